@@ -11,9 +11,14 @@ BUILD_PATH = default_build_path()
 QUERY_LOG_DIR = dodos.noisepage.ARTIFACT_pgdata_log
 
 # Scratch work.
-PREPROCESSOR_ARTIFACT = BUILD_PATH / "preprocessed.parquet.gzip"
+# The preprocessor output is a Parquet dataset directory that is appended to incrementally.
+# Its manifest changes whenever new query log data is added, so the manifest is used for dependency tracking.
+PREPROCESSOR_ARTIFACT = BUILD_PATH / "preprocessed.parquet"
+PREPROCESSOR_MANIFEST = PREPROCESSOR_ARTIFACT / "_manifest.json"
 PREPROCESSOR_TIMESTAMP = BUILD_PATH / "preprocessed.timestamp.txt"
 CLUSTER_ARTIFACT = BUILD_PATH / "clustered.parquet"
+# Versions of the cluster assignments, which keep cluster ids stable across clustering runs.
+CLUSTER_STORE = BUILD_PATH / "clusters"
 MODEL_DIR = BUILD_PATH / "models"
 
 # Default forecasting parameters.
@@ -28,6 +33,8 @@ ARTIFACT_FORECAST = ARTIFACTS_PATH / "forecast.csv"
 def task_forecast_preprocess():
     """
     Forecast: preprocess the query logs by extracting query templates.
+
+    Only query log files (and the tails of query log files) that have not been preprocessed yet are read.
     """
 
     def preprocessor_action():
@@ -36,6 +43,8 @@ def task_forecast_preprocess():
             f"--query-log-folder {QUERY_LOG_DIR} "
             f"--output-parquet {PREPROCESSOR_ARTIFACT} "
             f"--output-timestamp {PREPROCESSOR_TIMESTAMP} "
+            "--incremental "
+            "--output-format dictionary "
         )
 
     return {
@@ -45,8 +54,10 @@ def task_forecast_preprocess():
             # Preprocess the PostgreSQL query logs.
             CmdAction(preprocessor_action),
         ],
+        # A code change reruns the preprocessor, which only reprocesses the logs from scratch if it bumped
+        # the manifest's FORMAT_VERSION.
         "file_dep": ["./forecast/preprocessor.py", *QUERY_LOG_DIR.glob("*")],
-        "targets": [PREPROCESSOR_ARTIFACT],
+        "targets": [PREPROCESSOR_MANIFEST, PREPROCESSOR_TIMESTAMP],
         "verbosity": VERBOSITY_DEFAULT,
     }
 
@@ -61,11 +72,12 @@ def task_forecast_cluster():
             "python3 ./forecast/clusterer.py "
             f"--preprocessor-parquet {PREPROCESSOR_ARTIFACT} "
             f"--output-parquet {CLUSTER_ARTIFACT} "
+            f"--assignment-store {CLUSTER_STORE} "
         )
 
     return {
         "actions": [CmdAction(cluster_action)],
-        "file_dep": ["./forecast/clusterer.py", PREPROCESSOR_ARTIFACT],
+        "file_dep": ["./forecast/clusterer.py", PREPROCESSOR_MANIFEST],
         "targets": [CLUSTER_ARTIFACT],
         "verbosity": VERBOSITY_DEFAULT,
     }
@@ -76,7 +88,9 @@ def task_forecast_predict():
     Forecast: produce predictions for the given time range.
     """
 
-    def forecast_action(pred_start, pred_end, pred_horizon, pred_interval, pred_seqlen):
+    def forecast_action(
+        pred_start, pred_end, pred_horizon, pred_interval, pred_seqlen, pred_incremental, pred_override
+    ):
         # Read the query log timestamps from the preprocessor's output.
         # TODO(WAN): This file is read repeatedly!
         with open(PREPROCESSOR_TIMESTAMP) as ts_file:
@@ -101,10 +115,13 @@ def task_forecast_predict():
             f"with horizon {pred_horizon}, interval {pred_interval}, seqlen {pred_seqlen}"
         )
 
+        # By default, saved models are reused unless their cluster changed in the assignment store.
+        model_flags = ("--incremental " if pred_incremental else "") + ("--override-models " if pred_override else "")
         return (
             "python3 ./forecast/forecaster.py "
             f"--preprocessor-parquet {PREPROCESSOR_ARTIFACT} "
             f"--clusterer-parquet {CLUSTER_ARTIFACT} "
+            f"--assignment-store {CLUSTER_STORE} "
             f"--model-path {MODEL_DIR} "
             f'--start-time "{pred_start}" '
             f'--end-time "{pred_end}" '
@@ -112,7 +129,7 @@ def task_forecast_predict():
             f"--horizon {pred_horizon.isoformat()} "
             f"--interval {pred_interval.isoformat()} "
             f"--seqlen {pred_seqlen} "
-            "--override-models "  # TODO(Mike): Always override models?
+            f"{model_flags}"
         )
 
     return {
@@ -120,7 +137,7 @@ def task_forecast_predict():
             f"mkdir -p {MODEL_DIR}",
             CmdAction(forecast_action),
         ],
-        "file_dep": ["./forecast/forecaster.py", PREPROCESSOR_ARTIFACT, PREPROCESSOR_TIMESTAMP, CLUSTER_ARTIFACT],
+        "file_dep": ["./forecast/forecaster.py", PREPROCESSOR_MANIFEST, PREPROCESSOR_TIMESTAMP, CLUSTER_ARTIFACT],
         "targets": [ARTIFACT_FORECAST],
         "verbosity": VERBOSITY_DEFAULT,
         "params": [
@@ -159,5 +176,19 @@ def task_forecast_predict():
                 "type": int,
                 "default": DEFAULT_PRED_SEQLEN,
             },
+            {
+                "name": "pred_incremental",
+                "long": "pred_incremental",
+                "help": "Fine-tune the saved models on new query data instead of retraining them from scratch.",
+                "type": bool,
+                "default": False,
+            },
+            {
+                "name": "pred_override",
+                "long": "pred_override",
+                "help": "Retrain every model from scratch, instead of only the models of clusters that changed.",
+                "type": bool,
+                "default": False,
+            },
         ],
     }
@@ -1,13 +1,13 @@
-import datetime
-from typing import Dict
+import json
+import time
+from pathlib import Path
+from typing import Dict, List
 
 import numpy as np
 import pandas as pd
-import sklearn.metrics.pairwise
-import sklearn.neighbors
-import sklearn.preprocessing
+import scipy.sparse
 from plumbum import cli
-from preprocessor import Preprocessor
+from preprocessor import LogManifest, Preprocessor, _atomic_write, _to_ns
 from sklearn.cluster import DBSCAN
 
 
@@ -25,6 +25,12 @@ class Clusterer:
     _df : pd.Dataframe
         Dataframe of counts grouped by (template, log_time_s)
         where log_time_s is aggregated to the clustering_interval
+    _index : pd.MultiIndex
+        The index of _df, without any unused level values.
+    _counts : np.ndarray | scipy.sparse.csr_matrix
+        (templates x intervals) matrix of the counts in _df, whichever representation is smaller.
+        Row i is the template _get_queries()[i] and column j is the interval starting at
+        min_time + j * interval_delta.
     n_samples : int
         Number of samples to use for calculating similarity between arrival rates.
     rho : float
@@ -43,14 +49,26 @@ class Clusterer:
         Number of time steps to to run online clustering.
     _dbgname : dict (string:int)
         Reverse lookup from query template string to an id.
+    offline_engine : str
+        The algorithm that _cluster_offline uses, one of OFFLINE_ENGINES.
+    _sampler : StratifiedSampler
+        Plans which intervals are sampled for similarity measurement.
     """
 
+    # dbscan: DBSCAN with the cosine metric, which computes O(templates^2) pairwise distances.
+    # leader: a single leader-follower pass over normalized templates, in O(templates x clusters) time
+    #         and O(clusters) memory.
+    OFFLINE_ENGINES = ["dbscan", "leader"]
+
     def __init__(
         self,
         dataframe,
         n_samples=10000,
         rho=0.8,
         cluster_interval=pd.Timedelta(seconds=1),
+        offline_engine="dbscan",
+        seed=15721,
+        clock=None,
     ):
         """
         Cluster the provided dataframe according to QueryBot5000.
@@ -65,16 +83,32 @@ class Clusterer:
             Cosine similarity threshold for query template clustering.
         cluster_interval : pd.TimeDelta
             Time interval to group and count the query templates.
+        offline_engine : str
+            The offline clustering algorithm, one of OFFLINE_ENGINES.
+        seed : int | None
+            The seed for sampling intervals, so that clustering is reproducible. None seeds from the OS.
+        clock : Callable[[str], None] | None
+            If specified, called with the name of each phase once the phase completes.
         """
         assert dataframe.index.names == ["query_template", "log_time_s"]
         assert dataframe.columns.values == ["count"]
+        assert offline_engine in self.OFFLINE_ENGINES, f"Unknown offline engine: {offline_engine}"
         self._df = dataframe
         self.n_samples = n_samples
         self.rho = rho
+        self.offline_engine = offline_engine
+        self._sampler = StratifiedSampler(n_samples, seed=seed)
+        self._clock = clock
+
+        # The templates and timestamps are derived from the index's levels and codes, which is much cheaper
+        # than materializing a value for every row. Prune the levels once, so that they are all in use.
+        self._index = self._df.index.remove_unused_levels()
+        self._queries = sorted(self._index.levels[0])
 
         # Cluster interval of every second.
-        self.min_time = self._get_timestamps().min()
-        self.max_time = self._get_timestamps().max()
+        timestamps = self._get_timestamps()
+        self.min_time = timestamps.min()
+        self.max_time = timestamps.max()
 
         self.interval_delta = cluster_interval
         self.n = int((self.max_time - self.min_time) / self.interval_delta + 1)
@@ -87,9 +121,17 @@ class Clusterer:
             template_str: template_id for template_id, template_str in dict(enumerate(self._get_queries())).items()
         }
 
+        # Lay the counts out as a matrix once, so that clustering only ever slices rows and columns.
+        self._counts = self._build_count_matrix()
+        self._done("Build count matrix")
+
         # Cluster the queries.
         self.assignment_df = self._cluster_offline()
 
+    def _done(self, label):
+        if self._clock is not None:
+            self._clock(label)
+
     def _get_queries(self):
         """
         Get the query templates being clustered.
@@ -99,95 +141,123 @@ class Clusterer:
         queries : List[str]
             A list of the query templates being clustered.
         """
-        return sorted(set(self._df.index.get_level_values(0)))
+        return self._queries
 
     def _get_timestamps(self):
         """
-        Get all the timestamps across all the query templates.
+        Get all the distinct timestamps across all the query templates.
 
         Returns
         -------
         timestamps : pd.DatetimeIndex
-            All the timestamps.
+            All the distinct timestamps.
         """
 
         # TODO(Mike): Are we ever relying on the date time index here to
         # reconstruct the time series with the clustering interval?
         # Could anything go wrong if this only has
         # 00:00, 00:01, 00:03, 00:04, but missing 00:02?
-        return self._df.index.get_level_values(1)
+        return self._index.levels[1]
 
-    def _get_first_arrival(self, template):
+    def _build_count_matrix(self):
         """
-        Find the first arrival time for the given query.
-
-        Parameters
-        ----------
-        template : str
-            The query template to find the first arrival time for.
+        Build the (templates x intervals) count matrix of _df.
 
         Returns
         -------
-        first_arrival : pd.Timestamp
-            The first timestamp for the given query template.
+        counts : np.ndarray | scipy.sparse.csr_matrix
+            The count matrix. It is sparse if that takes less memory than a dense array.
         """
-        return self._df.xs(template, level=0).index.min()
+        # Map the index's codes to positions in the sorted templates and to intervals, one level value at a time.
+        index = self._index
+        rows = pd.Index(self._get_queries()).get_indexer(index.levels[0])[index.codes[0]]
+        cols = self._get_offset(self._get_timestamps())[index.codes[1]]
+        values = self._df["count"].to_numpy(dtype=np.int64)
+
+        shape = (len(self._dbgname), self.n)
+        nonzero = values != 0
+        # CSR stores a value and a column index per nonzero, and a row pointer per template.
+        sparse_bytes = nonzero.sum() * (values.itemsize + 4) + (shape[0] + 1) * 4
+        if sparse_bytes < shape[0] * shape[1] * values.itemsize:
+            counts = scipy.sparse.csr_matrix((values[nonzero], (rows[nonzero], cols[nonzero])), shape=shape)
+        else:
+            counts = np.zeros(shape, dtype=np.int64)
+            counts[rows, cols] = values
+        return counts
 
-    @staticmethod
-    def _query_df_range(df, template, start_time, end_time):
+    def get_centers(self):
         """
-
-        Parameters
-        ----------
-        df
-        template
-        start_time
-        end_time
+        Get the center of every cluster in assignment_df, which is the sum of its templates' counts.
 
         Returns
         -------
-        results : pd.DataFrame
+        centers : pd.Series
+            The non-zero counts of each cluster, indexed by (cluster, log_time_s).
         """
-        # The first level can be dropped since query_template == template.
-        return df.query(
-            "`query_template` == @template and @start_time <= `log_time_s` and `log_time_s` < @end_time"
-        ).droplevel(0)
+        labels = self.assignment_df["cluster"].reindex(self._get_queries()).to_numpy()
+        clusters, inverse = np.unique(labels, return_inverse=True)
+        membership = scipy.sparse.csr_matrix(
+            (np.ones(len(labels), dtype=np.int64), (inverse, np.arange(len(labels)))),
+            shape=(len(clusters), len(labels)),
+        )
+        centers = scipy.sparse.coo_matrix(membership @ self._counts)
+        nonzero = centers.data != 0
+        index = pd.MultiIndex.from_arrays(
+            [clusters[centers.row[nonzero]], self.min_time + centers.col[nonzero] * self.interval_delta],
+            names=["cluster", "log_time_s"],
+        )
+        return pd.Series(centers.data[nonzero], index=index, name="count").sort_index()
 
-    @staticmethod
-    def _query_df(df, template, timestamps):
+    def _get_offset(self, timestamps):
         """
-        Get template counts, sampled by timestamps
+        Convert timestamps to column offsets into the count matrix.
 
         Parameters
         ----------
-        df
-        template
-        timestamps
+        timestamps : pd.Timestamp | pd.DatetimeIndex
 
         Returns
         -------
-        results : pd.DataFrame
+        offsets : int | np.ndarray
         """
-        # The first level can be dropped since query_template == template.
-        df = df.query("`query_template` == @template and `log_time_s` in @timestamps").droplevel(0)
-        return df.reindex(timestamps, fill_value=0)
+        offsets = (timestamps - self.min_time) // self.interval_delta
+        return offsets if np.isscalar(offsets) else np.asarray(offsets, dtype=np.int64)
 
-    @staticmethod
-    def _query_series(series, timestamps):
+    def _template_samples(self, template_ids, offsets):
         """
-        Get values for a series, indexed by sample timestamps
+        Get the counts of templates at sampled intervals.
 
         Parameters
         ----------
-        series
-        timestamps
+        template_ids : int | np.ndarray
+            The rows of the templates in the count matrix.
+        offsets : np.ndarray
+            The sampled columns of the count matrix.
 
         Returns
         -------
-        results : pd.DataFrame
+        counts : np.ndarray
+            A vector if template_ids is a single row, otherwise a (templates x samples) matrix.
+        """
+        counts = self._slice_counts(np.atleast_1d(template_ids), offsets)
+        return counts.ravel() if np.isscalar(template_ids) else counts
+
+    def _slice_counts(self, template_ids, columns):
+        """
+        Get a dense (templates x columns) block of the count matrix, without copying any other columns.
+        """
+        if scipy.sparse.issparse(self._counts):
+            return self._counts[template_ids][:, columns].toarray()
+        return self._counts[template_ids[:, np.newaxis], columns]
+
+    @staticmethod
+    def _normalize(samples):
+        """
+        Scale every row to unit length, so that cosine similarities are dot products. All-zero rows stay zero.
         """
-        series = series.query("`log_time_s` in @timestamps")
-        return series.reindex(timestamps, fill_value=0)
+        samples = samples.astype(np.float64)
+        norms = np.linalg.norm(samples, axis=1, keepdims=True)
+        return np.divide(samples, norms, out=np.zeros_like(samples), where=norms > 0)
 
     @staticmethod
     def _similarity(s1, s2):
@@ -204,331 +274,1019 @@ class Clusterer:
         """
         if s1.shape[0] == 0 or s2.shape[0] == 0:
             return 0
-        # Reshape because we only have a single feature, the count.
-        arr1 = s1.reshape(-1, 1)
-        arr2 = s2.reshape(-1, 1)
         # Compute the cosine similarity.
-        return sklearn.metrics.pairwise.cosine_similarity(arr1, arr2)[0][0]
+        s1, s2 = Clusterer._normalize(np.stack([s1.ravel(), s2.ravel()]))
+        return s1 @ s2
 
-    @staticmethod
-    def _sample_timestamps(n, start_time, end_time, n_samples, interval):
+    def _cluster_online(self, lookback=pd.Timedelta(seconds=10)):
         """
+        Replay the counts through an OnlineClusterer, one interval at a time.
+
+        The resulting assignment changes are stored in assignment_events,
+        and the clustering itself is kept in online.
 
         Parameters
         ----------
-        n : int
-        start_time : pd.Timestamp
-        end_time : pd.Timestamp
-        n_samples : int
-        interval : pd.TimeDelta
+        lookback : pd.Timedelta
+            The sliding window that similarities are measured over.
+        """
+        window = max(1, int(lookback / self.interval_delta))
+        self.online = OnlineClusterer(
+            rho=self.rho, window=window, n_samples=self.n_samples, seed=self._sampler.seed, clock=self._clock
+        )
+        self.online.add_templates(self._get_queries())
+        # Slicing columns out of a CSR matrix is slow, so replay from a CSC copy.
+        counts = self._counts.tocsc() if scipy.sparse.issparse(self._counts) else self._counts
+        for current in range(self.n):
+            column = counts[:, current]
+            column = column.toarray().ravel() if scipy.sparse.issparse(column) else column
+            self.online.update(column, self.min_time + current * self.interval_delta)
+        self.assignment_events = self.online.drain_events()
+        for template, cluster in self.online.get_assignment_df()["cluster"].items():
+            print(self._dbgname[template], "->", cluster)
+        self.num_clusters = self.online.num_clusters
+
+    def _cluster_offline(self):
+        # TODO(Mike): only consider the last 10 seconds? or sample everything?
+        # Sample columns to consider, once for all the templates.
+        offsets = self._sampler.sample(0, self.n)
+        if self.offline_engine == "leader":
+            labels = self._cluster_offline_leader(offsets)
+        else:
+            # Create (k,n) matrix where there are
+            # k templates, n_sample features for DBSCAN.
+            counts = self._template_samples(np.arange(len(self._dbgname)), offsets)
+            self._done("Extract features")
+
+            clustering = DBSCAN(eps=1 - self.rho, metric="cosine", min_samples=1).fit(counts)
+            labels = clustering.labels_
+            self._done("Build neighbors")
+        reverse_lookup = {template_id: template_str for template_str, template_id in self._dbgname.items()}
+        final_assignments = {reverse_lookup[template_id]: cluster_id for template_id, cluster_id in enumerate(labels)}
+        assignment_df = pd.DataFrame(final_assignments.items(), columns=["query_template", "cluster"]).set_index(
+            "query_template"
+        )
+        self._done("Build assignments")
+        return assignment_df
+
+    def _cluster_offline_leader(self, offsets, batch_size=1024):
+        """
+        Cluster templates with a single leader-follower pass.
+
+        Templates are visited from the most to the least queried, since busier templates have less noisy
+        arrival rates to lead with. Each template joins the cluster of its most similar leader if the cosine
+        similarity is above rho, and otherwise leads a new cluster. Templates are normalized and compared to
+        all the leaders in batches, so only a batch of samples and the leaders are ever held in memory.
+
+        Unlike DBSCAN, similarity is not transitive through chains of templates: every template is within rho
+        of its own leader, and leaders are never within rho of each other.
+
+        Parameters
+        ----------
+        offsets : np.ndarray
+            The sampled columns of the count matrix.
+        batch_size : int
+            The number of templates to compare to the leaders at a time.
 
         Returns
         -------
-        samples : pd.DatetimeArray
-            Array of timestamps that were sampled.
+        labels : np.ndarray
+            The cluster of every template.
         """
-        if n > n_samples:
-            offsets = np.random.choice(a=n, size=n_samples, replace=False)
-        else:
-            offsets = np.arange(n)
-        timestamps = []
-        for offset in offsets:
-            next_time = start_time + interval * offset
-            if next_time >= end_time:
-                break
-            timestamps.append(next_time)
-        return pd.array(timestamps)
+        totals = np.asarray(self._counts.sum(axis=1)).ravel()
+        order = np.argsort(-totals, kind="stable")
+        labels = np.full(len(order), -1, dtype=np.int64)
+        leaders = np.zeros((0, len(offsets)), dtype=np.float32)
+        for batch_start in range(0, len(order), batch_size):
+            batch = order[batch_start : batch_start + batch_size]
+            samples = self._normalize(self._template_samples(batch, offsets)).astype(np.float32)
+            self._done("Extract features")
+            if len(leaders) > 0:
+                similarity = samples @ leaders.T
+                best = similarity.argmax(axis=1)
+                joins = similarity[np.arange(len(batch)), best] > self.rho
+                labels[batch[joins]] = best[joins]
+                batch, samples = batch[~joins], samples[~joins]
+
+            # The remaining templates are not similar to any existing leader, so they only need to be
+            # compared to each other, in order, to pick the new leaders.
+            new_leaders = []
+            for i, template_id in enumerate(batch):
+                if len(new_leaders) > 0:
+                    similarity = samples[new_leaders] @ samples[i]
+                    best = similarity.argmax()
+                    if similarity[best] > self.rho:
+                        labels[template_id] = len(leaders) + best
+                        continue
+                labels[template_id] = len(leaders) + len(new_leaders)
+                new_leaders.append(i)
+            leaders = np.vstack([leaders, samples[new_leaders]])
+            self._done("Assign leaders")
+        return labels
+
+
+class OnlineClusterer:
+    """
+    Incrementally cluster query templates over a sliding window of their arrival rates.
 
-    @staticmethod
-    def _build_neighbors(centers, timestamps, n_neighbors):
+    Every template and every cluster center is a ring buffer of its counts in the last `window` intervals.
+    Consuming an interval overwrites one slot of each ring buffer, so memory does not grow with the length
+    of the log. Only changes to the assignments are recorded, as an event log that callers drain.
+
+    Attributes
+    ----------
+    rho : float
+        Cosine similarity threshold for query template clustering.
+    window : int
+        Number of intervals that the ring buffers hold.
+    n_samples : int
+        Maximum number of window slots to sample for similarity measurement.
+    n_intervals : int
+        Number of intervals consumed so far.
+    cluster_sizes : Dict[int, int]
+        Number of templates in each cluster.
+    cluster_totals : Dict[int, int]
+        Total count of each cluster since it was created.
+    next_cluster : int
+        The next cluster id to use.
+    """
+
+    def __init__(self, rho=0.8, window=40, n_samples=10000, seed=15721, clock=None):
+        """
+        Parameters
+        ----------
+        rho : float
+            Cosine similarity threshold for query template clustering.
+        window : int
+            Number of most recent intervals that similarities are measured over.
+        n_samples : int
+            Maximum number of window slots to sample for similarity measurement.
+        seed : int | None
+            The seed for sampling window slots. None seeds from the OS.
+        clock : Callable[[str], None] | None
+            If specified, called with the name of each phase of an update once the phase completes.
         """
+        self.rho = rho
+        self.window = window
+        self.n_samples = n_samples
+        self._sampler = StratifiedSampler(n_samples, seed=seed)
+        self._clock = clock
+        self.n_intervals = 0
+
+        self._templates: List[str] = []
+        self._template_ids: Dict[str, int] = {}
+        self._template_windows = np.zeros((0, window), dtype=np.int64)
+        self._first_arrival = np.zeros(0, dtype=np.int64)
+        # The cluster of every template, or -1 if it has not been assigned yet.
+        self._labels = np.zeros(0, dtype=np.int64)
+
+        # Center ring buffers are rows of a matrix. Rows of merged clusters are reused by new clusters.
+        self._center_windows = np.zeros((0, window), dtype=np.int64)
+        self._center_rows: Dict[int, int] = {}
+        self._free_rows: List[int] = []
+        self.cluster_sizes: Dict[int, int] = {}
+        self.cluster_totals: Dict[int, int] = {}
+        self.next_cluster = 0
+
+        # Assignment changes since the last drain_events(), as (log_time, template id, cluster) columns.
+        self._events = ([], [], [])
+
+    def _done(self, label):
+        if self._clock is not None:
+            self._clock(label)
+
+    @property
+    def num_clusters(self):
+        return len(self._center_rows)
+
+    def add_templates(self, templates):
+        """
+        Register query templates, so that they can be counted. Already registered templates are ignored.
 
         Parameters
         ----------
-        centers
-        timestamps
-        n_neighbors
+        templates : List[str]
 
         Returns
         -------
-        neighbors : sklearn.neighbors.NearestNeighbors | None
+        template_ids : np.ndarray
+            The id of every template, which is its position in the counts passed to update().
         """
-        clusters = sorted(centers.keys())
-        samples = np.array([Clusterer._query_series(centers[cluster], timestamps).values for cluster in clusters])
+        new_templates = [template for template in dict.fromkeys(templates) if template not in self._template_ids]
+        if len(new_templates) > 0:
+            self._template_ids.update({template: len(self._templates) + i for i, template in enumerate(new_templates)})
+            self._templates.extend(new_templates)
+            n_new = len(new_templates)
+            self._template_windows = np.vstack([self._template_windows, np.zeros((n_new, self.window), np.int64)])
+            self._first_arrival = np.append(self._first_arrival, np.full(n_new, np.iinfo(np.int64).max))
+            self._labels = np.append(self._labels, np.full(n_new, -1, dtype=np.int64))
+        return np.array([self._template_ids[template] for template in templates], dtype=np.int64)
+
+    def update(self, counts, log_time):
+        """
+        Consume the counts of the next interval and adjust the cluster assignments.
 
-        if len(samples) == 0:
-            neighbors = None
+        Parameters
+        ----------
+        counts : pd.Series | np.ndarray
+            The count of every template in the interval. Either indexed by query template, in which case
+            unseen templates are registered, or an array ordered by template id.
+        log_time : pd.Timestamp
+            The start of the interval, which is recorded with any resulting assignment changes.
+        """
+        if isinstance(counts, pd.Series):
+            template_ids = self.add_templates(counts.index)
+            column = np.zeros(len(self._templates), dtype=np.int64)
+            np.add.at(column, template_ids, counts.to_numpy(dtype=np.int64))
         else:
-            samples = samples.reshape(len(clusters), -1)
-            normalized_samples = sklearn.preprocessing.normalize(samples, copy=False)
-            neighbors = sklearn.neighbors.NearestNeighbors(n_neighbors=n_neighbors, algorithm="kd_tree", metric="l2")
-            neighbors.fit(normalized_samples)
-        return neighbors
+            column = np.zeros(len(self._templates), dtype=np.int64)
+            column[: len(counts)] = counts
+
+        current = self.n_intervals
+        slot = current % self.window
+        self._first_arrival[(column > 0) & (self._first_arrival > current)] = current
+
+        # Slide every ring buffer forward by one interval, which is all that assigned templates contribute.
+        self._template_windows[:, slot] = column
+        self._center_windows[:, slot] = 0
+        assigned = np.flatnonzero(self._labels >= 0)
+        rows = self._get_center_rows(self._labels[assigned])
+        np.add.at(self._center_windows[:, slot], rows, column[assigned])
+        for cluster, total in zip(*self._sum_by_cluster(self._labels[assigned], column[assigned])):
+            self.cluster_totals[cluster] += total
+
+        # One plan of slots is shared by the templates and the centers for this interval.
+        slots = self._sampler.sample(0, self.window)
+        self._done("Slide windows")
+        self._assign_templates(current, slots, log_time)
+        self._done("Assign templates")
+        self._merge_clusters(slots, log_time)
+        self._done("Merge clusters")
+        self.n_intervals += 1
+
+    def get_assignment_df(self):
+        """
+        Get the current cluster assignments of all the templates that have been assigned.
 
-    def _modify_cluster(self, positive, cluster, template, start_time, end_time):
-        """Add or remove a template from a cluster.
+        Returns
+        -------
+        assignment_df : pd.DataFrame
+            The cluster of every query template, indexed by query template.
+        """
+        assigned = np.flatnonzero(self._labels >= 0)
+        return pd.DataFrame(
+            {"cluster": self._labels[assigned]},
+            index=pd.Index(np.array(self._templates, dtype=object)[assigned], name="query_template"),
+        )
+
+    def drain_events(self):
+        """
+        Get the assignment changes since the last call, and forget them.
+
+        Returns
+        -------
+        events : pd.DataFrame
+            One row per change, with the log_time_s of the interval that caused it, the query_template,
+            and its new cluster. A cluster of -1 means that the template was unassigned.
+        """
+        log_times, template_ids, clusters = self._events
+        events = pd.DataFrame(
+            {
+                "log_time_s": pd.to_datetime(np.array(log_times, dtype=np.int64), utc=True),
+                "query_template": np.array(self._templates, dtype=object)[np.array(template_ids, dtype=np.int64)],
+                "cluster": np.array(clusters, dtype=np.int64),
+            }
+        )
+        self._events = ([], [], [])
+        return events
+
+    def _record(self, template_ids, log_time):
+        """
+        Record the current clusters of templates as assignment changes.
+        """
+        self._events[0].extend([pd.Timestamp(log_time).value] * len(template_ids))
+        self._events[1].extend(template_ids.tolist())
+        self._events[2].extend(self._labels[template_ids].tolist())
+
+    def _get_center_rows(self, clusters):
+        """
+        Look up the center rows of clusters, in bulk.
+        """
+        clusters = np.asarray(clusters, dtype=np.int64)
+        if len(clusters) == 0:
+            return np.zeros(0, dtype=np.int64)
+        known = np.fromiter(self._center_rows.keys(), dtype=np.int64, count=len(self._center_rows))
+        rows = np.fromiter(self._center_rows.values(), dtype=np.int64, count=len(self._center_rows))
+        order = np.argsort(known)
+        positions = np.minimum(np.searchsorted(known[order], clusters), len(known) - 1)
+        assert (known[order][positions] == clusters).all(), "Unknown cluster."
+        return rows[order][positions]
+
+    @staticmethod
+    def _sum_by_cluster(clusters, values):
+        """
+        Sum values, or rows of values, per cluster.
+        """
+        unique_clusters, inverse = np.unique(clusters, return_inverse=True)
+        sums = np.zeros((len(unique_clusters),) + values.shape[1:], dtype=np.int64)
+        np.add.at(sums, inverse, values)
+        return unique_clusters, sums
+
+    def _move_templates(self, template_ids, clusters, sign):
+        """
+        Add the windows of templates to the centers of clusters, or remove them with sign=-1.
+        """
+        if len(template_ids) == 0:
+            return
+        unique_clusters, sums = self._sum_by_cluster(clusters, self._template_windows[template_ids])
+        self._center_windows[self._get_center_rows(unique_clusters)] += sign * sums
+        for cluster, size in zip(*np.unique(clusters, return_counts=True)):
+            self.cluster_sizes[cluster] += sign * size
+
+    def _new_cluster(self):
+        """
+        Create an empty cluster.
+        """
+        cluster = self.next_cluster
+        self.next_cluster += 1
+        if len(self._free_rows) > 0:
+            row = self._free_rows.pop()
+        else:
+            row = len(self._center_windows)
+            self._center_windows = np.vstack([self._center_windows, np.zeros((max(row, 1), self.window), np.int64)])
+            self._free_rows.extend(range(len(self._center_windows) - 1, row, -1))
+        self._center_windows[row] = 0
+        self._center_rows[cluster] = row
+        self.cluster_sizes[cluster] = 0
+        self.cluster_totals[cluster] = 0
+        return cluster
+
+    def _assign_templates(self, current, slots, log_time):
+        """
+        Adjust every template's cluster assignment, in bulk.
+
+        Similarities between all the templates and all the cluster centers are computed with a single
+        matrix multiply of their normalized windows. A template stays in its cluster if it is still similar to
+        it (or is its last member), and otherwise joins the most similar cluster if that is similar enough.
+        The remaining templates are grouped into new clusters, each led by the first of them that is not
+        similar to an earlier leader.
 
         Parameters
         ----------
-        positive : bool
-            True for add, False for remove.
-        cluster : int
-            The Cluster to modify.
-        template : string
-            Template to add to or remove from.
-        start_time, end_time : pd.Timestamp
-            Current time range considered
-        """
-        modify_method = self.centers[cluster].add if positive else self.centers[cluster].sub
-
-        self.centers[cluster] = modify_method(
-            self._query_df_range(self._df, template, start_time, end_time), fill_value=0
+        current : int
+            The interval being clustered.
+        slots : np.ndarray
+            The window slots to sample from the templates and centers for similarity measurement.
+        log_time : pd.Timestamp
+            The start of the interval being clustered.
+        """
+        labels = self._labels
+        labels_before = labels.copy()
+        samples = Clusterer._normalize(self._template_windows[:, slots])
+        clusters = np.array(sorted(self._center_rows), dtype=np.int64)
+        centers = Clusterer._normalize(self._center_windows[self._get_center_rows(clusters)][:, slots])
+        similarity = samples @ centers.T
+
+        # A template without any queries in the window gives no evidence to (re)assign it on, which is common
+        # when following a live log. If it has not appeared at this point in time, its assignment is still None.
+        idle = ~samples.any(axis=1)
+        assigned = labels >= 0
+        active = assigned | ((current > self._first_arrival) & ~idle)
+
+        # Templates that are still similar to their cluster, or are its last member, stay in it.
+        old_slots = np.searchsorted(clusters, labels[assigned])
+        sizes = np.array([self.cluster_sizes[cluster] for cluster in clusters], dtype=np.int64)
+        stays = np.zeros(len(labels), dtype=bool)
+        old_similarity = similarity[np.flatnonzero(assigned), old_slots]
+        stays[assigned] = (sizes[old_slots] == 1) | (old_similarity > self.rho) | idle[assigned]
+        leaving = np.flatnonzero(assigned & ~stays)
+        # A cluster that all its members would leave keeps its first member instead.
+        leaving_clusters, leaving_first, leaving_sizes = np.unique(
+            labels[leaving], return_index=True, return_counts=True
         )
-        self.cluster_sizes[cluster] += 1 if positive else -1
+        emptied = leaving_sizes == sizes[np.searchsorted(clusters, leaving_clusters)]
+        stays[leaving[leaving_first[emptied]]] = True
+        leaving = np.flatnonzero(assigned & ~stays)
+
+        # Eliminate the leaving templates from their old clusters.
+        self._move_templates(leaving, labels[leaving], sign=-1)
+        labels[leaving] = -1
+
+        # Try to find a cluster membership for the other templates.
+        unassigned = np.flatnonzero(active & ~stays)
+        if len(clusters) > 0 and len(unassigned) > 0:
+            best = similarity[unassigned].argmax(axis=1)
+            joins = similarity[unassigned, best] > self.rho
+            joining = unassigned[joins]
+            labels[joining] = clusters[best[joins]]
+            self._move_templates(joining, labels[joining], sign=1)
+            unassigned = unassigned[~joins]
+
+        # Otherwise, these templates need new clusters.
+        leaders = []
+        for template_id in unassigned:
+            if len(leaders) > 0:
+                leader_similarity = samples[leaders] @ samples[template_id]
+                if leader_similarity.max() > self.rho:
+                    labels[template_id] = labels[leaders[leader_similarity.argmax()]]
+                    continue
+            labels[template_id] = self._new_cluster()
+            leaders.append(template_id)
+            print(f"Created cluster {labels[template_id]} based on template: {template_id}")
+        self._move_templates(unassigned, labels[unassigned], sign=1)
+
+        # Record every template whose cluster is not the one it started this interval in.
+        self._record(np.flatnonzero(labels != labels_before), log_time)
+
+    def _merge_clusters(self, slots, log_time):
+        """
+        Merge every cluster into its most similar cluster, if they are similar enough.
+
+        Parameters
+        ----------
+        slots : np.ndarray
+            The window slots to sample from the centers for similarity measurement.
+        log_time : pd.Timestamp
+            The start of the interval being clustered.
+        """
+        clusters = np.array(sorted(self._center_rows), dtype=np.int64)
+        if len(clusters) <= 1:
+            return
+        rows = self._get_center_rows(clusters)
+        # Our query points are centers, so exclude each center from being its own merge candidate.
+        centers = Clusterer._normalize(self._center_windows[rows][:, slots])
+        similarity = centers @ centers.T
+        np.fill_diagonal(similarity, -np.inf)
+        nearest = similarity.argmax(axis=1)
+        nearest_similarity = similarity[np.arange(len(clusters)), nearest]
+
+        # Clusters are merged into the root of their nearest cluster, which is tracked with a union-find forest.
+        # Only the centers of roots that absorb a cluster change, so only their normalized rows are refreshed,
+        # and only once they are compared again.
+        parent = list(range(len(clusters)))
+        absorbed = [False] * len(clusters)
+        stale = set()
+
+        def find(i):
+            root = i
+            while parent[root] != root:
+                root = parent[root]
+            while parent[i] != root:
+                parent[i], i = root, parent[i]
+            return root
+
+        def measure(i, j):
+            for k in stale.intersection((i, j)):
+                centers[k] = Clusterer._normalize(self._center_windows[rows[k]][np.newaxis, slots])[0]
+                stale.discard(k)
+            return centers[i] @ centers[j]
+
+        for i, (cluster, nearest_i, similarity_i) in enumerate(
+            zip(clusters.tolist(), nearest.tolist(), nearest_similarity.tolist())
+        ):
+            neighbor = find(nearest_i)
+            if neighbor == i:
+                continue
+            measured = measure(i, neighbor) if absorbed[i] or absorbed[neighbor] else similarity_i
+            row, merge_row = rows[i], rows[neighbor]
+            # Integer counts often land right on rho, where the matrix product may round the other way.
+            if abs(measured - self.rho) < 1e-9:
+                measured = Clusterer._similarity(
+                    self._center_windows[row][slots], self._center_windows[merge_row][slots]
+                )
+            if measured <= self.rho:
+                continue
+            merge_cluster = clusters[neighbor]
+            self._center_windows[merge_row] += self._center_windows[row]
+            print(f"{self.cluster_sizes[cluster]} templates merged from cluster {cluster} into {merge_cluster}.")
+            self.cluster_sizes[merge_cluster] += self.cluster_sizes[cluster]
+            del self._center_rows[cluster]
+            del self.cluster_sizes[cluster]
+            del self.cluster_totals[cluster]
+            self._free_rows.append(row)
+            parent[i] = neighbor
+            absorbed[neighbor] = True
+            stale.add(neighbor)
+
+        # Relabel the members of all the merged clusters in a single pass.
+        roots = clusters[[find(i) for i in range(len(clusters))]]
+        assigned = np.flatnonzero(self._labels >= 0)
+        new_labels = roots[np.searchsorted(clusters, self._labels[assigned])]
+        merged = assigned[new_labels != self._labels[assigned]]
+        if len(merged) > 0:
+            self._labels[assigned] = new_labels
+            self._record(merged, log_time)
+
+
+class StratifiedSampler:
+    """
+    Plan which intervals to sample for similarity measurement.
+
+    A range of intervals is split into n_samples strata of (nearly) equal width, and one interval is drawn
+    uniformly from each stratum. Unlike sampling the whole range without replacement, this covers the range
+    evenly, and the plan comes out sorted and within the range. Plans are drawn from a seeded generator, so
+    a clustering run is reproducible.
 
-    def _adjust_template(self, template, current_time, old_assignment, timestamps, neighbors):
-        """Adjust template cluster assignment at current time.
+    A plan is computed once and then used to slice every template and center that is compared with it.
+    """
 
+    def __init__(self, n_samples, seed=15721):
+        """
         Parameters
         ----------
-        template : string
-            The query template we need to update.
-        current_time : pd.Timestamp
-            Timestamp of the current clustering iteration.
-        old_assignment : int
-            Template's previous cluster assignment.
-        timestamps : np.array(pd.Timestamp)
-            Array of timestamps to sample from the centers fo similarity measurement.
-        neighbors : sklearn.neighbors.NearestNeighbors
-            Nearest neighbor learner containing all the cluster centers.
+        n_samples : int
+            The maximum number of intervals in a plan.
+        seed : int | None
+            The seed of the random number generator. None seeds from the OS.
+        """
+        self.n_samples = n_samples
+        self.seed = seed
+        self._rng = np.random.default_rng(seed)
+
+    def sample(self, start, end):
+        """
+        Sample intervals from a range.
+
+        Parameters
+        ----------
+        start, end : int
+            The range [start, end) of columns to sample from.
 
         Returns
         -------
-        The updated cluster assignment to be added to self.assignments.
-        """
-        end_time = current_time + self.cluster_gap * self.interval_delta
-        # Only consider the last 10 seconds.
-        start_time = max(self.min_time, end_time - datetime.timedelta(seconds=10))
-
-        # If template has not appeared at this point in time; assignment is still None.
-        if (old_assignment is None) and (current_time <= self._get_first_arrival(template)):
-            return None
-        if old_assignment is not None:
-            # Template is the last member of the cluster.
-            last_cluster_element = self.cluster_sizes[old_assignment] == 1
-            # Template still belongs to its old cluster.
-            still_belongs = (
-                Clusterer._similarity(
-                    self._query_df(self._df, template, timestamps).values,
-                    self._query_series(self.centers[old_assignment], timestamps).values,
-                )
-                > self.rho
-            )
-            # If the template still belongs.
-            if last_cluster_element or still_belongs:
-                # reason = ('L' if last_cluster_element else '') + ('B' if still_belongs else '')
-                # print(f'Template stayed in cluster {old_cluster} because ({reason}): {self._dbgname[template]}')
-                return old_assignment
-
-            # Otherwise, eliminate the template from its old cluster.
-            self._modify_cluster(False, old_assignment, template, start_time, end_time)
-            # print(f'Template eliminated from cluster {old_cluster}: {self._dbgname[template]}')
-
-        new_assignment = None
-        # Try to find a cluster membership for the template.
-        if neighbors is None:
-            for cluster in self.centers.keys():
-                if (
-                    self._similarity(
-                        self._query_df(self._df, template, timestamps).values,
-                        self._query_series(self.centers[cluster], timestamps).values,
+        offsets : np.ndarray
+            The sorted, distinct columns that were sampled. Every column is sampled if the range has at most
+            n_samples columns.
+        """
+        n = max(end - start, 0)
+        if n <= self.n_samples:
+            return np.arange(start, start + n)
+        edges = start + np.arange(self.n_samples + 1) * n // self.n_samples
+        widths = np.diff(edges)
+        return edges[:-1] + (self._rng.random(self.n_samples) * widths).astype(np.int64)
+
+
+class IntervalCounter:
+    """
+    Turn a stream of query log chunks into per-interval template counts.
+
+    The latest interval that has been seen may still receive log entries from the next chunk, so it is held
+    back until a later log entry shows that it is complete. Intervals are aligned to the epoch, like those of
+    a CountCube.
+    """
+
+    def __init__(self, interval, max_gap=None):
+        """
+        Parameters
+        ----------
+        interval : pd.Timedelta
+            The interval to count the query templates by.
+        max_gap : int | None
+            If specified, at most this many empty intervals are produced for a gap in the log.
+        """
+        self.interval = interval
+        self.max_gap = max_gap
+        # The counts of the intervals that are not complete yet, indexed by (interval start in ns, template).
+        self._pending = pd.Series(dtype=np.int64)
+        # The start of the next interval to produce, in ns.
+        self._next = None
+        self.late_entries = 0
+
+    def add(self, df):
+        """
+        Count a chunk of the query log.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Log entries indexed by log_time, with a query_template column, e.g., from Preprocessor.read_dataset_part.
+
+        Returns
+        -------
+        intervals : List[Tuple[pd.Timestamp, pd.Series]]
+            Every interval that was completed by this chunk, in order, as its start and its counts indexed by
+            query template. Intervals in a gap of the log have no counts.
+        """
+        df = df[df["query_template"] != ""]
+        if len(df) == 0:
+            return []
+        log_time_ns = _to_ns(df.index)
+        buckets = log_time_ns - log_time_ns % self.interval.value
+        counts = df.groupby([buckets, df["query_template"].astype(str).to_numpy()]).size()
+        if self._next is None:
+            self._next = buckets.min()
+        late = counts.index.get_level_values(0) < self._next
+        if late.any():
+            # The intervals of these log entries were already produced, so they can only be dropped.
+            self.late_entries += counts[late].sum()
+            counts = counts[~late]
+        self._pending = counts if len(self._pending) == 0 else self._pending.add(counts, fill_value=0)
+
+        # Everything before the latest interval seen is complete.
+        latest = self._pending.index.get_level_values(0).max()
+        complete = self._pending[self._pending.index.get_level_values(0) < latest]
+        self._pending = self._pending[self._pending.index.get_level_values(0) == latest]
+        complete_counts = {bucket: bucket_counts.droplevel(0) for bucket, bucket_counts in complete.groupby(level=0)}
+
+        intervals = []
+        while self._next < latest:
+            bucket_counts = complete_counts.get(self._next)
+            if bucket_counts is None:
+                # Skip to the next interval with counts once an empty gap is long enough.
+                gap_end = min([bucket for bucket in complete_counts if bucket > self._next], default=latest)
+                if self.max_gap is not None and (gap_end - self._next) // self.interval.value > self.max_gap:
+                    intervals.extend(
+                        (
+                            pd.Timestamp(self._next + i * self.interval.value, unit="ns", tz="UTC"),
+                            pd.Series(dtype=np.int64),
+                        )
+                        for i in range(self.max_gap)
                     )
-                    > self.rho
-                ):
-                    new_assignment = cluster
-                    break
-        else:
-            data = self._query_df(self._df, template, timestamps)["count"].values.reshape(1, -1)
-            data = sklearn.preprocessing.normalize(data)
-            neighbor = neighbors.kneighbors(data, return_distance=False)[0][0]
-            clusters = sorted(self.centers.keys())
-            if self._similarity(data, self.centers[clusters[neighbor]].values) > self.rho:
-                new_assignment = clusters[neighbor]
-
-        # If this template found a cluster to join, then make the assignment and continue.
-        if new_assignment is not None:
-            # description = 'joined' if old_assignment is None else 'reassigned to'
-            # print(f'Template {description} cluster {new_cluster}: {self._dbgname[template]}')
-            self._modify_cluster(True, new_assignment, template, start_time, end_time)
-            return new_assignment
-
-        # Otherwise, this template needs a new cluster. Make a new cluster.
-        new_assignment = self.next_cluster
-        self.next_cluster += 1
+                    self._next = gap_end
+                    continue
+                bucket_counts = pd.Series(dtype=np.int64)
+            intervals.append((pd.Timestamp(self._next, unit="ns", tz="UTC"), bucket_counts.astype(np.int64)))
+            self._next += self.interval.value
+        return intervals
 
-        self.centers[new_assignment] = self._query_df_range(self._df, template, start_time, end_time)
-        assert self.centers[new_assignment].index.name == "log_time_s"
-        assert self.centers[new_assignment].columns.values == ["count"]
-        if self.centers[new_assignment].shape[0] == 0:
-            print(
-                f"WARNING: cluster {new_assignment} has no items."
-                f"Does the following query appear within the lookback window:"
-                f"{self._dbgname[template]}"
-            )
 
-        self.cluster_sizes[new_assignment] = 1
-        self.cluster_totals[new_assignment] = 0
-        print(f"Created cluster {new_assignment} based on template: {self._dbgname[template]}")
-        return new_assignment
+class AssignmentStore:
+    """
+    Keep versions of the cluster assignments, with cluster ids that are stable across clustering runs.
 
-    def _cluster_online(self):
-        # Map cluster id to df representing center of cluster.
-        self.centers: Dict[int, pd.DataFrame] = {}
-        self.cluster_totals: Dict[int, int] = {}
-        self.cluster_sizes: Dict[int, int] = {}
+    Clustering from scratch numbers its clusters arbitrarily. When a new clustering is committed, each of its
+    clusters is matched to the most similar center of the previous version, and takes over that cluster's id
+    if they are similar enough. Other clusters get ids that have never been used. Every version also records
+    the template->cluster changes from the previous version, so that consumers only need to revisit the
+    clusters whose membership changed.
 
-        # Array representing the assignment of template to clusters at a given time.
-        self.assignments = [
-            (
-                self.min_time,
-                {template: None for template in sorted(self._get_queries())},
-            )
-        ]
+    A version is stored as a version-<number>/ directory of Parquet files:
+    assignments.parquet (query_template, cluster), deltas.parquet (query_template, old_cluster, new_cluster),
+    and centers.parquet (cluster, log_time_s, count), the total count of each cluster per interval.
+    A cluster of -1 in a delta means that the template was not assigned in that version.
 
-        # Begin at min time with no assignments.
-        current_time = self.min_time
+    Attributes
+    ----------
+    store_path : Path
+        The directory of the store.
+    versions : List[dict]
+        The committed versions, oldest first. Each has its version number, commit time, and changed clusters.
+    next_cluster : int
+        The next cluster id to use.
+    """
+
+    FILENAME = "_versions.json"
 
-        # The next cluster id to use.
+    def __init__(self, store_path):
+        self.store_path = Path(store_path)
+        self.versions = []
         self.next_cluster = 0
+        manifest_path = self.store_path / self.FILENAME
+        if manifest_path.exists():
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            self.versions = manifest["versions"]
+            self.next_cluster = manifest["next_cluster"]
+
+    @property
+    def latest_version(self):
+        """
+        The number of the latest version, or None if nothing has been committed.
+        """
+        return self.versions[-1]["version"] if len(self.versions) > 0 else None
 
-        for gap in range(self.n_gaps):
-            # End time is the next interval.
-            next_time = current_time + self.cluster_gap * self.interval_delta
-            # Only consider the last 10 seconds.
-            start_time = max(self.min_time, next_time - datetime.timedelta(seconds=10))
-            # Timestamps to consider.
-            timestamps = self._sample_timestamps(self.n, start_time, next_time, self.n_samples, self.interval_delta)
-
-            # Get assignment dicts.
-            last_assignment = self.assignments[-1][1]
-            assignment = last_assignment.copy()
-
-            # Update counts for all the assignments made in the past round.
-            for template in last_assignment:
-                old_assignment = last_assignment[template]
-                if old_assignment is not None:
-                    counts = self._query_df_range(self._df, template, current_time, next_time)
-                    self.centers[old_assignment] = self.centers[old_assignment].add(counts, fill_value=0)
-                    self.cluster_totals[old_assignment] += counts.sum().values[0]
-
-            # If possible, build a kdtree of neighbors.
-            neighbors = self._build_neighbors(self.centers, timestamps, n_neighbors=1)
-
-            # For each template, try to assign a cluster.
-            for template in self._get_queries():
-                assignment[template] = self._adjust_template(
-                    template=template,
-                    current_time=current_time,
-                    old_assignment=last_assignment[template],
-                    timestamps=timestamps,
-                    neighbors=neighbors,
-                )
+    def _version_path(self, version):
+        version = self.latest_version if version is None else version
+        assert version is not None, "The assignment store is empty."
+        return self.store_path / f"version-{version:08d}"
 
-            # If possible, build an updated kdtree of neighbors. we need n_neighbors=2
-            # because our query points are centers, so the second closest neighbor is the merge candidate.
-            neighbors = self._build_neighbors(self.centers, timestamps, n_neighbors=2)
-            root = [None] * len(self.centers)
-            clusters = sorted(self.centers.keys())
-            if len(clusters) > 1:
-                # Try to merge clusters.
-                for i, cluster in enumerate(clusters):
-                    merge_cluster = None
-                    data = self._query_series(self.centers[cluster], timestamps)["count"].values.reshape(1, -1)
-                    data = sklearn.preprocessing.normalize(data)
-                    neighbor = neighbors.kneighbors(data, return_distance=False)
-
-                    neighbor_inds = neighbor[0]
-                    if clusters[neighbor_inds[0]] == cluster:
-                        neighbor = neighbor_inds[1]
-                    else:
-                        neighbor = neighbor_inds[0]
-                    while root[neighbor] is not None:
-                        neighbor = root[neighbor]
-                    is_similar = (
-                        self._similarity(
-                            self._query_series(self.centers[cluster], timestamps).values,
-                            self._query_series(self.centers[clusters[neighbor]], timestamps).values,
-                        )
-                        > self.rho
-                    )
-                    if cluster != clusters[neighbor] and is_similar:
-                        merge_cluster = clusters[neighbor]
-                    if merge_cluster is not None:
-                        self.centers[merge_cluster] = self.centers[merge_cluster].add(
-                            self.centers[cluster], fill_value=0
-                        )
-                        self.cluster_sizes[merge_cluster] += self.cluster_sizes[cluster]
-                        del self.centers[cluster]
-                        del self.cluster_sizes[cluster]
-                        if neighbors is not None:
-                            root[i] = neighbor
-                        for template in self._get_queries():
-                            if assignment[template] == cluster:
-                                assignment[template] = merge_cluster
-                                print(
-                                    f"Template merged from cluster {cluster} into {merge_cluster}: "
-                                    f"{self._dbgname[template]}"
-                                )
-            self.assignments.append((next_time, assignment))
-            current_time = next_time
-            for cluster, df in self.centers.items():
-                if df.shape[0] == 0:
-                    print(f"WARNING: gap {gap} cluster {cluster} has no items.")
-        for template, cluster in self.assignments[-1][1].items():
-            print(self._dbgname[template], "->", cluster)
-        self.num_clusters = len(self.centers)
+    def get_assignment_df(self, version=None):
+        """
+        Get the cluster of every query template, indexed by query template, in a version (default: latest).
+        """
+        return pd.read_parquet(self._version_path(version) / "assignments.parquet")
 
-    def _cluster_offline(self):
-        next_time = self.max_time + self.cluster_gap * self.interval_delta
-        # TODO(Mike): only consider the last 10 seconds? or sample everything?
-        start_time = self.min_time
-        # Sample timestamps to consider.
-        timestamps = self._sample_timestamps(self.n, start_time, next_time, self.n_samples, self.interval_delta)
-        counts = np.array(
-            [
-                # Create (k,n) matrix where there are
-                # k templates, n_sample features for DBSCAN.
-                self._query_df(self._df, template, timestamps).values.reshape((-1))
-                for template in self._get_queries()
-            ]
+    def get_deltas(self, version=None):
+        """
+        Get the templates whose cluster changed in a version (default: latest), indexed by query template.
+        """
+        return pd.read_parquet(self._version_path(version) / "deltas.parquet")
+
+    def get_centers(self, version=None):
+        """
+        Get the per-interval count of each cluster in a version (default: latest).
+        """
+        return pd.read_parquet(self._version_path(version) / "centers.parquet")["count"]
+
+    def get_changed_clusters(self, since=None, version=None):
+        """
+        Get the clusters that gained or lost templates after version since, up to a version (default: latest).
+
+        Cluster ids are stable, so this compares the assignments of the two versions directly, which also
+        covers any versions in between that a consumer skipped.
+
+        Parameters
+        ----------
+        since : int | None
+            The version that the consumer last saw, e.g., the one that a model was trained on.
+            If None, or if the store does not have this version, every cluster of the version is changed.
+        version : int | None
+            The version to compare against since. Default: latest.
+
+        Returns
+        -------
+        changed_clusters : List[int]
+            The changed clusters, which is empty if nothing has been committed.
+        """
+        version = self.latest_version if version is None else version
+        if version is None:
+            return []
+        current = self.get_assignment_df(version)["cluster"]
+        if since not in [entry["version"] for entry in self.versions]:
+            return sorted(int(cluster) for cluster in current.unique() if cluster != -1)
+        _, changed_clusters = self._diff_assignments(self.get_assignment_df(since)["cluster"], current)
+        return changed_clusters
+
+    @staticmethod
+    def _diff_assignments(previous, current):
+        """
+        Find the templates whose cluster differs between two assignments, as series of clusters by template.
+
+        Returns
+        -------
+        deltas : pd.DataFrame
+            The old_cluster and new_cluster of every changed template, where -1 means not assigned.
+        changed_clusters : List[int]
+            The clusters that gained or lost templates.
+        """
+        deltas = (
+            previous.rename("old_cluster")
+            .to_frame()
+            .join(current.rename("new_cluster"), how="outer")
+            .fillna(-1)
+            .astype(np.int64)
+        )
+        deltas = deltas[deltas["old_cluster"] != deltas["new_cluster"]]
+        changed_clusters = sorted(
+            int(cluster) for cluster in set(deltas["old_cluster"]) | set(deltas["new_cluster"]) if cluster != -1
         )
+        return deltas, changed_clusters
 
-        clustering = DBSCAN(eps=1 - self.rho, metric="cosine", min_samples=1).fit(counts)
-        labels = clustering.labels_
-        reverse_lookup = {template_id: template_str for template_str, template_id in self._dbgname.items()}
-        final_assignments = {reverse_lookup[template_id]: cluster_id for template_id, cluster_id in enumerate(labels)}
-        return pd.DataFrame(final_assignments.items(), columns=["query_template", "cluster"]).set_index(
-            "query_template"
+    @staticmethod
+    def _match_clusters(previous, current, rho):
+        """
+        Match clusters to the most similar previous clusters, one to one.
+
+        Clusters are compared by the cosine similarity of their centers over the time range that both cover.
+        Pairs are matched greedily from the most similar down, as long as they are more similar than rho.
+
+        Parameters
+        ----------
+        previous, current : pd.Series
+            The centers to match, as counts indexed by (cluster, log_time_s).
+        rho : float
+            Cosine similarity threshold for matching clusters.
+
+        Returns
+        -------
+        matches : Dict[int, int]
+            The previous cluster of each matched current cluster.
+        """
+        if len(previous) == 0 or len(current) == 0:
+            return {}
+        start = max(previous.index.get_level_values(1).min(), current.index.get_level_values(1).min())
+        end = min(previous.index.get_level_values(1).max(), current.index.get_level_values(1).max())
+        sides = []
+        for centers in (previous, current):
+            log_time = centers.index.get_level_values(1)
+            sides.append(centers[(log_time >= start) & (log_time <= end) & (centers > 0)])
+        if len(sides[0]) == 0 or len(sides[1]) == 0:
+            return {}
+
+        # Lay both sides out as normalized, sparse (clusters x intervals) matrices over the same intervals.
+        columns, intervals = pd.factorize(sides[0].index.get_level_values(1).append(sides[1].index.get_level_values(1)))
+        matrices, cluster_ids = [], []
+        for centers, centers_columns in zip(sides, np.split(columns, [len(sides[0])])):
+            rows, ids = pd.factorize(centers.index.get_level_values(0))
+            values = centers.to_numpy(dtype=np.float64)
+            norms = np.sqrt(np.bincount(rows, weights=values**2))
+            matrices.append(
+                scipy.sparse.csr_matrix(
+                    (values / norms[rows], (rows, centers_columns)), shape=(len(ids), len(intervals))
+                )
+            )
+            cluster_ids.append(ids.to_numpy())
+        similarity = (matrices[0] @ matrices[1].T).toarray()
+
+        matches = {}
+        matched_previous = set()
+        candidates = np.argwhere(similarity > rho)
+        order = np.argsort(-similarity[candidates[:, 0], candidates[:, 1]], kind="stable")
+        for previous_row, current_row in candidates[order]:
+            previous_cluster, current_cluster = cluster_ids[0][previous_row], cluster_ids[1][current_row]
+            if current_cluster in matches or previous_cluster in matched_previous:
+                continue
+            matches[current_cluster] = previous_cluster
+            matched_previous.add(previous_cluster)
+        return matches
+
+    def commit(self, assignment_df, centers, rho=0.8):
+        """
+        Store a new clustering as the next version, renumbering its clusters to match the latest version.
+
+        Parameters
+        ----------
+        assignment_df : pd.DataFrame
+            The cluster of every query template, indexed by query template, e.g., Clusterer.assignment_df.
+        centers : pd.Series
+            The count of each cluster per interval, indexed by (cluster, log_time_s), e.g., from
+            Clusterer.get_centers().
+        rho : float
+            Cosine similarity threshold for a cluster to keep the id of a previous cluster.
+
+        Returns
+        -------
+        assignment_df : pd.DataFrame
+            The committed assignments, with stable cluster ids.
+        """
+        if self.latest_version is None:
+            previous_assignments = pd.Series(
+                dtype=np.int64, index=pd.Index([], dtype=object, name="query_template"), name="cluster"
+            )
+            previous_centers = pd.Series(dtype=np.int64)
+        else:
+            previous_assignments = self.get_assignment_df()["cluster"]
+            previous_centers = self.get_centers()
+
+        matches = self._match_clusters(previous_centers, centers, rho)
+        relabel = {-1: -1}
+        for cluster in np.unique(assignment_df["cluster"]):
+            if cluster == -1:
+                continue
+            if cluster in matches:
+                relabel[cluster] = matches[cluster]
+            else:
+                relabel[cluster] = self.next_cluster
+                self.next_cluster += 1
+        assignment_df = assignment_df.assign(cluster=assignment_df["cluster"].map(relabel).astype(np.int64))
+        cluster_codes = centers.index.get_level_values(0).map(relabel)
+        centers = centers.set_axis(
+            pd.MultiIndex.from_arrays(
+                [cluster_codes.astype(np.int64), centers.index.get_level_values(1)], names=["cluster", "log_time_s"]
+            )
+        ).rename("count")
+
+        deltas, changed_clusters = self._diff_assignments(previous_assignments, assignment_df["cluster"])
+
+        # Write the version's files before the manifest, which is what makes the version visible to readers.
+        version = 1 if self.latest_version is None else self.latest_version + 1
+        version_path = self._version_path(version)
+        version_path.mkdir(parents=True, exist_ok=True)
+        assignment_df.to_parquet(version_path / "assignments.parquet")
+        deltas.to_parquet(version_path / "deltas.parquet")
+        centers.to_frame().to_parquet(version_path / "centers.parquet")
+        self.versions.append(
+            {
+                "version": version,
+                "committed": pd.Timestamp.now(tz="UTC").isoformat(),
+                "changed_clusters": changed_clusters,
+            }
+        )
+        with _atomic_write(self.store_path / self.FILENAME) as tmp_path, open(tmp_path, "w") as manifest_file:
+            json.dump({"versions": self.versions, "next_cluster": self.next_cluster}, manifest_file, indent=2)
+        print(
+            f"Committed assignment version {version}: {len(matches)} clusters kept their ids, "
+            f"{len(relabel) - 1 - len(matches)} are new, {len(deltas)} templates changed clusters."
         )
+        return assignment_df
 
 
 class ClustererCLI(cli.Application):
     preprocessor_parquet = cli.SwitchAttr("--preprocessor-parquet", str, mandatory=True)
     output_parquet = cli.SwitchAttr("--output-parquet", str, mandatory=True)
+    offline_engine = cli.SwitchAttr(
+        "--offline-engine",
+        cli.Set(*Clusterer.OFFLINE_ENGINES),
+        default="dbscan",
+        help="The offline clustering algorithm. "
+        "leader scales to many more templates than dbscan, at the cost of not chaining similar templates.",
+    )
+    seed = cli.SwitchAttr("--seed", int, default=15721, help="The seed for sampling intervals.")
+
+    online = cli.Flag(
+        "--online",
+        help="Keep running, and cluster the preprocessor's Parquet dataset online as new parts are added to it "
+        f"(e.g., by preprocessor.py --incremental), following its {LogManifest.FILENAME}. "
+        "The output Parquet is replaced with the current assignments every time new intervals are clustered.",
+    )
+    lookback = cli.SwitchAttr(
+        "--lookback",
+        pd.Timedelta,
+        default=pd.Timedelta(seconds=10),
+        help="With --online, the sliding window that template similarities are measured over.",
+    )
+    poll_interval = cli.SwitchAttr(
+        "--poll-interval", float, default=1.0, help="With --online, how many seconds to wait for new parts."
+    )
+    idle_timeout = cli.SwitchAttr(
+        "--idle-timeout",
+        float,
+        default=None,
+        help="With --online, stop after this many seconds without new parts. Default: run forever.",
+    )
+    output_events = cli.SwitchAttr(
+        "--output-events",
+        str,
+        default=None,
+        help="With --online, if specified, a directory to append the assignment changes to as Parquet parts.",
+    )
+    assignment_store = cli.SwitchAttr(
+        "--assignment-store",
+        str,
+        default=None,
+        help="If specified, a directory to commit the assignments to as a new version, keeping cluster ids "
+        "stable across runs by matching clusters to the previous version's. Ignored with --online.",
+    )
 
-    def main(self):
-        print(f"Loading preprocessor data from {self.preprocessor_parquet}.")
-        preprocessor = Preprocessor(parquet_path=self.preprocessor_parquet)
+    @staticmethod
+    def _publish(assignment_df, output_parquet):
+        """
+        Replace the output assignments, such that readers never see a partially written file.
+        """
+        with _atomic_write(output_parquet) as tmp_path:
+            assignment_df.to_parquet(tmp_path)
+
+    def _main_online(self, cluster_interval):
+        """
+        Cluster the dataset's parts as they are committed to its manifest, until idle_timeout expires.
+        """
+        dataset_path = Path(self.preprocessor_parquet)
+        if self.output_events is not None:
+            Path(self.output_events).mkdir(parents=True, exist_ok=True)
+
+        dataset, online, counter = None, None, None
+        next_part = 0
+        n_published = 0
+        last_activity = time.monotonic()
+        while True:
+            manifest = LogManifest.load(dataset_path)
+            if dataset != (manifest.created, manifest.format_version) or manifest.next_part < next_part:
+                if next_part > 0:
+                    print(f"{dataset_path} was rebuilt, clustering it again from its first part.")
+                dataset = (manifest.created, manifest.format_version)
+                online = OnlineClusterer(window=max(1, int(self.lookback / cluster_interval)), seed=self.seed)
+                # Gaps longer than the window leave every ring buffer empty, so clustering them changes nothing.
+                counter = IntervalCounter(cluster_interval, max_gap=online.window)
+                next_part = 0
+            if manifest.next_part <= next_part:
+                if self.idle_timeout is not None and time.monotonic() - last_activity > self.idle_timeout:
+                    break
+                time.sleep(self.poll_interval)
+                continue
+
+            n_intervals = online.n_intervals
+            for part in range(next_part, manifest.next_part):
+                df = Preprocessor.read_dataset_part(dataset_path, LogManifest.part_name(part), ["query_template"])
+                for log_time, counts in counter.add(df):
+                    online.update(counts, log_time)
+            next_part = manifest.next_part
+            last_activity = time.monotonic()
+
+            self._publish(online.get_assignment_df(), self.output_parquet)
+            events = online.drain_events()
+            if self.output_events is not None and len(events) > 0:
+                events.to_parquet(Path(self.output_events) / f"{LogManifest.part_name(n_published)}.parquet")
+            n_published += 1
+            print(
+                f"Clustered {online.n_intervals - n_intervals} intervals up to part {next_part - 1}: "
+                f"{online.num_clusters} clusters, {len(events)} assignment changes."
+            )
+        if counter.late_entries > 0:
+            print(f"WARNING: dropped {counter.late_entries} log entries that arrived after their interval.")
+        print("Done!")
 
+    def main(self):
         # TODO(Mike): This should not be hardcoded, since many components
         # of the forecaster depend on this. Should be a shared constant somewhere.
         cluster_interval = pd.Timedelta(milliseconds=250)
+        if self.online:
+            print(f"Clustering {self.preprocessor_parquet} online.")
+            self._main_online(cluster_interval)
+            return
+
+        print(f"Loading preprocessor data from {self.preprocessor_parquet}.")
+        # Clustering only needs per-interval template counts, so skip loading the query parameters.
+        preprocessor = Preprocessor(parquet_path=self.preprocessor_parquet, columns=["query_template"])
         df = preprocessor.get_grouped_dataframe_interval(cluster_interval)
         df.index.rename(["query_template", "log_time_s"], inplace=1)
         print("Clustering query templates.")
-        clusterer = Clusterer(df, cluster_interval=cluster_interval)
+        clusterer = Clusterer(df, cluster_interval=cluster_interval, offline_engine=self.offline_engine, seed=self.seed)
         print("Generating cluster assignments.")
-        clusterer.assignment_df.to_parquet(self.output_parquet)
+        assignment_df = clusterer.assignment_df
+        if self.assignment_store is not None:
+            store = AssignmentStore(self.assignment_store)
+            assignment_df = store.commit(assignment_df, clusterer.get_centers(), rho=clusterer.rho)
+        assignment_df.to_parquet(self.output_parquet)
         print("Done!")
 
 
@@ -0,0 +1,325 @@
+import contextlib
+import itertools
+import multiprocessing
+import os
+import resource
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from clusterer import Clusterer, OnlineClusterer
+from plumbum import cli
+from sklearn.metrics import adjusted_rand_score
+
+# periodic: a sine wave with a random period and phase.
+# bursty: a low base rate with short, large bursts.
+# trending: a rate that ramps linearly up or down over the workload.
+PATTERNS = ["periodic", "bursty", "trending"]
+
+
+def synthesize_patterns(kinds, n, rng):
+    """
+    Generate arrival rate patterns.
+
+    Parameters
+    ----------
+    kinds : List[str]
+        The kind of every pattern, from PATTERNS.
+    n : int
+        The number of intervals.
+    rng : np.random.Generator
+
+    Returns
+    -------
+    patterns : np.ndarray
+        A (patterns x intervals) matrix of non-negative arrival rates.
+    """
+    t = np.arange(n)
+    patterns = np.empty((len(kinds), n))
+    for i, kind in enumerate(kinds):
+        if kind == "periodic":
+            period, phase = rng.uniform(n / 20, n / 2), rng.uniform(0, 2 * np.pi)
+            patterns[i] = 1 + np.sin(2 * np.pi * t / period + phase)
+        elif kind == "bursty":
+            # Bursts last a few intervals, so that neighboring intervals are correlated.
+            starts = rng.random(n) < 0.01
+            bursts = np.convolve(starts, np.ones(5), mode="same") > 0
+            patterns[i] = 0.2 + 5 * bursts
+        elif kind == "trending":
+            start, end = rng.uniform(0.1, 2, size=2)
+            patterns[i] = start + (end - start) * t / max(n - 1, 1)
+        else:
+            raise ValueError(f"Unknown pattern: {kind}")
+    return patterns
+
+
+def synthesize_workload(n_templates, n_groups, duration, interval, patterns=PATTERNS, seed=15721, chunk_size=1000):
+    """
+    Generate the per-interval counts of query templates whose arrival rates follow a few known patterns.
+
+    Every group of templates shares an arrival pattern, and the groups cycle through the given kinds of
+    patterns. Each template scales its group's pattern by its own volume, and its counts are Poisson samples
+    of the scaled pattern.
+
+    Parameters
+    ----------
+    n_templates : int
+        The number of query templates.
+    n_groups : int
+        The number of arrival patterns, which are the true clusters.
+    duration : pd.Timedelta
+        The length of the workload.
+    interval : pd.Timedelta
+        The interval that counts are grouped by.
+    patterns : List[str]
+        The kinds of arrival patterns, from PATTERNS.
+    seed : int
+        The seed of the random number generator.
+    chunk_size : int
+        The number of templates to generate counts for at a time.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Non-zero counts indexed by (query_template, log_time_s), as expected by Clusterer.
+    truth : pd.Series
+        The group of every query template.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration / interval)
+    group_patterns = synthesize_patterns([patterns[group % len(patterns)] for group in range(n_groups)], n, rng)
+
+    groups = rng.integers(0, n_groups, size=n_templates)
+    volumes = rng.lognormal(mean=2, sigma=1, size=n_templates)
+    templates = np.array([f"SELECT * FROM t{group} WHERE c{i} = $1" for i, group in enumerate(groups)], dtype=object)
+
+    rows, cols, counts = [], [], []
+    for chunk_start in range(0, n_templates, chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        chunk_counts = rng.poisson(group_patterns[groups[chunk]] * volumes[chunk, np.newaxis])
+        chunk_rows, chunk_cols = np.nonzero(chunk_counts)
+        rows.append(chunk_rows + chunk_start)
+        cols.append(chunk_cols)
+        counts.append(chunk_counts[chunk_rows, chunk_cols])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+    start_time = pd.Timestamp("2022-01-01", tz="UTC")
+    # Building the index from codes avoids materializing a template string and a timestamp for every count.
+    index = pd.MultiIndex(
+        levels=[pd.Index(templates), start_time + np.arange(n) * interval],
+        codes=[rows, cols],
+        names=["query_template", "log_time_s"],
+    )
+    df = pd.DataFrame({"count": np.concatenate(counts)}, index=index)
+    return df, pd.Series(groups, index=pd.Index(templates, name="query_template"))
+
+
+class PhaseTimer:
+    """
+    A clock for Clusterer and OnlineClusterer that adds up the time spent in each phase.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.reset()
+
+    def reset(self):
+        """
+        Start timing the next phase from now, e.g., to leave out the caller's own work.
+        """
+        self._start = time.perf_counter()
+
+    def __call__(self, label):
+        end = time.perf_counter()
+        self.seconds[label] += end - self._start
+        self._start = end
+
+
+def run_offline(df, config, timer):
+    clusterer = Clusterer(
+        df,
+        n_samples=config["n_samples"],
+        rho=config["rho"],
+        cluster_interval=config["interval"],
+        offline_engine=config["engine"],
+        seed=config["seed"],
+        clock=timer,
+    )
+    return clusterer.assignment_df["cluster"]
+
+
+def count_columns(df):
+    """
+    Lay the workload out as a (templates x intervals) CSC matrix, whose columns are cheap to slice.
+    """
+    index = df.index.remove_unused_levels()
+    counts = scipy.sparse.csc_matrix(
+        (df["count"].to_numpy(), (index.codes[0], index.codes[1])), shape=(len(index.levels[0]), len(index.levels[1]))
+    )
+    return counts, index.levels[0], index.levels[1]
+
+
+def run_online(columns, config, timer):
+    """
+    Replay the workload's count_columns through an OnlineClusterer, one interval at a time.
+    """
+    counts, templates, intervals = columns
+    online = OnlineClusterer(
+        rho=config["rho"],
+        window=max(1, int(config["lookback"] / config["interval"])),
+        n_samples=config["n_samples"],
+        seed=config["seed"],
+        clock=timer,
+    )
+    online.add_templates(list(templates))
+    # Every new cluster is logged, which is not part of the work being measured.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for current, log_time in enumerate(intervals):
+            column = counts[:, current].toarray().ravel()
+            timer.reset()
+            online.update(column, log_time)
+    return online.get_assignment_df()["cluster"]
+
+
+def run_config(config):
+    """
+    Generate a workload and cluster it, reporting the time, memory, and quality of the clustering.
+
+    This is meant to run in its own process, so that the peak RSS is that of a single configuration.
+    """
+    df, truth = synthesize_workload(
+        config["n_templates"],
+        config["n_groups"],
+        config["duration"],
+        config["interval"],
+        patterns=config["patterns"],
+        seed=config["seed"],
+    )
+    n_counts = len(df)
+    if config["engine"] == "online":
+        # The online engine is fed one interval at a time, instead of the whole dataframe.
+        columns = count_columns(df)
+        del df
+    # ru_maxrss is a high-water mark in KiB on Linux, so it includes generating the workload.
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    timer = PhaseTimer()
+    start = time.perf_counter()
+    if config["engine"] == "online":
+        labels = run_online(columns, config, timer)
+    else:
+        labels = run_offline(df, config, timer)
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    # Templates that were never assigned are each their own cluster.
+    labels = labels.reindex(truth.index)
+    unassigned = labels.isna()
+    labels[unassigned] = -1 - np.arange(unassigned.sum())
+    result = {
+        "engine": config["engine"],
+        "templates": config["n_templates"],
+        "intervals": int(config["duration"] / config["interval"]),
+        "counts": n_counts,
+        "samples": config["n_samples"],
+        "rho": config["rho"],
+        "seconds": elapsed,
+        "peak_rss_mib": peak_rss,
+        "rss_increase_mib": peak_rss - baseline_rss,
+        "clusters": labels[~unassigned].nunique(),
+        "unassigned": int(unassigned.sum()),
+        "ari_truth": adjusted_rand_score(truth, labels),
+    }
+    result.update({f"{phase} (s)": seconds for phase, seconds in timer.seconds.items()})
+    return result, labels
+
+
+class ClustererBenchmarkCLI(cli.Application):
+    """
+    Measure how the clustering engines scale on synthetic workloads with known clusters.
+
+    Every combination of the comma-separated sizes and parameters is run with every engine, each in its own
+    process. The wall time, peak RSS, and time per phase of each run are reported. Quality is reported as the
+    adjusted Rand index (ARI) against the true clusters, and against the clusters of the first engine on the
+    same workload.
+    """
+
+    n_templates = cli.SwitchAttr("--templates", str, default="5000", help="The numbers of query templates.")
+    n_groups = cli.SwitchAttr("--groups", int, default=20, help="The number of true clusters.")
+    durations = cli.SwitchAttr("--duration", str, default="30min", help="The lengths of the workload.")
+    interval = cli.SwitchAttr(
+        "--interval", pd.Timedelta, default=pd.Timedelta(seconds=1), help="The clustering interval."
+    )
+    patterns = cli.SwitchAttr(
+        "--patterns",
+        str,
+        default=",".join(PATTERNS),
+        help=f"The kinds of arrival patterns that the true clusters cycle through, from {', '.join(PATTERNS)}.",
+    )
+    n_samples = cli.SwitchAttr("--samples", str, default="10000", help="The numbers of intervals to sample.")
+    rhos = cli.SwitchAttr("--rho", str, default="0.8", help="The cosine similarity thresholds.")
+    engines = cli.SwitchAttr(
+        "--engines",
+        str,
+        default=",".join(Clusterer.OFFLINE_ENGINES),
+        help="The engines to compare: offline engines, or online. The first engine is the reference.",
+    )
+    lookback = cli.SwitchAttr(
+        "--lookback",
+        pd.Timedelta,
+        default=pd.Timedelta(seconds=10),
+        help="For the online engine, the sliding window that similarities are measured over.",
+    )
+    seed = cli.SwitchAttr("--seed", int, default=15721, help="The seed for the workload and for sampling.")
+    output_csv = cli.SwitchAttr("--output-csv", str, default=None, help="If specified, write the results here.")
+
+    def main(self):
+        engines = self.engines.split(",")
+        for engine in engines:
+            assert engine in Clusterer.OFFLINE_ENGINES + ["online"], f"Unknown engine: {engine}"
+
+        results = []
+        # A fresh process per run keeps one run's memory from counting towards the next one's peak RSS.
+        context = multiprocessing.get_context("spawn")
+        for n_templates, duration, n_samples, rho in itertools.product(
+            [int(n) for n in self.n_templates.split(",")],
+            [pd.Timedelta(duration) for duration in self.durations.split(",")],
+            [int(n) for n in self.n_samples.split(",")],
+            [float(rho) for rho in self.rhos.split(",")],
+        ):
+            print(f"{n_templates} templates over {duration}, {n_samples} samples, rho {rho}:")
+            reference = None
+            for engine in engines:
+                config = {
+                    "engine": engine,
+                    "n_templates": n_templates,
+                    "n_groups": self.n_groups,
+                    "duration": duration,
+                    "interval": self.interval,
+                    "patterns": self.patterns.split(","),
+                    "n_samples": n_samples,
+                    "rho": rho,
+                    "lookback": self.lookback,
+                    "seed": self.seed,
+                }
+                with context.Pool(1) as pool:
+                    result, labels = pool.apply(run_config, (config,))
+                if reference is None:
+                    reference = labels
+                result["ari_reference"] = adjusted_rand_score(reference, labels)
+                results.append(result)
+                print(f"    {engine}: {result['seconds']:.2f} s, {result['peak_rss_mib']:.0f} MiB peak RSS.")
+
+        results = pd.DataFrame(results)
+        # Engines have different phases, so the phase columns go last.
+        phases = [column for column in results.columns if column.endswith(" (s)")]
+        results = results[[column for column in results.columns if column not in phases] + phases]
+        print(results.to_string(index=False))
+        if self.output_csv is not None:
+            results.to_csv(self.output_csv, index=False)
+
+
+if __name__ == "__main__":
+    ClustererBenchmarkCLI.run()
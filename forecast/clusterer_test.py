@@ -0,0 +1,420 @@
+import contextlib
+import copy
+import io
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from clusterer import (
+    AssignmentStore,
+    Clusterer,
+    ClustererCLI,
+    IntervalCounter,
+    OnlineClusterer,
+    StratifiedSampler,
+)
+from preprocessor import LogManifest, Preprocessor
+from preprocessor_test import run_preprocessor, write_csvlog
+
+
+class TestIntervalCounter(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self._tmp.name)
+        (self.tmp_path / "logs").mkdir()
+        write_csvlog(self.tmp_path / "logs" / "postgresql-0.csv", 6000)
+        self.dataset_path = self.tmp_path / "preprocessed.parquet"
+        run_preprocessor(
+            "--query-log-folder",
+            str(self.tmp_path / "logs"),
+            "--output-parquet",
+            str(self.dataset_path),
+            "--incremental",
+            "--output-format",
+            "dictionary",
+            "--read-chunk-size",
+            "1000",
+        )
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_matches_offline_grouping(self):
+        interval = pd.Timedelta(milliseconds=250)
+        counter = IntervalCounter(interval)
+        rows = []
+        manifest = LogManifest.load(self.dataset_path)
+        self.assertGreater(manifest.next_part, 1)
+        for part in range(manifest.next_part):
+            df = Preprocessor.read_dataset_part(self.dataset_path, LogManifest.part_name(part), ["query_template"])
+            for log_time, counts in counter.add(df):
+                rows.extend((template, log_time, count) for template, count in counts.items())
+        actual = pd.DataFrame(rows, columns=["query_template", "log_time", "count"])
+        self.assertEqual(counter.late_entries, 0)
+
+        preprocessor = Preprocessor(parquet_path=self.dataset_path)
+        preprocessor._count_cube = None
+        expected = preprocessor.get_grouped_dataframe_interval(interval).reset_index()
+        expected["query_template"] = expected["query_template"].astype(str)
+        # The offline grouping fills in empty intervals, and the counter holds back the latest interval.
+        expected = expected[(expected["count"] > 0) & (expected["log_time"] < expected["log_time"].max())]
+
+        self.assertEqual(actual["log_time"].min().year, 2022)
+        self.assertEqual(set(actual["query_template"]), set(expected["query_template"]))
+        for frame in [actual, expected]:
+            frame["log_time"] = frame["log_time"].dt.as_unit("ns")
+            frame["count"] = frame["count"].astype(np.int64)
+            frame.sort_values(["query_template", "log_time"], inplace=True, ignore_index=True)
+        pd.testing.assert_frame_equal(actual, expected[actual.columns].reset_index(drop=True))
+
+
+def make_count_df(counts):
+    """
+    Lay a (templates x intervals) count array out as the per-second counts that Clusterer expects.
+    Templates are named such that they sort in the order of their rows.
+    """
+    counts = np.asarray(counts)
+    templates = [f"SELECT {i:04d}" for i in range(len(counts))]
+    rows, cols = np.nonzero(counts)
+    index = pd.MultiIndex.from_arrays(
+        [
+            np.array(templates, dtype=object)[rows],
+            pd.Timestamp("2022-01-01", tz="UTC") + pd.to_timedelta(cols, unit="s"),
+        ],
+        names=["query_template", "log_time_s"],
+    )
+    return pd.DataFrame({"count": counts[rows, cols]}, index=index)
+
+
+class TestOfflineLeader(unittest.TestCase):
+    # A is the busiest and leads. B is within 0.8 of both A and C, but A and C are orthogonal, as is D.
+    COUNTS = [[9, 0, 0, 0], [2, 2, 0, 0], [0, 1, 0, 0], [0, 0, 0, 3]]
+
+    def cluster(self, counts, rho, offline_engine="leader"):
+        clusterer = Clusterer(make_count_df(counts), rho=rho, offline_engine=offline_engine)
+        return clusterer, clusterer.assignment_df["cluster"].sort_index().to_numpy()
+
+    def test_threshold(self):
+        # cos(A, B) = cos(B, C) = 0.707. Leaders are numbered from the busiest, so D leads before C.
+        _, labels = self.cluster(self.COUNTS, rho=0.7)
+        np.testing.assert_array_equal(labels, [0, 0, 2, 1])
+        _, labels = self.cluster(self.COUNTS, rho=0.71)
+        np.testing.assert_array_equal(labels, [0, 1, 3, 2])
+
+    def test_not_chained(self):
+        # DBSCAN chains C to A through B, but C is not similar to A, which leads the cluster that B joins.
+        _, labels = self.cluster(self.COUNTS, rho=0.7, offline_engine="dbscan")
+        np.testing.assert_array_equal(labels, [0, 0, 0, 1])
+
+    def test_batches(self):
+        clusterer, labels = self.cluster(self.COUNTS, rho=0.7)
+        offsets = np.arange(clusterer.n)
+        for batch_size in [1, 2, 3]:
+            with self.subTest(batch_size=batch_size):
+                batch_labels = clusterer._cluster_offline_leader(offsets, batch_size=batch_size)
+                np.testing.assert_array_equal(batch_labels[np.argsort(clusterer._get_queries())], labels)
+
+    def test_matches_dbscan(self):
+        # Groups of templates that take turns being active are separable, so both engines find the same groups.
+        rng = np.random.default_rng(15721)
+        phases = np.arange(600) // 10 % 3
+        groups = rng.integers(0, 3, size=30)
+        counts = rng.poisson(rng.uniform(20, 50, size=(30, 1)) * (phases == groups[:, np.newaxis]))
+        _, leader = self.cluster(counts, rho=0.8)
+        _, dbscan = self.cluster(counts, rho=0.8, offline_engine="dbscan")
+        self.assertEqual(len(set(leader)), 3)
+        self.assertEqual(pd.crosstab(leader, dbscan).astype(bool).sum().tolist(), [1, 1, 1])
+        self.assertEqual(pd.crosstab(leader, groups).astype(bool).sum().tolist(), [1, 1, 1])
+
+
+class TestStratifiedSampler(unittest.TestCase):
+    def test_seeded(self):
+        samplers = [StratifiedSampler(10, seed=15721) for _ in range(2)]
+        for start, end in [(0, 1000), (5, 28), (100, 111)]:
+            np.testing.assert_array_equal(samplers[0].sample(start, end), samplers[1].sample(start, end))
+        self.assertFalse(np.array_equal(StratifiedSampler(10, seed=1).sample(0, 1000), samplers[0].sample(0, 1000)))
+
+    def test_strata(self):
+        sampler = StratifiedSampler(10)
+        # Ranges just wider than n_samples have strata of a single column, which must all be sampled.
+        for start, end in [(0, 1000), (5, 28), (100, 111), (0, 19)]:
+            with self.subTest(start=start, end=end):
+                edges = start + np.arange(11) * (end - start) // 10
+                for _ in range(100):
+                    offsets = sampler.sample(start, end)
+                    self.assertEqual(len(offsets), 10)
+                    self.assertTrue(((offsets >= edges[:-1]) & (offsets < edges[1:])).all())
+
+    def test_narrow_range(self):
+        sampler = StratifiedSampler(10)
+        np.testing.assert_array_equal(sampler.sample(3, 13), np.arange(3, 13))
+        np.testing.assert_array_equal(sampler.sample(3, 5), [3, 4])
+        self.assertEqual(len(sampler.sample(3, 3)), 0)
+
+
+class TestOnlineClusterer(unittest.TestCase):
+    def test_groups(self):
+        # Three groups of templates that take turns being active, so that only templates in a group are similar.
+        rng = np.random.default_rng(15721)
+        n_intervals = 400
+        phases = np.arange(n_intervals) // 10 % 3
+        groups = np.tile([0, 1, 2], 4)
+        templates = [f"SELECT * FROM t{group} WHERE c{i} = $1" for i, group in enumerate(groups)]
+        counts = rng.poisson(10 * (phases[np.newaxis, :] == groups[:, np.newaxis]))
+        log_times = pd.date_range("2022-01-01", periods=n_intervals, freq="s", tz="UTC")
+
+        online = OnlineClusterer(window=40)
+        events = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for current, log_time in enumerate(log_times):
+                # Templates are only registered once they are first seen.
+                active = counts[:, current] > 0
+                online.update(pd.Series(counts[active, current], index=np.array(templates)[active]), log_time)
+                events.append(online.drain_events())
+        assignment_df = online.get_assignment_df()
+
+        self.assertEqual(online.num_clusters, 3)
+        self.assertEqual(online._template_windows.shape, (len(templates), 40))
+        self.assertEqual(sorted(assignment_df.index), sorted(templates))
+        clusters = assignment_df["cluster"].reindex(templates).to_numpy()
+        for group in range(3):
+            self.assertEqual(len(set(clusters[groups == group])), 1)
+        self.assertEqual(len(set(clusters)), 3)
+
+        # Replaying the drained events ends up at the current assignments.
+        events = pd.concat(events)
+        self.assertEqual(events["log_time_s"].min().year, 2022)
+        replayed = events.groupby("query_template")["cluster"].last()
+        pd.testing.assert_series_equal(replayed.reindex(templates), assignment_df["cluster"].reindex(templates))
+
+    @staticmethod
+    def assign_per_template(online, current, slots):
+        """
+        Assign templates one at a time, by the same rules as OnlineClusterer._assign_templates.
+        """
+        windows = online._template_windows[:, slots]
+        clusters = sorted(online._center_rows)
+        centers = {cluster: online._center_windows[online._center_rows[cluster]][slots] for cluster in clusters}
+        labels = online._labels.copy()
+        idle = ~windows.any(axis=1)
+
+        def stays(template_id):
+            cluster = labels[template_id]
+            similarity = Clusterer._similarity(windows[template_id], centers[cluster])
+            return online.cluster_sizes[cluster] == 1 or similarity > online.rho or idle[template_id]
+
+        leaving = [template_id for template_id in range(len(labels)) if labels[template_id] >= 0]
+        leaving = [template_id for template_id in leaving if not stays(template_id)]
+        for cluster in clusters:
+            members = [template_id for template_id in leaving if labels[template_id] == cluster]
+            if len(members) == online.cluster_sizes[cluster]:
+                leaving.remove(members[0])
+        labels[leaving] = -1
+
+        next_cluster, leaders = online.next_cluster, []
+        for template_id in range(len(labels)):
+            active = online._labels[template_id] >= 0 or (
+                current > online._first_arrival[template_id] and not idle[template_id]
+            )
+            if labels[template_id] >= 0 or not active:
+                continue
+            similarities = [Clusterer._similarity(windows[template_id], centers[cluster]) for cluster in clusters]
+            if len(clusters) > 0 and max(similarities) > online.rho:
+                labels[template_id] = clusters[int(np.argmax(similarities))]
+                continue
+            similarities = [Clusterer._similarity(windows[leader], windows[template_id]) for leader in leaders]
+            if len(leaders) > 0 and max(similarities) > online.rho:
+                labels[template_id] = labels[leaders[int(np.argmax(similarities))]]
+                continue
+            labels[template_id] = next_cluster
+            next_cluster += 1
+            leaders.append(template_id)
+        return labels
+
+    def test_batched_assignment(self):
+        rng = np.random.default_rng(15721)
+        n_templates, window, current = 60, 12, 30
+        patterns = rng.poisson(5, size=(4, window))
+        online = OnlineClusterer(window=window)
+        online.add_templates([f"SELECT {i}" for i in range(n_templates)])
+        # Templates follow noisy copies of a few patterns, and some of them are idle.
+        online._template_windows[:] = rng.poisson(patterns[rng.integers(0, 4, size=n_templates)])
+        online._template_windows[rng.random(n_templates) < 0.1] = 0
+        online._first_arrival[:] = rng.choice([0, current, current + 1], size=n_templates)
+        # Templates are assigned to clusters at random, so that many of them are dissimilar to their cluster.
+        clusters = [online._new_cluster() for _ in range(6)]
+        for template_id in np.flatnonzero(rng.random(n_templates) < 0.6):
+            online._labels[template_id] = rng.choice(clusters)
+            online._move_templates(np.array([template_id]), online._labels[[template_id]], sign=1)
+        online._first_arrival[online._labels >= 0] = 0
+
+        for slots in [np.arange(window), np.array([0, 3, 4, 9])]:
+            with self.subTest(slots=slots):
+                batched = copy.deepcopy(online)
+                expected = self.assign_per_template(batched, current, slots)
+                self.assertGreater((expected != online._labels).sum(), 0)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    batched._assign_templates(current, slots, pd.Timestamp("2022-01-01", tz="UTC"))
+                np.testing.assert_array_equal(batched._labels, expected)
+
+                # The centers and sizes follow the templates that moved.
+                for cluster, row in batched._center_rows.items():
+                    members = batched._labels == cluster
+                    self.assertEqual(batched.cluster_sizes[cluster], members.sum())
+                    np.testing.assert_array_equal(
+                        batched._center_windows[row], batched._template_windows[members].sum(axis=0)
+                    )
+                moved = np.flatnonzero(batched._labels != online._labels)
+                self.assertEqual(sorted(batched.drain_events()["query_template"]), sorted(f"SELECT {i}" for i in moved))
+
+    def test_converging_clusters_merge(self):
+        online = OnlineClusterer(window=4)
+        log_times = pd.date_range("2022-01-01", periods=8, freq="s", tz="UTC")
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Two templates that alternate are not similar, so each gets a cluster of its own.
+            for current in range(4):
+                online.update(pd.Series([5, 0] if current % 2 == 0 else [0, 5], index=["a", "b"]), log_times[current])
+            self.assertEqual(online.num_clusters, 2)
+            clusters = online.get_assignment_df()["cluster"]
+            online.drain_events()
+            # Once both arrive together for a whole window, their centers are the same.
+            for current in range(4, 8):
+                online.update(pd.Series([5, 5], index=["a", "b"]), log_times[current])
+        self.assertEqual(online.num_clusters, 1)
+        self.assertEqual(online.get_assignment_df()["cluster"].nunique(), 1)
+        events = online.drain_events()
+        self.assertEqual(len(events), 1)
+        self.assertIn(events["cluster"].iloc[0], clusters.tolist())
+
+    def test_transitive_merges(self):
+        online = OnlineClusterer(window=4)
+        online.add_templates(["a", "b", "c", "d"])
+        online._template_windows[:] = [[1, 0, 0, 0], [1, 0, 0, 0], [2, 0, 0, 0], [0, 0, 0, 1]]
+        for template_id in range(4):
+            online._labels[template_id] = online._new_cluster()
+            online._move_templates(np.array([template_id]), online._labels[[template_id]], sign=1)
+
+        # Cluster 0 merges into its nearest cluster 1. Cluster 2's nearest is cluster 0, whose root is now 1.
+        log_time = pd.Timestamp("2022-01-01", tz="UTC")
+        with contextlib.redirect_stdout(io.StringIO()):
+            online._merge_clusters(np.arange(4), log_time)
+        self.assertEqual(online.get_assignment_df()["cluster"].tolist(), [1, 1, 1, 3])
+        self.assertEqual(online.cluster_sizes, {1: 3, 3: 1})
+        np.testing.assert_array_equal(online._center_windows[online._center_rows[1]], [4, 0, 0, 0])
+        self.assertEqual(
+            sorted(online._free_rows),
+            sorted(set(range(len(online._center_windows))) - set(online._center_rows.values())),
+        )
+
+        events = online.drain_events()
+        self.assertEqual(events["query_template"].tolist(), ["a", "c"])
+        self.assertEqual(events["cluster"].tolist(), [1, 1])
+        self.assertTrue((events["log_time_s"] == log_time).all())
+
+
+class TestClustererCLIOnline(unittest.TestCase):
+    def test_rebuilt_dataset(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            tmp_path = Path(tmp_path)
+            (tmp_path / "logs").mkdir()
+            dataset_path, output_path = tmp_path / "preprocessed.parquet", tmp_path / "assignments.parquet"
+
+            def preprocess(*args):
+                run_preprocessor(
+                    "--query-log-folder", str(tmp_path / "logs"), "--output-parquet", str(dataset_path), *args
+                )
+
+            write_csvlog(tmp_path / "logs" / "postgresql-0.csv", 3000)
+            preprocess("--incremental", "--read-chunk-size", "500")
+
+            def cluster():
+                ClustererCLI.run(
+                    [
+                        "clusterer.py",
+                        "--preprocessor-parquet",
+                        str(dataset_path),
+                        "--output-parquet",
+                        str(output_path),
+                        "--online",
+                        "--poll-interval",
+                        "0.05",
+                        "--idle-timeout",
+                        "3",
+                    ],
+                    exit=False,
+                )
+
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                thread = threading.Thread(target=cluster)
+                thread.start()
+                while not output_path.exists():
+                    time.sleep(0.05)
+                # Rebuild the dataset from other tables' logs, with more parts than the clusterer has read.
+                (tmp_path / "logs" / "postgresql-0.csv").unlink()
+                write_csvlog(tmp_path / "logs" / "postgresql-0.csv", 3000, seed=1, tables=("d", "e", "f"))
+                preprocess("--read-chunk-size", "300")
+                thread.join()
+
+            templates = pd.read_parquet(output_path).index
+            self.assertEqual(len(templates), 3)
+            self.assertTrue(all(" d " in template or " e " in template or " f " in template for template in templates))
+
+
+def make_assignments(clusters):
+    return pd.DataFrame(
+        {"cluster": np.array(list(clusters.values()), dtype=np.int64)},
+        index=pd.Index(list(clusters.keys()), name="query_template"),
+    )
+
+
+def make_centers(n_clusters, n_intervals=100):
+    # Every cluster has a distinct, dissimilar pattern, so that clusters keep their ids across versions.
+    log_times = pd.date_range("2022-01-01", periods=n_intervals, freq="s", tz="UTC")
+    index = pd.MultiIndex.from_product([range(n_clusters), log_times], names=["cluster", "log_time_s"])
+    counts = [1 + np.sin(np.arange(n_intervals) * (cluster + 1) / 7) for cluster in range(n_clusters)]
+    return pd.Series(np.concatenate(counts), index=index, name="count")
+
+
+class TestAssignmentStore(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.store_path = Path(self._tmp.name) / "clusters"
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def commit(self, clusters):
+        store = AssignmentStore(self.store_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            store.commit(make_assignments(clusters), make_centers(3))
+        return store
+
+    def test_empty(self):
+        store = AssignmentStore(self.store_path)
+        self.assertIsNone(store.latest_version)
+        self.assertEqual(store.get_changed_clusters(), [])
+        self.assertEqual(store.get_changed_clusters(since=1), [])
+
+    def test_changed_since(self):
+        self.commit({"a": 0, "b": 0, "c": 1, "d": 2})
+        self.commit({"a": 0, "b": 1, "c": 1, "d": 2})
+        store = self.commit({"a": 0, "b": 1, "c": 1, "d": 2})
+        self.assertEqual(store.latest_version, 3)
+        np.testing.assert_array_equal(store.get_assignment_df()["cluster"].to_numpy(), [0, 1, 1, 2])
+
+        # Skipping version 2 must not lose its change.
+        self.assertEqual(store.get_changed_clusters(since=1), [0, 1])
+        self.assertEqual(store.get_changed_clusters(since=2), [])
+        self.assertEqual(store.get_changed_clusters(since=3), [])
+        self.assertEqual(store.get_changed_clusters(since=1, version=2), [0, 1])
+        # Without a known version, every cluster is changed.
+        self.assertEqual(store.get_changed_clusters(), [0, 1, 2])
+        self.assertEqual(store.get_changed_clusters(since=99), [0, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
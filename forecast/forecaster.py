@@ -1,15 +1,65 @@
 import csv
 import glob
+import multiprocessing
+import os
 import re
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from model import LSTM, ForecastDataset
+import torch
+from clusterer import AssignmentStore
+from model import LSTM, ForecastDataset, ForecastModel
 from plumbum import cli
 from preprocessor import Preprocessor
 
 
+class LazyModels(MutableMapping):
+    """
+    The models of clusters, where saved models are only loaded the first time that they are used.
+
+    Loading a saved model maps its arrays from disk, so clusters that are never predicted cost nothing.
+    """
+
+    def __init__(self):
+        self._paths = {}
+        self._models = {}
+
+    def add_saved(self, cluster, path):
+        """Register the saved model of a cluster, to be loaded when it is first accessed."""
+        self._models.pop(cluster, None)
+        self._paths[cluster] = path
+
+    def __getitem__(self, cluster):
+        if cluster not in self._models:
+            path = self._paths[cluster]
+            self._models[cluster] = LSTM.load(path)
+            print(f"loaded model for cluster {cluster}")
+        return self._models[cluster]
+
+    def __setitem__(self, cluster, model):
+        self._paths.pop(cluster, None)
+        self._models[cluster] = model
+
+    def __delitem__(self, cluster):
+        if cluster not in self._models and cluster not in self._paths:
+            raise KeyError(cluster)
+        self._models.pop(cluster, None)
+        self._paths.pop(cluster, None)
+
+    def __contains__(self, cluster):
+        return cluster in self._models or cluster in self._paths
+
+    def __iter__(self):
+        yield from self._models
+        yield from (cluster for cluster in self._paths if cluster not in self._models)
+
+    def __len__(self):
+        return len(self._models) + sum(1 for cluster in self._paths if cluster not in self._models)
+
+
 class ClusterForecaster:
     """
     Predict cluster in workload using trained LSTMs.
@@ -22,8 +72,8 @@ class ClusterForecaster:
         The prediction horizon of the models to train.
     prediction_seqlen : int
         Number of intervals to feed the LSTM for a prediction.
-    models : Dict[int, LSTM]
-        Dictionary of trained models to perform inference by
+    models : LazyModels
+        Dictionary of trained models to perform inference by, loaded on first use
 
     """
 
@@ -31,16 +81,17 @@ class ClusterForecaster:
 
     @staticmethod
     def cluster_to_file(path, cluster):
-        """Generate model file path from cluster name"""
-        return f"{path}/{ClusterForecaster.MODEL_PREFIX}{cluster}.pkl"
+        """Generate model artifact path from cluster id"""
+        # Cluster ids may arrive as floats, e.g., after a join leaves NaN, but always name artifacts as integers.
+        return f"{path}/{ClusterForecaster.MODEL_PREFIX}{int(cluster)}"
 
     @staticmethod
     def get_cluster_from_file(filename):
-        """Infer cluster id from file name"""
-        m = re.search(f"(?<={ClusterForecaster.MODEL_PREFIX})[^/]*(?=\\.pkl)", filename)
+        """Infer cluster id from model artifact path, as written by cluster_to_file"""
+        m = re.search(f"(?<=/{ClusterForecaster.MODEL_PREFIX})-?[0-9]+$", "/" + filename.rstrip("/"))
         if m is None:
-            raise RuntimeError("Could not get cluster name")
-        return m[0]
+            raise RuntimeError(f"Could not get cluster id from {filename}")
+        return int(m[0])
 
     def __init__(
         self,
@@ -51,6 +102,10 @@ class ClusterForecaster:
         save_path,
         top_k=5,
         override=False,
+        assignment_store=None,
+        workers=1,
+        threads_per_worker=None,
+        incremental=False,
     ):
         """Construct the ClusterForecaster object.
         Parameters
@@ -64,25 +119,63 @@ class ClusterForecaster:
         override : bool
             Determines whether we should (re)train models anyway, even if they are
             in the directory.
+        assignment_store : AssignmentStore | None
+            If specified, the store of the cluster assignments in train_df. Saved models of clusters whose
+            membership changed since the version that the model was trained on are retrained, even if they are
+            in the directory. Trained models record the store's latest version.
+        workers : int
+            The number of processes to train cluster models in. Each model is trained by one process.
+        threads_per_worker : int | None
+            The number of threads that torch uses in each training process.
+            Default: the CPU count divided among the workers.
+        incremental : bool
+            If True, saved models of the top k clusters are fine-tuned on the data after their training cutoff,
+            instead of being skipped. Stale clusters and clusters without a saved model are trained from scratch.
+
+        Saved models that were trained with other prediction parameters are always retrained.
         """
         assert train_df.index.names[0] == "cluster"
         assert train_df.index.names[1] == "log_time_s"
+        assert not (override and incremental), "Overriding models discards the models to fine-tune."
 
         self.prediction_seqlen = prediction_seqlen
         self.prediction_interval = prediction_interval
         self.prediction_horizon = prediction_horizon
-        self.models = {}
+        self.models = LazyModels()
 
         if not override:
-            model_files = glob.glob(str(Path(save_path) / f"{self.MODEL_PREFIX}*.pkl"))
-            for filename in model_files:
-                cluster_name = self.get_cluster_from_file(filename)
-                self.models[int(cluster_name)] = LSTM.load(filename)
-                print(f"loaded model for cluster {cluster_name}")
-            print(f"Loaded {len(model_files)} models")
+            # Only artifacts with a manifest are complete; the manifest is written last.
+            manifests = glob.glob(str(Path(save_path) / f"{self.MODEL_PREFIX}*" / ForecastModel.MANIFEST_FILENAME))
+            for manifest in manifests:
+                model_path = str(Path(manifest).parent)
+                try:
+                    cluster = self.get_cluster_from_file(model_path)
+                except RuntimeError:
+                    print(f"Skipping model that is not named by an integer cluster id: {model_path}")
+                    continue
+                self.models.add_saved(cluster, model_path)
+            print(f"Found {len(self.models)} models")
 
         if train_df is None:
             return
+        assignment_version = None if assignment_store is None else assignment_store.latest_version
+        # The clusters that changed since each version that a saved model was trained on.
+        changed_since = {}
+
+        def is_stale(model, cluster):
+            if (model.horizon, model.interval, model.sequence_length) != (
+                prediction_horizon,
+                prediction_interval,
+                prediction_seqlen,
+            ):
+                return True
+            if assignment_store is None:
+                return False
+            if model.assignment_version not in changed_since:
+                changed_since[model.assignment_version] = set(
+                    assignment_store.get_changed_clusters(since=model.assignment_version)
+                )
+            return cluster in changed_since[model.assignment_version]
 
         # Only consider top k clusters.
         cluster_totals = train_df.groupby(level=0).sum().sort_values(by="count", ascending=False)
@@ -95,35 +188,124 @@ class ClusterForecaster:
 
         dtindex = pd.DatetimeIndex([mintime, maxtime])
 
+        train_counts, warm_starts = {}, set()
         for cluster in labels:
             if cluster in self.models and not override:
-                print(f"Already have model for cluster {cluster}, skipping")
-                continue
+                if is_stale(self.models[cluster], cluster):
+                    print(f"Model for cluster {cluster} is stale, retraining")
+                elif not incremental:
+                    print(f"Already have model for cluster {cluster}, skipping")
+                    continue
+                else:
+                    warm_starts.add(cluster)
 
-            print(f"training model for cluster {cluster}")
             cluster_counts = train_df[train_df.index.get_level_values(0) == cluster].droplevel(0)
 
             # This zero-fills the start and ends of the cluster time series.
             cluster_counts = cluster_counts.reindex(cluster_counts.index.append(dtindex), fill_value=0)
-            cluster_counts = cluster_counts.resample(prediction_interval).sum()
-            self._train_cluster(cluster_counts, cluster, save_path)
+            train_counts[cluster] = cluster_counts.resample(prediction_interval).sum()
+
+        model_args = (prediction_seqlen, prediction_interval, prediction_horizon, assignment_version)
+        if workers <= 1 or len(train_counts) <= 1:
+            for cluster, cluster_counts in train_counts.items():
+                self.models[cluster] = self._train_cluster(
+                    cluster_counts, cluster, save_path, *model_args, warm_start=cluster in warm_starts
+                )
+            return
+
+        # Each model is small, single-sequence tensor work, so models are trained side by side instead.
+        # Worker processes are spawned rather than forked, since forking after torch has started its thread
+        # pool can deadlock.
+        if threads_per_worker is None:
+            threads_per_worker = max(1, os.cpu_count() // workers)
+        print(f"updating {len(train_counts)} models on {workers} workers with {threads_per_worker} threads each")
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(train_counts)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=torch.set_num_threads,
+            initargs=(threads_per_worker,),
+        ) as pool:
+            futures = {
+                cluster: pool.submit(
+                    self._train_cluster,
+                    cluster_counts,
+                    cluster,
+                    save_path,
+                    *model_args,
+                    warm_start=cluster in warm_starts,
+                )
+                for cluster, cluster_counts in train_counts.items()
+            }
+            for cluster, future in futures.items():
+                self.models[cluster] = future.result()
+
+    @staticmethod
+    def _train_cluster(
+        cluster_counts,
+        cluster,
+        save_path,
+        prediction_seqlen,
+        prediction_interval,
+        prediction_horizon,
+        assignment_version=None,
+        warm_start=False,
+    ):
+        """
+        Train and save the model of a cluster. With several workers, this runs in a worker process,
+        so it only takes what the model needs instead of the whole forecaster.
+
+        The model records assignment_version, the AssignmentStore version of the cluster's assignments.
+
+        With warm_start, the saved model of the cluster is fine-tuned on the counts after its training cutoff,
+        and saved back with the new cutoff. A saved model that was fit with other prediction parameters, or
+        without a recorded cutoff, is trained from scratch instead.
+
+        Returns
+        -------
+        model : LSTM
+            The trained model.
+        """
+        model_path = ClusterForecaster.cluster_to_file(save_path, cluster)
+        model = None
+        if warm_start:
+            model = LSTM.load(model_path)
+            if (
+                model.training_cutoff is None
+                or model.horizon != prediction_horizon
+                or model.interval != prediction_interval
+                or model.sequence_length != prediction_seqlen
+            ):
+                print(f"cannot fine-tune the saved model of cluster {cluster}, training from scratch")
+                model = None
+            elif cluster_counts.index.max() <= model.training_cutoff:
+                print(f"model for cluster {cluster} is up to date as of {model.training_cutoff}")
+                return model
+            else:
+                # Like predict(), keep enough history before the cutoff for the first new label's input sequence.
+                trunc_start = model.training_cutoff - prediction_horizon - prediction_seqlen * prediction_interval
+                cluster_counts = cluster_counts[cluster_counts.index > trunc_start]
+                print(f"fine-tuning model for cluster {cluster} on data after {model.training_cutoff}")
 
-    def _train_cluster(self, cluster_counts, cluster, save_path):
         dataset = ForecastDataset(
             cluster_counts,
-            sequence_length=self.prediction_seqlen,
-            horizon=self.prediction_horizon,
-            interval=self.prediction_interval,
+            sequence_length=prediction_seqlen,
+            horizon=prediction_horizon,
+            interval=prediction_interval,
         )
 
-        self.models[cluster] = LSTM(
-            horizon=self.prediction_horizon,
-            interval=self.prediction_interval,
-            sequence_length=self.prediction_seqlen,
-        )
-
-        self.models[cluster].fit(dataset)
-        self.models[cluster].save(self.cluster_to_file(save_path, cluster))
+        if model is None:
+            print(f"training model for cluster {cluster}")
+            model = LSTM(
+                horizon=prediction_horizon,
+                interval=prediction_interval,
+                sequence_length=prediction_seqlen,
+            )
+            model.fit(dataset)
+        else:
+            model.fit(dataset, warm_start=True)
+        model.assignment_version = assignment_version
+        model.save(model_path)
+        return model
 
     def predict(self, cluster_df, cluster, start_time, end_time):
         """
@@ -161,14 +343,14 @@ class ClusterForecaster:
             interval=self.prediction_interval,
         )
 
-        # generate predictions
-        predictions = [self.models[cluster].predict(seq) for seq, _ in dataset]
+        # generate predictions for every sequence at once
+        predictions = self.models[cluster].predict_batch(dataset.windows.numpy())
 
         # tag with timestamps
-        pred_arr = [[dataset.get_y_timestamp(i), pred] for i, pred in enumerate(predictions)]
-
-        pred_df = pd.DataFrame(pred_arr, columns=["log_time_s", "count"])
-        pred_df.set_index("log_time_s", inplace=True)
+        pred_df = pd.DataFrame(
+            {"count": predictions},
+            index=pd.Index(dataset.raw_df.index[: len(predictions)] + dataset.horizon, name="log_time_s"),
+        )
         return pred_df[start_time:]
 
 
@@ -185,7 +367,7 @@ class WorkloadGenerator:
         joined = df.join(assignment_df)
 
         # Calculate weight of template within each cluster.
-        joined["cluster"].fillna(-1, inplace=True)
+        joined["cluster"] = joined["cluster"].fillna(-1).astype(np.int64)
         summed = joined.groupby(["cluster", "query_template"]).sum()
         self._preprocessor = preprocessor
         self._percentages = summed / summed.groupby(level=0).sum()
@@ -245,6 +427,18 @@ class ForecasterCLI(cli.Application):
     clusterer_parquet = cli.SwitchAttr(["-c", "--clusterer-parquet"], str, mandatory=True)
     model_path = cli.SwitchAttr(["-m", "--model-path"], str, mandatory=True)
     override = cli.Flag("--override-models")
+    incremental = cli.Flag(
+        "--incremental",
+        excludes=["--override-models"],
+        help="Fine-tune the saved models on the data after their training cutoff, instead of skipping them.",
+    )
+    assignment_store = cli.SwitchAttr(
+        "--assignment-store",
+        str,
+        default=None,
+        help="If specified, the clusterer's assignment store. Without --override-models, saved models are only "
+        "retrained if their cluster's membership changed since the version that they were trained on.",
+    )
 
     start_ts = cli.SwitchAttr(["-s", "--start-time"], str, mandatory=True)
     end_ts = cli.SwitchAttr(["-e", "--end-time"], str, mandatory=True)
@@ -255,6 +449,16 @@ class ForecasterCLI(cli.Application):
     pred_interval = cli.SwitchAttr(["--interval"], pd.Timedelta, mandatory=True)
     pred_seqlen = cli.SwitchAttr(["--seqlen"], int, mandatory=True)
 
+    train_workers = cli.SwitchAttr(
+        "--train-workers", int, default=1, help="The number of processes to train cluster models in."
+    )
+    train_threads = cli.SwitchAttr(
+        "--train-threads",
+        int,
+        default=None,
+        help="The number of torch threads in each training process. Default: the CPU count divided among them.",
+    )
+
     def main(self):
 
         print(f"Loading preprocessor data from {self.preprocessor_parquet}.")
@@ -268,9 +472,13 @@ class ForecasterCLI(cli.Application):
 
         # Join to cluster and group by (cluster,time).
         joined = df.join(assignment_df)
-        joined["cluster"].fillna(-1, inplace=True)
+        joined["cluster"] = joined["cluster"].fillna(-1).astype(np.int64)
         clustered_df = joined.groupby(["cluster", "log_time_s"]).sum()
 
+        assignment_store = None
+        if self.assignment_store is not None:
+            assignment_store = AssignmentStore(self.assignment_store)
+
         # TODO(MIKE): check how many templates are not part of known
         # clusters (i.e. cluster = -1).
         forecaster = ClusterForecaster(
@@ -280,6 +488,10 @@ class ForecasterCLI(cli.Application):
             prediction_horizon=self.pred_horizon,
             save_path=self.model_path,
             override=self.override,
+            assignment_store=assignment_store,
+            workers=self.train_workers,
+            threads_per_worker=self.train_threads,
+            incremental=self.incremental,
         )
 
         # Use preprocessor to sample template and parameter distributions.
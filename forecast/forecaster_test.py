@@ -0,0 +1,147 @@
+import contextlib
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from clusterer import AssignmentStore
+from clusterer_test import make_assignments, make_centers
+from forecaster import ClusterForecaster
+from model import LSTM
+
+START_TIME = pd.Timestamp("2022-01-01 00:00:00", tz="UTC")
+
+
+def make_cluster_df(spans, seed=15721):
+    """
+    Build per-second cluster counts, where each cluster only has counts within its (start, end) span in seconds.
+    """
+    rng = np.random.default_rng(seed)
+    frames = []
+    for cluster, (start, end) in enumerate(spans):
+        seconds = np.arange(start, end)
+        counts = rng.poisson(10 + 5 * np.sin(seconds / 60 + cluster))
+        index = pd.MultiIndex.from_arrays(
+            [np.full(len(seconds), cluster), START_TIME + pd.to_timedelta(seconds, unit="s")],
+            names=["cluster", "log_time_s"],
+        )
+        frames.append(pd.DataFrame({"count": counts}, index=index))
+    return pd.concat(frames)
+
+
+class TestClusterForecaster(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.save_path = self._tmp.name
+        self.model_args = {
+            "prediction_seqlen": 5,
+            "prediction_interval": pd.Timedelta(seconds=10),
+            "prediction_horizon": pd.Timedelta(seconds=30),
+            "save_path": self.save_path,
+        }
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def train(self, cluster_df, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ClusterForecaster(cluster_df, **{**self.model_args, **kwargs})
+
+    def test_predict_without_data_in_range(self):
+        # Cluster 1 only has data from 00:20 on, so nothing can be predicted for it before then.
+        cluster_df = make_cluster_df([(0, 1800), (1200, 1800)])
+        forecaster = self.train(cluster_df)
+        start_time, end_time = START_TIME + pd.Timedelta(minutes=15), START_TIME + pd.Timedelta(minutes=20)
+
+        pred_df = forecaster.predict(cluster_df, 1, start_time, end_time)
+        self.assertEqual(len(pred_df), 0)
+        self.assertEqual(pred_df["count"].sum(), 0)
+
+        pred_df = forecaster.predict(cluster_df, 0, start_time, end_time)
+        self.assertGreater(len(pred_df), 0)
+        self.assertTrue(np.isfinite(pred_df["count"]).all())
+
+    def saved_models(self, clusters):
+        return [LSTM.load(ClusterForecaster.cluster_to_file(self.save_path, cluster)) for cluster in clusters]
+
+    def test_retrain_changed_clusters(self):
+        cluster_df = make_cluster_df([(0, 600), (0, 600), (0, 600)])
+        store = AssignmentStore(Path(self.save_path) / "clusters")
+        with contextlib.redirect_stdout(io.StringIO()):
+            store.commit(make_assignments({"a": 0, "b": 1, "c": 1, "d": 2}), make_centers(3))
+        self.train(cluster_df, assignment_store=store)
+        self.assertEqual([model.assignment_version for model in self.saved_models([0, 1, 2])], [1, 1, 1])
+
+        # Template c moves from cluster 1 to cluster 0 in version 2, which the forecaster never sees.
+        with contextlib.redirect_stdout(io.StringIO()):
+            store.commit(make_assignments({"a": 0, "b": 1, "c": 0, "d": 2}), make_centers(3))
+            store.commit(make_assignments({"a": 0, "b": 1, "c": 0, "d": 2}), make_centers(3))
+        self.train(cluster_df, assignment_store=store)
+        self.assertEqual([model.assignment_version for model in self.saved_models([0, 1, 2])], [3, 3, 1])
+
+        # Models that were trained with other prediction parameters are always retrained.
+        self.train(cluster_df, assignment_store=store, prediction_seqlen=3)
+        self.assertEqual([model.sequence_length for model in self.saved_models([0, 1, 2])], [3, 3, 3])
+
+    def test_incremental(self):
+        self.train(make_cluster_df([(0, 600), (0, 600)]))
+        before = self.saved_models([0, 1])
+        self.assertEqual([model.training_cutoff for model in before], [START_TIME + pd.Timedelta(seconds=590)] * 2)
+
+        # Fine-tuning on newer data moves the cutoff along with the weights.
+        cluster_df = make_cluster_df([(0, 1200), (0, 1200)])
+        self.train(cluster_df, incremental=True)
+        models = self.saved_models([0, 1])
+        self.assertEqual([model.training_cutoff for model in models], [START_TIME + pd.Timedelta(seconds=1190)] * 2)
+        for model, old_model in zip(models, before):
+            weights, old_weights = model.state_dict(), old_model.state_dict()
+            self.assertFalse(all(np.array_equal(weights[name], old_weights[name]) for name in weights))
+
+        # Models that are up to date are left alone, and are not reported as trained.
+        arrays = ClusterForecaster.cluster_to_file(self.save_path, 0) + "/" + LSTM.ARRAYS_FILENAME
+        mtime = Path(arrays).stat().st_mtime_ns
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            ClusterForecaster(cluster_df, **self.model_args, incremental=True)
+        self.assertEqual(Path(arrays).stat().st_mtime_ns, mtime)
+        self.assertIn("model for cluster 0 is up to date", output.getvalue())
+        self.assertNotIn("training model", output.getvalue())
+        self.assertNotIn("fine-tuning model", output.getvalue())
+
+    def test_workers(self):
+        cluster_df = make_cluster_df([(0, 600), (0, 600), (300, 600)])
+        serial = self.train(cluster_df)
+        parallel = self.train(cluster_df, save_path=f"{self.save_path}/parallel", override=True, workers=2)
+        self.assertEqual(sorted(parallel.models), [0, 1, 2])
+        for cluster in range(3):
+            self.assertEqual(parallel.models[cluster].training_cutoff, serial.models[cluster].training_cutoff)
+            self.assertTrue(Path(ClusterForecaster.cluster_to_file(f"{self.save_path}/parallel", cluster)).is_dir())
+
+    def test_cluster_file_names(self):
+        for cluster in [0, 3, -1, 3.0, np.int64(7), np.float64(-1.0)]:
+            model_path = ClusterForecaster.cluster_to_file(self.save_path, cluster)
+            self.assertEqual(ClusterForecaster.get_cluster_from_file(model_path), int(cluster))
+        with self.assertRaises(RuntimeError):
+            ClusterForecaster.get_cluster_from_file(f"{self.save_path}/model_3.0")
+
+    def test_float_cluster_labels(self):
+        # A join that leaves NaN cluster labels turns every label into a float.
+        cluster_df = make_cluster_df([(0, 600), (0, 600)])
+        cluster_df.index = cluster_df.index.set_levels(cluster_df.index.levels[0].astype(np.float64), level=0)
+        self.train(cluster_df)
+        self.assertTrue(Path(ClusterForecaster.cluster_to_file(self.save_path, 1)).is_dir())
+        # An artifact that an older version named after a float label is skipped, rather than failing the load.
+        (Path(self.save_path) / "model_1.0").mkdir()
+        (Path(self.save_path) / "model_1.0" / "manifest.json").touch()
+
+        forecaster = self.train(cluster_df)
+        self.assertEqual(sorted(forecaster.models), [0, 1])
+        start_time, end_time = START_TIME + pd.Timedelta(minutes=5), START_TIME + pd.Timedelta(minutes=8)
+        pred_df = forecaster.predict(cluster_df, 1.0, start_time, end_time)
+        self.assertGreater(len(pred_df), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,16 +5,19 @@ ForecastModel, and override the _do_fit and _do_predict abstract methods
 """
 
 import copy
+import json
 import logging
 from abc import ABC, abstractmethod
-from typing import Tuple
+from pathlib import Path
+from typing import Dict, Tuple
 
 import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
+from preprocessor import _atomic_write
 from sklearn.preprocessing import MinMaxScaler
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, TensorDataset
 
 
 class ForecastDataset(Dataset):
@@ -36,6 +39,8 @@ class ForecastDataset(Dataset):
     y : torch.FloatTensor.
         The (optionally transformed) tensors expecting the expected value at the
         specified horizon.
+    windows : torch.FloatTensor
+        The (N, sequence_length, features) input sequence of every label in y, as a view of X.
     """
 
     def __init__(
@@ -56,15 +61,23 @@ class ForecastDataset(Dataset):
         return self.X.shape[0]
 
     def __getitem__(self, i):
-        if i >= self.sequence_length - 1:
-            i_start = i - self.sequence_length + 1
-            x = self.X[i_start : (i + 1)]
-        else:
-            padding = self.X[0].repeat(self.sequence_length - i - 1, 1)
-            x = self.X[0 : (i + 1), :]
-            x = torch.cat((padding, x), 0)
+        return self.windows[i], self.y[i].reshape((1, -1))
 
-        return x, self.y[i].reshape((1, -1))
+    @staticmethod
+    def _unfold_windows(X, sequence_length):
+        """
+        Lay out the sequence ending at every data point as one (N, sequence_length, features) tensor.
+        Sequences that start before the first data point are padded with the first data point.
+
+        The windows are strided views of a single padded copy of X, so no window is copied.
+        Since every data point has a window, an empty X has an empty (0, sequence_length, features) tensor.
+        """
+        if len(X) < 1:
+            return X.new_zeros((0, sequence_length, X.shape[1]))
+        padding = X[:1].expand(sequence_length - 1, -1)
+        padded = torch.cat((padding, X), 0)
+        # unfold() yields (N, features, sequence_length) windows.
+        return padded.unfold(0, sequence_length, 1).transpose(1, 2)
 
     def get_y_timestamp(self, ind):
         """For a (seq,label) pair in the dataset, return the
@@ -95,14 +108,25 @@ class ForecastDataset(Dataset):
         if x_transformer is None or y_transformer is None:
             self.X = torch.FloatTensor(self.raw_df.values)
             self.y = torch.FloatTensor(shifted.values)
-            return
-
-        self.X = torch.FloatTensor(x_transformer.transform(self.raw_df.values))
-        self.y = torch.FloatTensor(y_transformer.transform(shifted.values))
+        else:
+            self.X = torch.FloatTensor(x_transformer.transform(self.raw_df.values))
+            self.y = torch.FloatTensor(y_transformer.transform(shifted.values))
+        self.windows = self._unfold_windows(self.X, self.sequence_length)
 
 
 class ForecastModel(ABC):
-    """Interface for all the forecasting models"""
+    """Interface for all the forecasting models
+
+    Models are saved as an artifact directory of a JSON manifest and a file of
+    raw arrays, so that loading a model does not unpickle any Python objects.
+    """
+
+    # Version 2 added the training cutoff, and version 3 the assignment version.
+    ARTIFACT_VERSION = 3
+    MANIFEST_FILENAME = "manifest.json"
+    ARRAYS_FILENAME = "arrays.bin"
+    # Arrays start on aligned offsets, so that they can be viewed in place.
+    ARRAY_ALIGNMENT = 64
 
     def __init__(self, horizon, interval, sequence_length):
         self._x_transformer = None
@@ -111,12 +135,16 @@ class ForecastModel(ABC):
         self.horizon = horizon
         self.interval = interval
         self.sequence_length = sequence_length
+        # The timestamp of the last data point that the model was fit on.
+        self.training_cutoff = None
+        # The version of the cluster assignments that the model was trained on, if any.
+        self.assignment_version = None
 
     @property
     def name(self):
         return self.__class__.__name__
 
-    def fit(self, train_seqs: ForecastDataset) -> None:
+    def fit(self, train_seqs: ForecastDataset, warm_start: bool = False) -> None:
         """Fit the model with training sequences
 
         Parameters
@@ -124,6 +152,11 @@ class ForecastModel(ABC):
         train_seqs :
             List of training sequences and the expected output label
             in a certain horizon
+        warm_start :
+            If True and the model has been fit before, fine-tune the current
+            weights on train_seqs, e.g., on the data after training_cutoff.
+            The existing transformers are kept, so that the inputs the model
+            was fit on keep their scale.
         """
 
         # Make sure that the training data matches what the model expects
@@ -131,12 +164,14 @@ class ForecastModel(ABC):
         assert self.interval == train_seqs.interval
         assert self.sequence_length == train_seqs.sequence_length
 
-        self._x_transformer, self._y_transformer = self._get_transformers(train_seqs.raw_df.values)
+        if not warm_start or self._x_transformer is None:
+            self._x_transformer, self._y_transformer = self._get_transformers(train_seqs.raw_df.values)
 
         transformed = copy.deepcopy(train_seqs)
         transformed.set_transformers((self._x_transformer, self._y_transformer))
 
         self._do_fit(transformed)
+        self.training_cutoff = train_seqs.raw_df.index.max()
 
     @abstractmethod
     def _do_fit(self, trains_seqs: ForecastDataset) -> None:
@@ -173,6 +208,46 @@ class ForecastModel(ABC):
 
         return predict
 
+    def predict_batch(self, test_seqs: np.ndarray) -> np.ndarray:
+        """Test a fitted model with many sequences at once.
+        Parameters
+        ----------
+        test_seqs:
+            A (N, sequence_length, features) array of test sequences,
+            e.g., ForecastDataset.windows
+
+        Returns
+        -------
+        The (N,) predicted values at certain horizon
+        """
+        test_seqs = np.asarray(test_seqs, dtype=np.float64)
+        if len(test_seqs) == 0:
+            return np.zeros(0)
+        if self._x_transformer:
+            n, sequence_length, features = test_seqs.shape
+            test_seqs = self._x_transformer.transform(test_seqs.reshape(-1, features))
+            test_seqs = test_seqs.reshape(n, sequence_length, features)
+
+        predicts = np.asarray(self._do_predict_batch(test_seqs), dtype=np.float64)
+        if self._y_transformer:
+            predicts = self._y_transformer.inverse_transform(predicts.reshape(-1, 1)).ravel()
+
+        return predicts
+
+    def _do_predict_batch(self, test_seqs: np.ndarray) -> np.ndarray:
+        """Perform prediction given many input sequences.
+        Models can override this to predict all the sequences at once.
+        Parameters
+        ----------
+        test_seqs
+            A (N, sequence_length, features) array of test sequences
+
+        Returns
+        -------
+        The (N,) predicted values at certain horizon
+        """
+        return np.array([self._do_predict(test_seq) for test_seq in test_seqs])
+
     @abstractmethod
     def _do_predict(self, test_seq: np.ndarray) -> float:
         """Perform prediction given input sequence.
@@ -213,6 +288,77 @@ class ForecastModel(ABC):
     def load(path):
         raise NotImplementedError("Should be implemented by child classes")
 
+    def _get_manifest(self) -> Dict:
+        """The manifest fields that every model shares."""
+        return {
+            "version": self.ARTIFACT_VERSION,
+            "model": self.name,
+            "horizon": self.horizon.isoformat(),
+            "interval": self.interval.isoformat(),
+            "sequence_length": self.sequence_length,
+            "training_cutoff": None if self.training_cutoff is None else self.training_cutoff.isoformat(),
+            "assignment_version": self.assignment_version,
+        }
+
+    @staticmethod
+    def _write_artifact(path, manifest: Dict, arrays: Dict[str, np.ndarray]) -> None:
+        """Write a model artifact.
+
+        Parameters
+        ----------
+        path :
+            The artifact directory, which is created if needed.
+        manifest :
+            The JSON-serializable description of the model. The name, dtype,
+            shape, and offset of every array are added to it.
+        arrays :
+            The named arrays of the model, e.g., its weights.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        entries, offset = [], 0
+        with _atomic_write(path / ForecastModel.ARRAYS_FILENAME) as arrays_tmp, open(arrays_tmp, "wb") as f:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                padding = -offset % ForecastModel.ARRAY_ALIGNMENT
+                f.write(b"\0" * padding)
+                offset += padding
+                entries.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+                f.write(array.tobytes())
+                offset += array.nbytes
+        manifest = dict(manifest, arrays=entries)
+
+        # The manifest is replaced last, since it is what readers look for.
+        with _atomic_write(path / ForecastModel.MANIFEST_FILENAME) as manifest_tmp, open(manifest_tmp, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    @staticmethod
+    def _read_artifact(path) -> Tuple[Dict, Dict[str, np.ndarray]]:
+        """Read a model artifact written by _write_artifact.
+
+        The arrays are copy-on-write views of the memory-mapped array file, so
+        only the pages that are used are read, and the file is never modified.
+
+        Returns
+        -------
+        The manifest and the named arrays.
+        """
+        path = Path(path)
+        with open(path / ForecastModel.MANIFEST_FILENAME) as f:
+            manifest = json.load(f)
+        if manifest["version"] > ForecastModel.ARTIFACT_VERSION:
+            raise RuntimeError(f"Unsupported model artifact version {manifest['version']} in {path}")
+
+        arrays = {}
+        if len(manifest["arrays"]) > 0:
+            buffer = np.memmap(path / ForecastModel.ARRAYS_FILENAME, dtype=np.uint8, mode="c")
+            for entry in manifest["arrays"]:
+                arrays[entry["name"]] = np.ndarray(
+                    tuple(entry["shape"]), dtype=np.dtype(entry["dtype"]), buffer=buffer, offset=entry["offset"]
+                )
+        return manifest, arrays
+
 
 class LSTM(nn.Module, ForecastModel):
     """A simple LSTM model serves as a template for ForecastModel"""
@@ -228,6 +374,10 @@ class LSTM(nn.Module, ForecastModel):
         output_size: int = 1,
         lr: float = 0.001,
         epochs: int = 10,
+        batch_size: int = 32,
+        num_threads: int = None,
+        patience: int = None,
+        min_delta: float = 0.0,
     ):
         """
         Parameters
@@ -244,12 +394,24 @@ class LSTM(nn.Module, ForecastModel):
             Learning rate while fitting.
         epochs :
             Number of epochs for fitting.
+        batch_size :
+            Number of training sequences per optimizer step. Each batch is
+            fed through the LSTM as a single tensor.
+        num_threads :
+            If specified, the number of threads that torch uses while fitting.
+        patience :
+            If specified, stop fitting early once the epoch's mean loss has not
+            improved by more than min_delta for this many epochs.
+        min_delta :
+            The smallest decrease in the mean loss that counts as an improvement.
         """
         nn.Module.__init__(self)
         ForecastModel.__init__(self, horizon, interval, sequence_length)
 
+        self._input_size = input_size
         self._hidden_layer_size = hidden_layer_size
         self._num_hidden_layers = num_hidden_layers
+        self._output_size = output_size
 
         self._lstm = nn.LSTM(
             input_size=input_size,
@@ -266,6 +428,10 @@ class LSTM(nn.Module, ForecastModel):
 
         self._epochs = epochs
         self._lr = lr
+        self._batch_size = batch_size
+        self._num_threads = num_threads
+        self._patience = patience
+        self._min_delta = min_delta
 
     def forward(self, input_seq: torch.FloatTensor) -> float:
         """Forward propagation Implements nn.Module.forward().
@@ -282,6 +448,22 @@ class LSTM(nn.Module, ForecastModel):
         predictions = self._linear(lstm_out.view(len(input_seq), -1))
         return predictions[-1]
 
+    def _forward_batch(self, input_seqs: torch.FloatTensor) -> torch.FloatTensor:
+        """Forward propagation of a batch of sequences, each from a zero hidden state.
+
+        Parameters
+        ----------
+        input_seqs : FloatTensor
+            A (batch, sequence_length, input_size) tensor.
+
+        Returns
+        -------
+        A (batch, output_size) tensor of the prediction of every sequence.
+        """
+        # nn.LSTM expects (sequence_length, batch, input_size), and defaults to a zero hidden state.
+        lstm_out, _ = self._lstm(input_seqs.transpose(0, 1))
+        return self._linear(lstm_out[-1])
+
     def _do_fit(self, train_seqs: Dataset) -> None:
         """
         Perform fitting.
@@ -301,35 +483,39 @@ class LSTM(nn.Module, ForecastModel):
         # Training specifics
         loss_function = nn.MSELoss()
         optimizer = torch.optim.Adam(self.parameters(), lr=lr)
+        # Every window is already materialized, so batches are gathered from two tensors instead of
+        # assembling each training sequence separately.
+        loader = DataLoader(TensorDataset(train_seqs.windows, train_seqs.y), batch_size=self._batch_size, shuffle=True)
         logging.info(f"Training with {len(train_seqs)} samples, {epochs} epochs:")
-        print(f"Training with {len(train_seqs)} samples, {epochs} epochs:")
-        for i in range(epochs):
-            # randomly shuffle training sequences
-            arr = np.arange(len(train_seqs))
-            np.random.shuffle(arr)
-            for ind in arr:
-                seq, labels = train_seqs[ind]
-                optimizer.zero_grad()
-
-                self._hidden_cell = (
-                    torch.zeros(self._num_hidden_layers, 1, self._hidden_layer_size),
-                    torch.zeros(self._num_hidden_layers, 1, self._hidden_layer_size),
-                )
-                seq = seq.view(-1)
-                labels = labels.view(-1)
-
-                y_pred = self(seq)
-
-                single_loss = loss_function(y_pred, labels)
-                single_loss.backward()
-                optimizer.step()
+        print(f"Training with {len(train_seqs)} samples, {epochs} epochs, batch size {self._batch_size}:")
+
+        num_threads = torch.get_num_threads()
+        if self._num_threads is not None:
+            torch.set_num_threads(self._num_threads)
+        try:
+            best_loss, stale_epochs = np.inf, 0
+            for i in range(epochs):
+                epoch_loss = 0.0
+                for seqs, labels in loader:
+                    optimizer.zero_grad()
+                    y_pred = self._forward_batch(seqs)
+                    batch_loss = loss_function(y_pred, labels)
+                    batch_loss.backward()
+                    optimizer.step()
+                    epoch_loss += batch_loss.item() * len(seqs)
+                epoch_loss /= len(train_seqs)
 
-            if i % 1 == 0:
                 # logging.info(
-                print(f"[LSTM FIT]epoch: {i + 1:3} loss: {single_loss.item():10.8f}")
-
-        # logging.info(
-        print(f"[LSTM FIT]epoch: {epochs:3} loss: {single_loss.item():10.10f}")
+                print(f"[LSTM FIT]epoch: {i + 1:3} loss: {epoch_loss:10.8f}")
+                if epoch_loss < best_loss - self._min_delta:
+                    best_loss, stale_epochs = epoch_loss, 0
+                else:
+                    stale_epochs += 1
+                    if self._patience is not None and stale_epochs >= self._patience:
+                        print(f"[LSTM FIT]stopping early, no improvement in {stale_epochs} epochs.")
+                        break
+        finally:
+            torch.set_num_threads(num_threads)
 
     def _do_predict(self, seq: np.ndarray) -> float:
         """Use LSTM to predict based on input sequence.
@@ -354,6 +540,21 @@ class LSTM(nn.Module, ForecastModel):
 
         return pred.item()
 
+    def _do_predict_batch(self, test_seqs: np.ndarray) -> np.ndarray:
+        """Use LSTM to predict based on many input sequences, in one forward pass.
+        Parameters
+        ----------
+        test_seqs
+            A (N, sequence_length, features) array of test sequences.
+
+        Returns
+        -------
+        The (N,) predicted values at certain horizon.
+        """
+        with torch.no_grad():
+            preds = self._forward_batch(torch.FloatTensor(test_seqs))
+        return preds[:, 0].numpy()
+
     def _get_transformers(self, data: np.ndarray) -> Tuple:
         """
         Get the transformers. In the case of the LSTM, it uses the same
@@ -373,9 +574,72 @@ class LSTM(nn.Module, ForecastModel):
         # Time-series data shares the same transformer
         return scaler, scaler
 
+    # The fitted attributes of the MinMaxScaler that is shared by X and y.
+    SCALER_ATTRIBUTES = ["min_", "scale_", "data_min_", "data_max_", "data_range_", "n_samples_seen_"]
+
     def _do_save(self, path):
-        torch.save(self, path)
+        """Save the hyperparameters, weights, and scaler of the model as an artifact directory."""
+        manifest = self._get_manifest()
+        manifest["hyperparameters"] = {
+            "input_size": self._input_size,
+            "hidden_layer_size": self._hidden_layer_size,
+            "num_hidden_layers": self._num_hidden_layers,
+            "output_size": self._output_size,
+            "lr": self._lr,
+            "epochs": self._epochs,
+            "batch_size": self._batch_size,
+            "num_threads": self._num_threads,
+            "patience": self._patience,
+            "min_delta": self._min_delta,
+        }
+        arrays = {f"state/{name}": tensor.detach().numpy() for name, tensor in self.state_dict().items()}
+
+        manifest["scaler"] = None
+        if self._x_transformer is not None:
+            manifest["scaler"] = {"feature_range": list(self._x_transformer.feature_range)}
+            for attribute in self.SCALER_ATTRIBUTES:
+                arrays[f"scaler/{attribute}"] = np.asarray(getattr(self._x_transformer, attribute))
+
+        self._write_artifact(path, manifest, arrays)
 
     @staticmethod
     def load(path):
-        return torch.load(path)
+        """Load a model saved by save().
+
+        Parameters
+        ----------
+        path :
+            The artifact directory of the model.
+
+        Returns
+        -------
+        The loaded LSTM.
+        """
+        manifest, arrays = ForecastModel._read_artifact(path)
+        assert manifest["model"] == LSTM.__name__, f"{path} is not an LSTM model"
+
+        model = LSTM(
+            horizon=pd.Timedelta(manifest["horizon"]),
+            interval=pd.Timedelta(manifest["interval"]),
+            sequence_length=manifest["sequence_length"],
+            **manifest["hyperparameters"],
+        )
+        state = {
+            name[len("state/") :]: torch.from_numpy(array)
+            for name, array in arrays.items()
+            if name.startswith("state/")
+        }
+        model.load_state_dict(state)
+        if manifest.get("training_cutoff") is not None:
+            model.training_cutoff = pd.Timestamp(manifest["training_cutoff"])
+        model.assignment_version = manifest.get("assignment_version")
+
+        if manifest["scaler"] is not None:
+            scaler = MinMaxScaler(feature_range=tuple(manifest["scaler"]["feature_range"]))
+            for attribute in LSTM.SCALER_ATTRIBUTES:
+                setattr(scaler, attribute, np.array(arrays[f"scaler/{attribute}"]))
+            scaler.n_features_in_ = scaler.min_.shape[0]
+            # Time-series data shares the same transformer
+            model._x_transformer, model._y_transformer = scaler, scaler
+
+        return model
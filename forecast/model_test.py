@@ -0,0 +1,104 @@
+import contextlib
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from model import LSTM, ForecastDataset, ForecastModel
+
+
+def make_counts(n, start_time="2022-01-01", interval=pd.Timedelta(seconds=1)):
+    log_times = pd.date_range(start_time, periods=n, freq=interval, tz="UTC", name="log_time_s")
+    return pd.DataFrame({"count": np.arange(n, dtype=np.int64)}, index=log_times)
+
+
+class TestForecastDataset(unittest.TestCase):
+    def test_empty(self):
+        dataset = ForecastDataset(make_counts(0), sequence_length=5)
+        self.assertEqual(len(dataset), 0)
+        self.assertEqual(tuple(dataset.windows.shape), (0, 5, 1))
+        self.assertEqual(len(LSTM(sequence_length=5).predict_batch(dataset.windows.numpy())), 0)
+
+    def test_shorter_than_window(self):
+        # Windows that start before the first data point are padded with it.
+        dataset = ForecastDataset(make_counts(3), sequence_length=5)
+        self.assertEqual(tuple(dataset.windows.shape), (3, 5, 1))
+        np.testing.assert_array_equal(dataset.windows[2, :, 0].numpy(), [0, 0, 0, 1, 2])
+
+
+class TestArtifact(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.model_path = Path(self._tmp.name) / "model_0"
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_round_trip(self):
+        counts = make_counts(300, interval=pd.Timedelta(seconds=10))
+        counts["count"] = (10 + 5 * np.sin(np.arange(300) / 10)).round().astype(np.int64)
+        args = {"horizon": pd.Timedelta(seconds=30), "interval": pd.Timedelta(seconds=10), "sequence_length": 5}
+        dataset = ForecastDataset(counts, **args)
+        model = LSTM(**args, hidden_layer_size=16, num_hidden_layers=2, epochs=2, batch_size=8)
+        with contextlib.redirect_stdout(io.StringIO()):
+            model.fit(dataset)
+        model.assignment_version = 4
+        model.save(self.model_path)
+
+        with open(self.model_path / ForecastModel.MANIFEST_FILENAME) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest["version"], ForecastModel.ARTIFACT_VERSION)
+        self.assertEqual(manifest["hyperparameters"]["num_hidden_layers"], 2)
+
+        loaded = LSTM.load(self.model_path)
+        for attribute in ["horizon", "interval", "sequence_length", "training_cutoff", "assignment_version"]:
+            self.assertEqual(getattr(loaded, attribute), getattr(model, attribute))
+        for name, tensor in model.state_dict().items():
+            np.testing.assert_array_equal(loaded.state_dict()[name].numpy(), tensor.numpy())
+        windows = dataset.windows.numpy()
+        np.testing.assert_array_equal(loaded.predict_batch(windows), model.predict_batch(windows))
+
+        # A loaded model can be fit further without touching the file it was mapped from.
+        arrays = (self.model_path / ForecastModel.ARRAYS_FILENAME).read_bytes()
+        with contextlib.redirect_stdout(io.StringIO()):
+            loaded.fit(dataset, warm_start=True)
+        self.assertEqual((self.model_path / ForecastModel.ARRAYS_FILENAME).read_bytes(), arrays)
+
+    def test_predict_batch(self):
+        counts = make_counts(200, interval=pd.Timedelta(seconds=10))
+        counts["count"] = (10 + 5 * np.sin(np.arange(200) / 10)).round().astype(np.int64)
+        args = {"horizon": pd.Timedelta(seconds=30), "interval": pd.Timedelta(seconds=10), "sequence_length": 5}
+        dataset = ForecastDataset(counts, **args)
+        model = LSTM(**args, hidden_layer_size=16, epochs=1, batch_size=8)
+        with contextlib.redirect_stdout(io.StringIO()):
+            model.fit(dataset)
+
+        # One batched forward pass agrees with predicting every window on its own.
+        windows = dataset.windows.numpy()
+        expected = [model.predict(window) for window in windows]
+        np.testing.assert_allclose(model.predict_batch(windows), expected, rtol=1e-5)
+
+    def test_unfitted(self):
+        model = LSTM(sequence_length=3)
+        model.save(self.model_path)
+        loaded = LSTM.load(self.model_path)
+        self.assertIsNone(loaded._x_transformer)
+        self.assertIsNone(loaded.training_cutoff)
+
+    def test_newer_version(self):
+        LSTM().save(self.model_path)
+        manifest_path = self.model_path / ForecastModel.MANIFEST_FILENAME
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        manifest["version"] = ForecastModel.ARTIFACT_VERSION + 1
+        with open(manifest_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        with self.assertRaises(RuntimeError):
+            LSTM.load(self.model_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
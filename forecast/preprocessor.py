@@ -1,25 +1,741 @@
+import contextlib
 import csv
+import functools
 import glob
+import hashlib
+import io
+import json
+import os
 import re
+import shutil
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from typing import List
 
+import numpy as np
 import pandas as pd
 import pglast
-from pandarallel import pandarallel
+import pyarrow as pa
+import pyarrow.parquet as pq
 from plumbum import cli
-from tqdm.contrib.concurrent import process_map
 
-# Enable parallel pandas operations.
-# pandarallel is a little buggy. For example, progress_bar=True does not work,
-# and if you are using PyCharm you will want to enable "Emulate terminal in
-# output console" instead of using the PyCharm Python Console.
-# The reason we're using this library anyway is that:
-# - The parallelization is dead simple: change .blah() to .parallel_blah().
-# - swifter has poor string perf; we're mainly performing string ops.
-# - That said, Wan welcomes any switch that works.
-pandarallel.initialize(verbose=1)
+
+class PreprocessorExecutor:
+    """
+    Run the row-wise preprocessing stages over chunks of string columns, serially or on a pool of workers.
+
+    Only the string columns that a stage needs are shipped to the workers. For process pools, each chunk of a
+    column is packed into a single UTF-8 buffer and an offsets array, which is far cheaper to pickle than a
+    DataFrame shard. The pool is only started on first use, so constructing an executor (or importing this
+    module) is free.
+
+    Attributes
+    ----------
+    kind : str
+        One of KINDS: run in the calling thread, on a thread pool, or on a process pool.
+    workers : int
+        The number of pool workers.
+    chunk_size : int
+        The number of rows in each chunk that is submitted to the pool.
+    """
+
+    KINDS = ["serial", "thread", "process"]
+    DEFAULT_CHUNK_SIZE = 50_000
+
+    def __init__(self, kind="serial", workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        assert kind in self.KINDS, f"Executor kind {kind} is invalid."
+        assert chunk_size > 0, "Executor chunk size must be positive."
+        self.kind = kind
+        self.workers = os.cpu_count() if workers is None else workers
+        self.chunk_size = chunk_size
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.kind == "thread":
+                self._pool = ThreadPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _pack(strings):
+        encoded = [string.encode() for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return b"".join(encoded), offsets
+
+    @staticmethod
+    def _unpack(packed):
+        buffer, offsets = packed
+        return [buffer[offsets[i] : offsets[i + 1]].decode() for i in range(len(offsets) - 1)]
+
+    @staticmethod
+    def _call_packed(fn, *packed_columns):
+        return fn(*[PreprocessorExecutor._unpack(packed) for packed in packed_columns])
+
+    def map_chunks(self, fn, *columns):
+        """
+        Apply fn to consecutive chunks of the given columns.
+
+        Parameters
+        ----------
+        fn : Callable
+            Called with one list of str per column. For process pools, fn must be picklable.
+        columns : List[str]
+            Columns of equal length.
+
+        Returns
+        -------
+        results : List
+            The result of fn for each chunk, in order.
+        """
+        n = len(columns[0]) if len(columns) > 0 else 0
+        if self.kind == "serial" or n <= self.chunk_size:
+            # There is no point in starting workers for a single chunk.
+            return [fn(*columns)]
+
+        bounds = [(start, min(start + self.chunk_size, n)) for start in range(0, n, self.chunk_size)]
+        pool = self._get_pool()
+        if self.kind == "thread":
+            futures = [pool.submit(fn, *[column[start:end] for column in columns]) for start, end in bounds]
+        else:
+            futures = [
+                pool.submit(
+                    PreprocessorExecutor._call_packed, fn, *[self._pack(column[start:end]) for column in columns]
+                )
+                for start, end in bounds
+            ]
+        return [future.result() for future in futures]
+
+    def map(self, fn, *iterables):
+        """
+        Apply fn to every item of the given iterables, e.g., to read each CSVLOG on a worker of its own.
+
+        Parameters
+        ----------
+        fn : Callable
+            Called with one item of each iterable. For process pools, fn, its arguments, and its results
+            must be picklable.
+        iterables : List[Iterable]
+            Iterables of equal length.
+
+        Returns
+        -------
+        results : List
+            The result of fn for each item, in order.
+        """
+        iterables = [list(iterable) for iterable in iterables]
+        n = len(iterables[0]) if len(iterables) > 0 else 0
+        if self.kind == "serial" or n <= 1:
+            return list(map(fn, *iterables))
+        return list(self._get_pool().map(fn, *iterables))
+
+
+# The TemplateCache of each pool worker, see Preprocessor._templatize_chunk.
+_worker_state = threading.local()
+
+
+@contextlib.contextmanager
+def _atomic_write(path):
+    """
+    Write a file through a temporary path, which replaces the file only once it has been completely written.
+
+    A crash never leaves a torn file behind, and readers only ever see the old or the new file. Files that
+    are written together are replaced in the order that their writes finish, so write the file that readers
+    look for last.
+
+    Parameters
+    ----------
+    path : str | Path
+        The file to write.
+
+    Yields
+    ------
+    tmp_path : Path
+        The temporary path to write the file to.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _to_ns(datetime_index):
+    """
+    Get the times of a DatetimeIndex as int64 nanoseconds since the epoch.
+    """
+    # The index may be in any datetime unit, e.g., microseconds when parsed by pandas 3.
+    return datetime_index.as_unit("ns").asi8
+
+
+class _BoundedReader(io.RawIOBase):
+    """
+    Expose at most the next length bytes of a file, so that pandas stops at a row boundary
+    even if PostgreSQL is still appending to the file.
+    """
+
+    def __init__(self, fp, length):
+        super().__init__()
+        self._fp = fp
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._fp.read(min(len(buffer), self._remaining))
+        self._remaining -= len(data)
+        buffer[: len(data)] = data
+        return len(data)
+
+
+class LogManifest:
+    """
+    Track how much of each CSVLOG has already been preprocessed into a Parquet dataset.
+
+    The manifest is stored alongside the dataset parts. Its leading underscore makes
+    Parquet readers skip it when the dataset directory is read.
+
+    Attributes
+    ----------
+    files : Dict[str, dict]
+        Map from resolved CSVLOG path to its size, mtime, a hash of its first bytes, and the byte offset that
+        has been processed up to.
+    next_part : int
+        The number to use for the next dataset part.
+    min_time : str | None
+        The earliest log_time in the dataset, ISO formatted.
+    max_time : str | None
+        The latest log_time in the dataset, ISO formatted.
+    format_version : int | None
+        The FORMAT_VERSION that the dataset was preprocessed with.
+    created : str | None
+        When the dataset was started from scratch, ISO formatted. Readers that follow the manifest can tell
+        from this that the dataset was rebuilt, even once it has grown back past the parts they have read.
+    """
+
+    FILENAME = "_manifest.json"
+    # Bump this whenever the layout of the dataset parts or the templatization output changes,
+    # so that datasets preprocessed by an older version are reprocessed from scratch.
+    FORMAT_VERSION = 1
+    # The number of leading bytes of a CSVLOG that are hashed to recognize it when it is rewritten in place.
+    HEAD_BYTES = 4096
+
+    def __init__(self, files=None, next_part=0, min_time=None, max_time=None, format_version=None, created=None):
+        self.files = {} if files is None else files
+        self.next_part = next_part
+        self.min_time = min_time
+        self.max_time = max_time
+        self.format_version = format_version
+        self.created = created
+
+    @staticmethod
+    def load(dataset_path):
+        """
+        Load the manifest of the given dataset, or an empty manifest if there is none.
+        """
+        manifest_path = Path(dataset_path) / LogManifest.FILENAME
+        if not manifest_path.exists():
+            return LogManifest()
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        # Manifests from before FORMAT_VERSION recorded a hash of the code instead, and have no known format.
+        manifest.pop("code_version", None)
+        return LogManifest(**manifest)
+
+    def save(self, dataset_path):
+        with _atomic_write(Path(dataset_path) / LogManifest.FILENAME) as tmp_path, open(tmp_path, "w") as manifest_file:
+            json.dump(vars(self), manifest_file, indent=2)
+
+    def pending_range(self, csvlog):
+        """
+        Find the byte range of a CSVLOG that has not been preprocessed yet.
+
+        Parameters
+        ----------
+        csvlog : str
+            Path to a CSVLOG file generated by PostgreSQL.
+
+        Returns
+        -------
+        byte_range : Tuple[int, int]
+            The [start, end) byte range to read. The end is the end of the last complete row,
+            so start == end if there is nothing new to read.
+        """
+        stat = os.stat(csvlog)
+        entry = self.files.get(self._key(csvlog))
+        if entry is None:
+            start = 0
+        elif stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+            # The file has not changed since it was processed.
+            start = entry["offset"]
+            if start == stat.st_size:
+                return start, start
+        elif stat.st_size < entry["offset"] or self._head_hash(csvlog, entry["offset"]) != entry["head"]:
+            # The file was truncated and reused on log rotation, even if it has grown back past the offset since.
+            start = 0
+        else:
+            start = entry["offset"]
+        return start, self._last_row_end(csvlog, start, stat.st_size)
+
+    @staticmethod
+    def _key(csvlog):
+        # The same CSVLOG can be globbed through different spellings of its folder.
+        return str(Path(csvlog).resolve())
+
+    @staticmethod
+    def _head_hash(csvlog, offset):
+        with open(csvlog, "rb") as fp:
+            return hashlib.sha256(fp.read(min(offset, LogManifest.HEAD_BYTES))).hexdigest()
+
+    @staticmethod
+    def _last_row_end(csvlog, start, size, block_size=1 << 20):
+        """
+        Find the end of the last complete row in [start, size), where start is the start of a row.
+
+        PostgreSQL may be in the middle of appending a row, and quoted fields may contain newlines, so a newline
+        only ends a row if it is outside of quotes, i.e., if an even number of quotes precede it since start.
+        Quotes inside quoted fields are doubled, which leaves the parity unchanged.
+        """
+        end, in_quotes = start, 0
+        with open(csvlog, "rb") as fp:
+            fp.seek(start)
+            position = start
+            while position < size:
+                block = np.frombuffer(fp.read(min(block_size, size - position)), dtype=np.uint8)
+                if len(block) == 0:
+                    break
+                parity = (np.cumsum(block == ord('"')) + in_quotes) % 2
+                row_ends = np.flatnonzero((block == ord("\n")) & (parity == 0))
+                if len(row_ends) > 0:
+                    end = position + int(row_ends[-1]) + 1
+                in_quotes = int(parity[-1])
+                position += len(block)
+        return end
+
+    def mark_processed(self, csvlog, offset):
+        stat = os.stat(csvlog)
+        self.files[self._key(csvlog)] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "head": self._head_hash(csvlog, offset),
+            "offset": offset,
+        }
+
+    def update_time_range(self, df):
+        if len(df) == 0:
+            return
+        min_time, max_time = df.index.min(), df.index.max()
+        if self.min_time is None or min_time < pd.Timestamp(self.min_time):
+            self.min_time = min_time.isoformat()
+        if self.max_time is None or max_time > pd.Timestamp(self.max_time):
+            self.max_time = max_time.isoformat()
+
+    @staticmethod
+    def part_name(part):
+        return f"part-{part:08d}"
+
+    def next_part_name(self):
+        part_name = self.part_name(self.next_part)
+        self.next_part += 1
+        return part_name
+
+
+class TemplateDictionary:
+    """
+    Assign stable integer ids to query templates, so that a Parquet dataset stores each template string once.
+
+    The dictionary is stored alongside the dataset parts, which only store template ids.
+    Ids are assigned densely and in order of first appearance, and are never reassigned.
+
+    Attributes
+    ----------
+    templates : List[str]
+        The query template of each template id.
+    """
+
+    FILENAME = "_templates.parquet"
+
+    def __init__(self, templates=None):
+        self.templates = [] if templates is None else list(templates)
+        self._ids = {template: template_id for template_id, template in enumerate(self.templates)}
+
+    @staticmethod
+    def exists(dataset_path):
+        return (Path(dataset_path) / TemplateDictionary.FILENAME).exists()
+
+    @staticmethod
+    def load(dataset_path):
+        """
+        Load the template dictionary of the given dataset, or an empty dictionary if there is none.
+        """
+        if not TemplateDictionary.exists(dataset_path):
+            return TemplateDictionary()
+        df = pd.read_parquet(Path(dataset_path) / TemplateDictionary.FILENAME)
+        assert (df["template_id"].to_numpy() == np.arange(len(df))).all(), "Template ids must be dense."
+        return TemplateDictionary(df["query_template"])
+
+    def save(self, dataset_path):
+        table = pa.table(
+            {
+                "template_id": pa.array(np.arange(len(self.templates), dtype=np.int32)),
+                "query_template": pa.array(self.templates, type=pa.string()),
+            }
+        )
+        with _atomic_write(Path(dataset_path) / TemplateDictionary.FILENAME) as tmp_path:
+            pq.write_table(table, tmp_path, compression="zstd")
+
+    def encode(self, template_series):
+        """
+        Convert query templates to template ids, assigning ids to templates that have not been seen before.
+
+        Parameters
+        ----------
+        template_series : pd.Series
+            A str-typed series of query templates.
+
+        Returns
+        -------
+        template_ids : np.ndarray
+            The int32 template id of each query template.
+        """
+        codes, uniques = pd.factorize(template_series)
+        unique_ids = np.empty(len(uniques), dtype=np.int32)
+        for i, template in enumerate(uniques):
+            template_id = self._ids.get(template)
+            if template_id is None:
+                template_id = len(self.templates)
+                self._ids[template] = template_id
+                self.templates.append(template)
+            unique_ids[i] = template_id
+        return unique_ids[codes]
+
+    def decode(self, template_ids):
+        """
+        Convert template ids back to query templates.
+
+        Parameters
+        ----------
+        template_ids : np.ndarray
+            Template ids produced by encode.
+
+        Returns
+        -------
+        query_templates : pd.Categorical
+            The query templates, which share the template id as their category code.
+        """
+        return pd.Categorical.from_codes(template_ids, categories=self.templates)
+
+
+class CountCube:
+    """
+    Per-template query counts of a Parquet dataset, pre-aggregated at several time resolutions.
+
+    Every dataset part has a counts part of the same name for each resolution, stored under
+    _counts/<resolution in ns>/. The leading underscore hides the counts from readers of the dataset itself.
+    Counts are sparse: a (template, bucket) pair is only stored if it has queries, and a pair that
+    straddles two parts is stored once per part.
+
+    Any interval that is a multiple of a stored resolution is served by re-bucketing the counts of the
+    coarsest such resolution, instead of resampling the raw query log.
+    """
+
+    DIRNAME = "_counts"
+    RESOLUTIONS = [pd.Timedelta(milliseconds=10), pd.Timedelta(seconds=1), pd.Timedelta(minutes=1)]
+
+    def __init__(self, dataset_path):
+        self.dataset_path = Path(dataset_path)
+        self.resolutions = sorted(
+            pd.Timedelta(int(path.name), unit="ns") for path in (self.dataset_path / self.DIRNAME).iterdir()
+        )
+
+    @staticmethod
+    def exists(dataset_path):
+        return (Path(dataset_path) / CountCube.DIRNAME).is_dir()
+
+    @staticmethod
+    def clear(dataset_path):
+        shutil.rmtree(Path(dataset_path) / CountCube.DIRNAME, ignore_errors=True)
+
+    @staticmethod
+    def write_part(df, dataset_path, part_name, template_dictionary=None):
+        """
+        Write the counts of a preprocessed chunk at every resolution.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            A preprocessed chunk from iter_csvlog_chunks.
+        dataset_path : str | Path
+            The directory containing the Parquet dataset.
+        part_name : str
+            The name of the dataset part that the chunk was written to.
+        template_dictionary : TemplateDictionary | None
+            If specified, query templates are stored as ids from this dictionary instead of as strings.
+        """
+        df = df[df["query_template"] != ""]
+        log_time_ns = _to_ns(df.index)
+        templates = df["query_template"].to_numpy()
+        template_column = "query_template"
+        if template_dictionary is not None:
+            template_column = "template_id"
+            templates = template_dictionary.encode(df["query_template"])
+
+        for resolution in CountCube.RESOLUTIONS:
+            buckets = pd.DataFrame(
+                {template_column: templates, "log_time": log_time_ns - log_time_ns % resolution.value}
+            )
+            counts = buckets.groupby([template_column, "log_time"], sort=False).size().rename("count").reset_index()
+            counts["log_time"] = pd.to_datetime(counts["log_time"], unit="ns", utc=True)
+            resolution_path = Path(dataset_path) / CountCube.DIRNAME / str(resolution.value)
+            resolution_path.mkdir(parents=True, exist_ok=True)
+            counts.to_parquet(resolution_path / f"{part_name}.parquet", compression="zstd", index=False)
+
+    def get_counts(self, interval, start_time=None, end_time=None):
+        """
+        Get the same counts as Preprocessor.get_grouped_dataframe_interval(interval).
+
+        Parameters
+        ----------
+        interval : pd.Timedelta
+            The time interval to count the query templates by.
+        start_time : pd.Timestamp | None
+            If specified, only count log entries at or after this time.
+        end_time : pd.Timestamp | None
+            If specified, only count log entries before this time.
+
+        Returns
+        -------
+        grouped_df : pd.DataFrame | None
+            Counts indexed by (query_template, log_time), where every template has a row for every interval
+            between its first and last query. None if the interval or the time range is not aligned with
+            any stored resolution.
+        """
+        # Resampling aligns intervals to midnight, which only matches the cube's epoch-aligned buckets
+        # if the interval divides a day.
+        if pd.Timedelta(days=1).value % interval.value != 0:
+            return None
+        bounds = [pd.Timestamp(bound).value for bound in (start_time, end_time) if bound is not None]
+        resolutions = [
+            resolution
+            for resolution in self.resolutions
+            if interval.value % resolution.value == 0 and all(bound % resolution.value == 0 for bound in bounds)
+        ]
+        if len(resolutions) == 0:
+            return None
+
+        table = pq.read_table(
+            self.dataset_path / self.DIRNAME / str(resolutions[-1].value),
+            filters=Preprocessor._time_filters(start_time, end_time),
+        )
+        if "template_id" in table.column_names:
+            template_dictionary = TemplateDictionary.load(self.dataset_path)
+            templates = pd.Series(template_dictionary.decode(table.column("template_id").to_numpy()))
+        else:
+            templates = table.column("query_template").to_pandas()
+        if table.num_rows == 0:
+            index = pd.MultiIndex.from_arrays(
+                [pd.Index([], dtype=object), pd.DatetimeIndex([], tz="UTC")], names=["query_template", "log_time"]
+            )
+            return pd.DataFrame({"count": np.array([], dtype=np.int64)}, index=index)
+        codes, uniques = pd.factorize(templates.astype(str), sort=True)
+        # Cast through ns timestamps, so that buckets are in ns whatever unit the counts were stored in.
+        buckets = table.column("log_time").cast(pa.timestamp("ns", tz="UTC")).cast(pa.int64()).to_numpy()
+        buckets = (buckets - buckets % interval.value) // interval.value
+        counts = table.column("count").to_numpy()
+
+        # Lay out every template's intervals from its first to its last bucket, then add the counts in.
+        first = np.full(len(uniques), np.iinfo(np.int64).max)
+        last = np.full(len(uniques), np.iinfo(np.int64).min)
+        np.minimum.at(first, codes, buckets)
+        np.maximum.at(last, codes, buckets)
+        lengths = last - first + 1
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        template_codes = np.repeat(np.arange(len(uniques)), lengths)
+        positions = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+        dense_counts = np.bincount(offsets[codes] + buckets - first[codes], weights=counts, minlength=lengths.sum())
+
+        log_times = pd.to_datetime((np.repeat(first, lengths) + positions) * interval.value, unit="ns", utc=True)
+        index = pd.MultiIndex.from_arrays(
+            [pd.Index(uniques, dtype=object)[template_codes], log_times], names=["query_template", "log_time"]
+        )
+        return pd.DataFrame({"count": dense_counts.astype(np.int64)}, index=index)
+
+
+class TemplateCache:
+    """
+    A bounded LRU cache from raw SQL statement text to the statement's token skeleton.
+
+    Extended query protocol statements are logged with $n placeholders, so the same few statements
+    repeat across millions of log entries. Caching their skeletons means that each distinct statement is
+    only tokenized once, and only parameter binding happens per log entry. Simple query protocol statements
+    inline their constants and are mostly one-off, so they are not cached, lest they evict the skeletons.
+
+    Attributes
+    ----------
+    maxsize : int
+        The maximum number of skeletons to keep.
+    hits : int
+        The number of lookups that found a cached skeleton.
+    misses : int
+        The number of lookups that had to tokenize the statement.
+    """
+
+    DEFAULT_MAXSIZE = 8192
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._skeletons = OrderedDict()
+
+    def get(self, query):
+        """
+        Get the skeleton of the given statement, tokenizing it if it is not cached.
+
+        Parameters
+        ----------
+        query : str
+            A SQL query produced by _extract_query, possibly containing $n placeholders.
+
+        Returns
+        -------
+        skeleton : Tuple
+            The skeleton produced by Preprocessor._query_skeleton.
+        """
+        skeleton = self._skeletons.get(query)
+        if skeleton is not None:
+            self.hits += 1
+            self._skeletons.move_to_end(query)
+            return skeleton
+        self.misses += 1
+        skeleton = Preprocessor._query_skeleton(query)
+        self._skeletons[query] = skeleton
+        if len(self._skeletons) > self.maxsize:
+            self._skeletons.popitem(last=False)
+        return skeleton
+
+    def __str__(self):
+        return f"{self.hits} cache hits, {self.misses} cache misses"
+
+
+class ParamIndex:
+    """
+    An index from query template to the parameter vectors that were observed with it.
+
+    The (query_template, query_params) counts are laid out so that every template owns a contiguous slice
+    of the parameter and count arrays. Looking up a template's parameters is then a dictionary lookup and a
+    slice, and weighted sampling is a searchsorted over the cumulative counts instead of a scan of the
+    grouped dataframe.
+
+    Attributes
+    ----------
+    params : np.ndarray
+        The parameter vectors (tuples of strings), grouped by query template.
+    counts : np.ndarray
+        The number of times each parameter vector was observed.
+    cumulative_counts : np.ndarray
+        The running total of counts; the weights of a template's slice are a subrange of this array.
+    slices : Dict[str, Tuple[int, int]]
+        The [start, stop) range of each query template in params and counts.
+    """
+
+    def __init__(self, grouped_df_params):
+        """
+        Build the index from the output of Preprocessor.get_grouped_dataframe_params().
+
+        Parameters
+        ----------
+        grouped_df_params : pd.DataFrame
+            Counts indexed by (query_template, query_params).
+        """
+        templates = grouped_df_params.index.get_level_values(0)
+        codes, uniques = pd.factorize(templates)
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        self.params = grouped_df_params.index.get_level_values(1).to_numpy()[order]
+        self.counts = grouped_df_params["count"].to_numpy(dtype=np.int64)[order]
+        self.cumulative_counts = np.cumsum(self.counts)
+        starts = np.searchsorted(codes, np.arange(len(uniques)), side="left")
+        stops = np.searchsorted(codes, np.arange(len(uniques)), side="right")
+        self.slices = {str(template): (start, stop) for template, start, stop in zip(uniques, starts, stops)}
+
+    def get(self, query):
+        """
+        Get the parameter vectors and counts of a query template.
+
+        Parameters
+        ----------
+        query : str
+            The query template to look up parameters for.
+
+        Returns
+        -------
+        params, counts : (np.ndarray, np.ndarray)
+            The parameter vectors and their counts. Both are empty if the template was never seen.
+        """
+        start, stop = self.slices.get(query, (0, 0))
+        return self.params[start:stop], self.counts[start:stop]
+
+    def sample(self, query, n, replace=True, weights=True):
+        """
+        Sample parameter vectors of a query template.
+
+        Parameters
+        ----------
+        query : str
+            The query template to sample parameters for.
+        n : int
+            The number of parameter vectors to sample.
+        replace : bool
+            True if the sampling should be done with replacement.
+        weights : bool
+            True if the sampling should use the counts as weights.
+            False if the sampling should be equal probability weighting.
+
+        Returns
+        -------
+        params : np.ndarray
+            The sampled parameter vectors.
+        """
+        start, stop = self.slices.get(query, (0, 0))
+        if stop - start == 0:
+            raise ValueError(f"No parameters were observed for the query template: {query}")
+
+        if not replace:
+            # Sampling without replacement cannot be done with independent draws, so defer to numpy.
+            counts = self.counts[start:stop]
+            p = counts / counts.sum() if weights else None
+            offsets = np.random.choice(stop - start, size=n, replace=False, p=p)
+            return self.params[start:stop][offsets]
+
+        if not weights:
+            return self.params[np.random.randint(start, stop, size=n)]
+
+        # Draw uniformly from the template's range of the cumulative counts. The first cumulative count that
+        # exceeds a draw identifies the parameter vector that the draw landed on.
+        low = self.cumulative_counts[start - 1] if start > 0 else 0
+        high = self.cumulative_counts[stop - 1]
+        draws = np.random.randint(low, high, size=n)
+        return self.params[np.searchsorted(self.cumulative_counts, draws, side="right")]
 
 
 class Preprocessor:
@@ -37,7 +753,7 @@ class Preprocessor:
             Dataframe containing the query log data.
             Note that irrelevant query log entries are still included.
         """
-        return self._df
+        return self._get_df()
 
     def get_grouped_dataframe_interval(self, interval=None):
         """
@@ -55,13 +771,22 @@ class Preprocessor:
             Dataframe containing the pre-grouped query log data.
             Grouped on query template and optionally log time.
         """
+        if interval is not None and self._count_cube is not None:
+            grouped_df = self._count_cube.get_counts(interval, start_time=self._start_time, end_time=self._end_time)
+            if grouped_df is not None:
+                return grouped_df
+
         gb = None
+        df = self._get_df()
         if interval is None:
-            gb = self._df.groupby("query_template").size()
-            gb.drop("", axis=0, inplace=True)
+            gb = df.groupby("query_template", observed=True).size()
+            gb.drop("", axis=0, inplace=True, errors="ignore")
         else:
-            gb = self._df.groupby("query_template").resample(interval).size()
-            gb.drop("", axis=0, level=0, inplace=True)
+            gb = df.groupby("query_template", observed=True).resample(interval).size()
+            if isinstance(gb, pd.DataFrame):
+                # If every template spans the same intervals, pandas returns a (template x interval) frame instead.
+                gb = gb.stack()
+            gb.drop("", axis=0, level=0, inplace=True, errors="ignore")
         grouped_df = pd.DataFrame(gb, columns=["count"])
         return grouped_df
 
@@ -75,7 +800,7 @@ class Preprocessor:
             Dataframe containing the pre-grouped query log data.
             Grouped on query template and query parameters.
         """
-        return self._grouped_df_params
+        return self._get_grouped_df_params()
 
     def get_params(self, query):
         """
@@ -93,8 +818,8 @@ class Preprocessor:
             Unfortunately, due to quirks of the PostgreSQL CSVLOG format,
             the types of parameters are unreliable and may be stringly typed.
         """
-        params = self._grouped_df_params.query("query_template == @query")
-        return params.droplevel(0).squeeze(axis=1)
+        params, counts = self._get_param_index().get(query)
+        return pd.Series(counts, index=pd.Index(params, tupleize_cols=False, name="query_params"), name="count")
 
     def sample_params(self, query, n, replace=True, weights=True):
         """
@@ -117,10 +842,7 @@ class Preprocessor:
         params : np.ndarray
             Sample of the parameters associated with a particular query.
         """
-        params = self.get_params(query)
-        weight_vec = params if weights else None
-        sample = params.sample(n, replace=replace, weights=weight_vec)
-        return sample.index.to_numpy()
+        return self._get_param_index().sample(query, n, replace=replace, weights=weights)
 
     @staticmethod
     def substitute_params(query_template, params):
@@ -133,21 +855,24 @@ class Preprocessor:
         return query
 
     @staticmethod
-    def _read_csv(csvlog, log_columns):
+    def _read_csv(csvlog, log_columns, chunk_size=None):
         """
         Read a PostgreSQL CSVLOG file into a pandas DataFrame.
 
         Parameters
         ----------
-        csvlog : str
-            Path to a CSVLOG file generated by PostgreSQL.
+        csvlog : str | file-like
+            Path to (or an open binary handle of) a CSVLOG file generated by PostgreSQL.
         log_columns : List[str]
             List of columns in the csv log.
+        chunk_size : int | None
+            If specified, the number of rows to read at a time.
 
         Returns
         -------
-        df : pd.DataFrame
+        df : pd.DataFrame | Iterator[pd.DataFrame]
             DataFrame containing the relevant columns for query forecasting.
+            If chunk_size is specified, an iterator over DataFrames of at most chunk_size rows.
         """
         # This function must have a separate non-local binding from _read_df
         # so that it can be pickled for multiprocessing purposes.
@@ -164,10 +889,11 @@ class Preprocessor:
             ],
             header=None,
             index_col=False,
+            chunksize=chunk_size,
         )
 
     @staticmethod
-    def _read_df(csvlogs, log_columns):
+    def _read_df(csvlogs, log_columns, executor=None):
         """
         Read the provided PostgreSQL CSVLOG files into a single DataFrame.
 
@@ -177,13 +903,16 @@ class Preprocessor:
             List of paths to CSVLOG files generated by PostgreSQL.
         log_columns : List[str]
             List of columns in the csv log.
+        executor : PreprocessorExecutor | None
+            The executor to read the files with, one file per task. If None, they are read serially.
 
         Returns
         -------
         df : pd.DataFrame
             DataFrame containing the relevant columns for query forecasting.
         """
-        return pd.concat(process_map(Preprocessor._read_csv, csvlogs, [log_columns for _ in csvlogs]))
+        executor = PreprocessorExecutor() if executor is None else executor
+        return pd.concat(executor.map(Preprocessor._read_csv, csvlogs, [log_columns for _ in csvlogs]))
 
     @staticmethod
     def _extract_query(message_series):
@@ -208,16 +937,19 @@ class Preprocessor:
         query = query[0].fillna(query[1])
         print("TODO(WAN): Disabled SQL format for being too slow.")
         # Prettify each SQL query for standardized formatting.
-        # query = query.parallel_map(pglast.prettify, na_action='ignore')
+        # query = query.map(pglast.prettify, na_action='ignore')
         # Replace NA values (irrelevant log messages) with empty strings.
         query.fillna("", inplace=True)
         return query.astype(str)
 
+    # A single "$n = value" entry of a "parameters: ..." detail message.
+    # Values are either NULL or quoted strings with embedded quotes doubled, so they may contain ", ".
+    _PARAM_REGEX = r"\$(\d+) = ('(?:[^']|'')*'|NULL)"
+
     @staticmethod
     def _extract_params(detail_series):
         """
         Extract SQL parameters from the CSVLOG's detail column.
-        If there are no such parameters, an empty {} is returned.
 
         Parameters
         ----------
@@ -226,31 +958,221 @@ class Preprocessor:
 
         Returns
         -------
-        params : pd.Series
-            A dict-typed series containing the parameters from the log.
-        """
-
-        def extract(detail):
-            detail = str(detail)
-            prefix = "parameters: "
-            idx = detail.find(prefix)
-            if idx == -1:
-                return {}
-            parameter_list = detail[idx + len(prefix) :]
-            params = {}
-            for pstr in parameter_list.split(", "):
-                pnum, pval = pstr.split(" = ")
-                assert pnum.startswith("$")
-                assert pnum[1:].isdigit()
-                params[pnum] = pval
-            return params
-
-        return detail_series.parallel_apply(extract)
+        params : pd.DataFrame
+            One row per parameter, sorted by (row, param), with the columns:
+            row (position of the log row in detail_series), param (n for $n), value.
+            Log rows without parameters have no entries.
+        """
+        details = detail_series.fillna("").astype(str).reset_index(drop=True)
+        parameter_lists = details.str.extract(r"parameters: (.*)", flags=re.DOTALL)[0].dropna()
+        matches = parameter_lists.str.extractall(Preprocessor._PARAM_REGEX)
+        params = pd.DataFrame(
+            {
+                "row": matches.index.get_level_values(0).to_numpy(dtype=np.int64),
+                "param": matches[0].to_numpy(dtype=np.int64),
+                "value": matches[1].to_numpy(dtype=object),
+            }
+        )
+        # PostgreSQL logs every parameter in order, so the n-th match of a row must be $n.
+        assert (params["param"].to_numpy() == matches.index.get_level_values(1).to_numpy() + 1).all()
+        return params
+
+    # Token names of integer, float, and string constants, which are extracted as query parameters.
+    _CONSTANT_TOKENS = frozenset(["ICONST", "FCONST", "SCONST"])
+
+    @staticmethod
+    def _templatize_query(query, params, store_query_subst=False):
+        """
+        Substitute parameters into the query and extract (prepared query, parameters) in a single scan.
+
+        This is equivalent to inlining the parameters into the query and then scanning the inlined query
+        to pull its constants back out, without tokenizing every query twice.
+
+        Parameters
+        ----------
+        query : str
+            A SQL query produced by _extract_query, possibly containing $n placeholders.
+        params : Tuple[str, ...]
+            The parameters of the query, where $n is at position n - 1.
+        store_query_subst : bool
+            True if the query with parameters inlined should also be built.
+
+        Returns
+        -------
+        query_template : str
+            The prepared SQL query, with every constant replaced by a $n placeholder.
+        query_params : Tuple[str, ...]
+            The constants that were replaced, in placeholder order.
+        query_subst : str | None
+            The query with parameters inlined if store_query_subst, else None.
+        """
+        template, subst, template_params, last_end = [], [], [], 0
+
+        def emit(token_str, is_constant, gap):
+            if gap:
+                template.append(" ")
+                if store_query_subst:
+                    subst.append(" ")
+            if store_query_subst:
+                subst.append(token_str)
+            if is_constant:
+                template_params.append(token_str)
+                template.append("$" + str(len(template_params)))
+            else:
+                template.append(token_str)
+
+        for token in pglast.parser.scan(query):
+            token_str = str(query[token.start : token.end + 1])
+            gap = token.start > last_end
+            last_end = token.end + 1
+            if token.name != "PARAM":
+                emit(token_str, token.name in Preprocessor._CONSTANT_TOKENS, gap)
+                continue
+
+            # Consider '$2' -> "abc'def'ghi".
+            # This necessitates the use of a SQL-aware substitution,
+            # even if this is much slower than naive string substitution.
+            assert token_str.startswith("$")
+            assert token_str[1:].isdigit()
+            value = params[int(token_str[1:]) - 1]
+            if len(value) >= 2 and value[0] == "'" and value[-1] == "'":
+                # PostgreSQL logs parameters as quoted strings with embedded quotes doubled,
+                # which always scan as a single string constant.
+                emit(value, True, gap)
+                continue
+            # Otherwise (e.g., NULL), scan the value itself as the inlined query would have.
+            value_end = 0
+            for value_token in pglast.parser.scan(value):
+                value_str = str(value[value_token.start : value_token.end + 1])
+                emit(value_str, value_token.name in Preprocessor._CONSTANT_TOKENS, gap or value_token.start > value_end)
+                gap, value_end = False, value_token.end + 1
+
+        return "".join(template), tuple(template_params), "".join(subst) if store_query_subst else None
+
+    @staticmethod
+    def _query_skeleton(query):
+        """
+        Tokenize a raw SQL statement into a skeleton that parameters can be bound to without rescanning.
+
+        Parameters
+        ----------
+        query : str
+            A SQL query produced by _extract_query, possibly containing $n placeholders.
+
+        Returns
+        -------
+        query_template : str
+            The prepared SQL query, assuming that every $n parameter is bound to a quoted string.
+        slots : Tuple[Tuple[bool, int | str], ...]
+            For each placeholder in query_template, (True, n - 1) if it is bound to parameter $n
+            or (False, constant) if it replaced a constant in the statement.
+        subst_pieces : Tuple[Tuple[bool, int | str], ...]
+            The pieces of the statement, with (True, n - 1) where parameter $n is to be inlined.
+        """
+        template, slots, subst_pieces, last_end = [], [], [], 0
+        for token in pglast.parser.scan(query):
+            token_str = str(query[token.start : token.end + 1])
+            if token.start > last_end:
+                template.append(" ")
+                subst_pieces.append((False, " "))
+            last_end = token.end + 1
+            is_param = token.name == "PARAM"
+            piece = int(token_str[1:]) - 1 if is_param else token_str
+            if is_param or token.name in Preprocessor._CONSTANT_TOKENS:
+                slots.append((is_param, piece))
+                template.append("$" + str(len(slots)))
+            else:
+                template.append(token_str)
+            subst_pieces.append((is_param, piece))
+        return "".join(template), tuple(slots), tuple(subst_pieces)
 
     @staticmethod
-    def _substitute_params(df, query_col, params_col):
+    def _bind_skeleton(skeleton, params, store_query_subst=False):
         """
-        Substitute parameters into the query, wherever possible.
+        Bind parameters to a skeleton from _query_skeleton.
+
+        Parameters
+        ----------
+        skeleton : Tuple
+            The skeleton produced by _query_skeleton.
+        params : Tuple[str, ...]
+            The parameters of the query, where $n is at position n - 1.
+        store_query_subst : bool
+            True if the query with parameters inlined should also be built.
+
+        Returns
+        -------
+        templatized : Tuple[str, Tuple[str, ...], str | None] | None
+            The same (query_template, query_params, query_subst) as _templatize_query,
+            or None if a parameter is not a quoted string (e.g., NULL) and the query must be rescanned.
+        """
+        template, slots, subst_pieces = skeleton
+        template_params = []
+        for is_param, text in slots:
+            if is_param:
+                text = params[text]
+                if len(text) < 2 or text[0] != "'" or text[-1] != "'":
+                    return None
+            template_params.append(text)
+        query_subst = None
+        if store_query_subst:
+            query_subst = "".join(params[text] if is_param else text for is_param, text in subst_pieces)
+        return template, tuple(template_params), query_subst
+
+    # A $n placeholder, which only statements that are worth caching in a TemplateCache contain.
+    _PLACEHOLDER_REGEX = re.compile(r"\$\d")
+
+    # Separates the parameters of a row when they are shipped to workers as a single string.
+    # PostgreSQL text values cannot contain NUL, so this never occurs within a parameter.
+    _PARAM_SEPARATOR = "\0"
+
+    @staticmethod
+    def _templatize_chunk(queries, params, store_query_subst=False, template_cache=None):
+        """
+        Templatize a chunk of queries, see _templatize.
+
+        Parameters
+        ----------
+        queries : List[str]
+            Queries produced by _extract_query.
+        params : List[str]
+            The parameters of each query, joined by _PARAM_SEPARATOR.
+        store_query_subst : bool
+            True if the query with parameters inlined should also be built.
+        template_cache : TemplateCache | None
+            The cache of statement skeletons to use. If None, the calling worker's own cache is used,
+            which persists across chunks.
+
+        Returns
+        -------
+        templatized : List[Tuple[str, Tuple[str, ...], str | None]]
+            The (query_template, query_params, query_subst) of each query.
+        hits : int
+            The number of template cache hits in this chunk.
+        misses : int
+            The number of template cache misses in this chunk.
+        """
+        if template_cache is None:
+            if not hasattr(_worker_state, "template_cache"):
+                _worker_state.template_cache = TemplateCache()
+            template_cache = _worker_state.template_cache
+        hits, misses = template_cache.hits, template_cache.misses
+
+        templatized = []
+        for query, query_params in zip(queries, params):
+            query_params = tuple(query_params.split(Preprocessor._PARAM_SEPARATOR)) if query_params else ()
+            row = None
+            if query_params or Preprocessor._PLACEHOLDER_REGEX.search(query):
+                row = Preprocessor._bind_skeleton(template_cache.get(query), query_params, store_query_subst)
+            if row is None:
+                row = Preprocessor._templatize_query(query, query_params, store_query_subst)
+            templatized.append(row)
+        return templatized, template_cache.hits - hits, template_cache.misses - misses
+
+    @staticmethod
+    def _templatize(df, query_col, params, store_query_subst=False, template_cache=None, executor=None):
+        """
+        Extract (prepared queries, parameters) from the queries and their parameters.
 
         Parameters
         ----------
@@ -258,73 +1180,118 @@ class Preprocessor:
             The dataframe of query log data.
         query_col : str
             Name of the query column produced by _extract_query.
-        params_col : str
-            Name of the parameter column produced by _extract_params.
+        params : pd.DataFrame
+            The parameters of df's rows, as produced by _extract_params.
+        store_query_subst : bool
+            True if the query with parameters inlined should also be returned.
+        template_cache : TemplateCache | None
+            The cache of statement skeletons to use when running serially. If None, a new cache is used.
+            Pool workers keep their own caches, whose hits and misses are added to this cache's counts.
+        executor : PreprocessorExecutor | None
+            The executor to templatize the queries with. If None, queries are templatized serially.
+
         Returns
         -------
-        query_subst : pd.Series
-            A str-typed series containing the query with parameters inlined.
+        templatized : pd.DataFrame
+            A dataframe with query_template and query_params columns,
+            along with a query_subst column if store_query_subst.
         """
+        template_cache = TemplateCache() if template_cache is None else template_cache
+        executor = PreprocessorExecutor() if executor is None else executor
+
+        queries = df[query_col].tolist()
+        # Ship the parameters of each row to the workers as a single string.
+        joined = params.groupby("row", sort=False)["value"].agg(Preprocessor._PARAM_SEPARATOR.join)
+        params = np.full(len(df), "", dtype=object)
+        params[joined.index.to_numpy()] = joined.to_numpy()
+        params = params.tolist()
+        if executor.kind == "serial":
+            fn = functools.partial(
+                Preprocessor._templatize_chunk, store_query_subst=store_query_subst, template_cache=template_cache
+            )
+        else:
+            fn = functools.partial(Preprocessor._templatize_chunk, store_query_subst=store_query_subst)
 
-        def substitute(query, params):
-            # Consider '$2' -> "abc'def'ghi".
-            # This necessitates the use of a SQL-aware substitution,
-            # even if this is much slower than naive string substitution.
-            new_sql, last_end = [], 0
-            for token in pglast.parser.scan(query):
-                token_str = str(query[token.start : token.end + 1])
-                if token.start > last_end:
-                    new_sql.append(" ")
-                if token.name == "PARAM":
-                    assert token_str.startswith("$")
-                    assert token_str[1:].isdigit()
-                    new_sql.append(params[token_str])
-                else:
-                    new_sql.append(token_str)
-                last_end = token.end + 1
-            new_sql = "".join(new_sql)
-            return new_sql
-
-        def subst(row):
-            return substitute(row[query_col], row[params_col])
-
-        return df.parallel_apply(subst, axis=1)
+        templatized = []
+        for chunk, hits, misses in executor.map_chunks(fn, queries, params):
+            templatized.extend(chunk)
+            if executor.kind != "serial":
+                template_cache.hits += hits
+                template_cache.misses += misses
+
+        columns = ["query_template", "query_params", "query_subst"]
+        templatized = pd.DataFrame(templatized, index=df.index, columns=columns)
+        if not store_query_subst:
+            templatized.drop(columns=["query_subst"], inplace=True)
+        return templatized
 
     @staticmethod
-    def _parse(query_series):
+    def _preprocess_df(df, store_query_subst=False, clock=None, template_cache=None, executor=None):
         """
-        Parse the SQL query to extract (prepared queries, parameters).
+        Extract query templates and parameters from a DataFrame of raw CSVLOG rows.
 
         Parameters
         ----------
-        query_series : pd.Series
-            SQL queries with the parameters inlined.
+        df : pd.DataFrame
+            DataFrame produced by _read_csv.
+        store_query_subst: bool
+            True if the "query_subst" column should be stored.
+        clock : Callable[[str], None] | None
+            If specified, called with the name of each stage once the stage completes.
+        template_cache : TemplateCache | None
+            The cache of statement skeletons to use. If None, a new cache is used.
+        executor : PreprocessorExecutor | None
+            The executor to run the row-wise stages with. If None, they are run serially.
 
         Returns
         -------
-        queries_and_params : pd.Series
-            A series containing tuples of (prepared SQL query, parameters).
-        """
-
-        def parse(sql):
-            new_sql, params, last_end = [], [], 0
-            for token in pglast.parser.scan(sql):
-                token_str = str(sql[token.start : token.end + 1])
-                if token.start > last_end:
-                    new_sql.append(" ")
-                if token.name in ["ICONST", "FCONST", "SCONST"]:
-                    # Integer, float, or string constant.
-                    new_sql.append("$" + str(len(params) + 1))
-                    params.append(token_str)
-                else:
-                    new_sql.append(token_str)
-                last_end = token.end + 1
-            new_sql = "".join(new_sql)
-            return new_sql, tuple(params)
-
-        return query_series.parallel_apply(parse)
-
-    def _from_csvlogs(self, csvlogs, log_columns, store_query_subst=False):
+        df : pd.DataFrame
+            A dataframe representing the query log.
+        """
+        if template_cache is None:
+            template_cache = TemplateCache()
+
+        def stage(label):
+            if clock is not None:
+                print(f"{label}: ", end="", flush=True)
+
+        def done(label):
+            if clock is not None:
+                clock(label)
+
+        stage("Extract queries")
+        df["query_raw"] = Preprocessor._extract_query(df["message"])
+        df.drop(columns=["message"], inplace=True)
+        done("Extract queries")
+
+        stage("Extract parameters")
+        params = Preprocessor._extract_params(df["detail"])
+        df.drop(columns=["detail"], inplace=True)
+        done("Extract parameters")
+
+        stage("Templatize query")
+        hits, misses = template_cache.hits, template_cache.misses
+        templatized = Preprocessor._templatize(
+            df,
+            "query_raw",
+            params,
+            store_query_subst=store_query_subst,
+            template_cache=template_cache,
+            executor=executor,
+        )
+        df.drop(columns=["query_raw"], inplace=True)
+        df[templatized.columns] = templatized
+        done(
+            f"Templatize query ({template_cache.hits - hits} cache hits, {template_cache.misses - misses} cache misses)"
+        )
+
+        # Only keep the relevant columns to optimize for storage, unless otherwise specified.
+        stored_columns = ["log_time", "query_template", "query_params"]
+        if store_query_subst:
+            stored_columns.append("query_subst")
+        return df[stored_columns]
+
+    def _from_csvlogs(self, csvlogs, log_columns, store_query_subst=False, executor=None):
         """
         Glue code for initializing the Preprocessor from CSVLOGs.
 
@@ -336,6 +1303,8 @@ class Preprocessor:
             List of columns in the csv log.
         store_query_subst: bool
             True if the "query_subst" column should be stored.
+        executor : PreprocessorExecutor | None
+            The executor to run the row-wise stages with. If None, they are run serially.
 
         Returns
         -------
@@ -350,44 +1319,213 @@ class Preprocessor:
             print("\r{}: {:.2f} s".format(label, time_end - time_start))
             time_start = time_end
 
-        df = self._read_df(csvlogs, log_columns)
+        df = self._read_df(csvlogs, log_columns, executor=executor)
         clock("Read dataframe")
 
-        print("Extract queries: ", end="", flush=True)
-        df["query_raw"] = self._extract_query(df["message"])
-        df.drop(columns=["message"], inplace=True)
-        clock("Extract queries")
+        return self._preprocess_df(df, store_query_subst=store_query_subst, clock=clock, executor=executor)
 
-        print("Extract parameters: ", end="", flush=True)
-        df["params"] = self._extract_params(df["detail"])
-        df.drop(columns=["detail"], inplace=True)
-        clock("Extract parameters")
+    @staticmethod
+    def iter_csvlog_chunks(
+        csvlogs,
+        log_columns,
+        chunk_size,
+        store_query_subst=False,
+        byte_ranges=None,
+        template_cache=None,
+        executor=None,
+    ):
+        """
+        Preprocess the provided CSVLOGs in bounded-size chunks.
 
-        print("Substitute parameters into query: ", end="", flush=True)
-        df["query_subst"] = self._substitute_params(df, "query_raw", "params")
-        df.drop(columns=["query_raw", "params"], inplace=True)
-        clock("Substitute parameters into query")
+        Only a single chunk of each CSVLOG is held in memory at a time,
+        so peak memory usage is determined by chunk_size rather than by the size of the logs.
 
-        print("Parse query: ", end="", flush=True)
-        parsed = self._parse(df["query_subst"])
-        df[["query_template", "query_params"]] = pd.DataFrame(parsed.tolist(), index=df.index)
-        clock("Parse query")
+        Parameters
+        ----------
+        csvlogs : List[str]
+            List of PostgreSQL CSVLOG files.
+        log_columns : List[str]
+            List of columns in the csv log.
+        chunk_size : int
+            The number of CSVLOG rows to preprocess at a time.
+        store_query_subst: bool
+            True if the "query_subst" column should be stored.
+        byte_ranges : List[Tuple[int, int]] | None
+            If specified, the [start, end) byte range of each CSVLOG to read.
+            Both offsets must fall on row boundaries, see LogManifest.
+        template_cache : TemplateCache | None
+            The cache of statement skeletons to share across all chunks. If None, a new cache is used.
+        executor : PreprocessorExecutor | None
+            The executor to run the row-wise stages of every chunk with. If None, they are run serially.
+
+        Yields
+        ------
+        csvlog : str
+            The CSVLOG that the chunk was read from.
+        chunk_id : int
+            The index of the chunk within the CSVLOG.
+        df : pd.DataFrame
+            The preprocessed chunk, indexed by log_time.
+        """
+        if byte_ranges is None:
+            byte_ranges = [(0, None) for _ in csvlogs]
+        if template_cache is None:
+            template_cache = TemplateCache()
+        for csvlog, (start, end) in zip(csvlogs, byte_ranges):
+            with open(csvlog, "rb") as fp:
+                fp.seek(start)
+                if end is not None:
+                    fp = io.BufferedReader(_BoundedReader(fp, end - start))
+                for chunk_id, chunk in enumerate(Preprocessor._read_csv(fp, log_columns, chunk_size=chunk_size)):
+                    df = Preprocessor._preprocess_df(
+                        chunk, store_query_subst=store_query_subst, template_cache=template_cache, executor=executor
+                    )
+                    df.set_index("log_time", inplace=True)
+                    yield csvlog, chunk_id, df
 
-        # Only keep the relevant columns to optimize for storage, unless otherwise specified.
-        stored_columns = ["log_time", "query_template", "query_params"]
-        if store_query_subst:
-            stored_columns.append("query_subst")
-        return df[stored_columns]
+    @staticmethod
+    def write_dataset_part(df, dataset_path, part_name, template_dictionary=None):
+        """
+        Write a preprocessed chunk as one part of a partitioned Parquet dataset.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            A preprocessed chunk from iter_csvlog_chunks.
+        dataset_path : str | Path
+            The directory containing the Parquet dataset.
+        part_name : str
+            The name of the part, unique within the dataset.
+        template_dictionary : TemplateDictionary | None
+            If specified, query templates are stored as ids from this dictionary instead of as strings,
+            and the part is compressed with zstd. The caller is responsible for saving the dictionary.
+
+        Returns
+        -------
+        part_path : Path
+            The path that the part was written to.
+        """
+        compression = "gzip"
+        if template_dictionary is not None:
+            compression = "zstd"
+            df = df.drop(columns=["query_template"]).assign(
+                template_id=template_dictionary.encode(df["query_template"])
+            )
+        table = pa.Table.from_pandas(df)
+        # A chunk without any parameters would otherwise be inferred as list<null>,
+        # which conflicts with the schema of the other parts in the dataset.
+        params_idx = table.schema.get_field_index("query_params")
+        table = table.set_column(params_idx, "query_params", table.column("query_params").cast(pa.list_(pa.string())))
+        part_path = Path(dataset_path) / f"{part_name}.parquet"
+        pq.write_table(table, part_path, compression=compression, use_dictionary=True)
+        return part_path
+
+    @staticmethod
+    def _time_filters(start_time, end_time):
+        """
+        Build Parquet filters that select log entries in [start_time, end_time).
+        """
+        filters = []
+        if start_time is not None:
+            filters.append(("log_time", ">=", pd.Timestamp(start_time)))
+        if end_time is not None:
+            filters.append(("log_time", "<", pd.Timestamp(end_time)))
+        return filters if len(filters) > 0 else None
+
+    @staticmethod
+    def _read_dictionary_dataset(dataset_path, columns=None, start_time=None, end_time=None, part_name=None):
+        """
+        Read a Parquet dataset that was written with a TemplateDictionary.
+
+        Parameters
+        ----------
+        dataset_path : str | Path
+            The directory containing the Parquet dataset.
+        columns : List[str] | None
+            The columns of get_dataframe() to read. If None, all columns are read.
+        start_time : pd.Timestamp | None
+            If specified, only log entries at or after this time are read.
+        end_time : pd.Timestamp | None
+            If specified, only log entries before this time are read.
+        part_name : str | None
+            If specified, only this part of the dataset is read.
+
+        Returns
+        -------
+        df : pd.DataFrame
+            The same dataframe as get_dataframe(), except that query_template is categorical
+            with the template ids as its codes.
+        """
+        template_dictionary = TemplateDictionary.load(dataset_path)
+        source = dataset_path if part_name is None else Path(dataset_path) / f"{part_name}.parquet"
+        read_columns = None
+        if columns is not None:
+            read_columns = ["log_time"] + [
+                "template_id" if column == "query_template" else column for column in columns
+            ]
+        table = pq.read_table(source, columns=read_columns, filters=Preprocessor._time_filters(start_time, end_time))
+
+        # Build the dataframe column by column, which avoids materializing template strings
+        # and lets query_params go straight to hashable tuples.
+        df = pd.DataFrame(index=pd.Index(table.column("log_time").to_pandas(), name="log_time"))
+        # Parts store template_id last, but get_dataframe() has query_template first.
+        for column in sorted(table.column_names, key=lambda name: name != "template_id"):
+            if column == "template_id":
+                df["query_template"] = template_dictionary.decode(table.column(column).to_numpy())
+            elif column == "query_params":
+                df[column] = [tuple(params) for params in table.column(column).to_pylist()]
+            elif column != "log_time":
+                df[column] = table.column(column).to_numpy()
+        return df
 
-    def __init__(self, parquet_path=None, csvlogs=None, log_columns=None, store_query_subst=False):
+    @staticmethod
+    def read_dataset_part(dataset_path, part_name, columns=None):
+        """
+        Read a single part of a Parquet dataset that was written by write_dataset_part.
+
+        Parameters
+        ----------
+        dataset_path : str | Path
+            The directory containing the Parquet dataset.
+        part_name : str
+            The name of the part, e.g., from LogManifest.part_name.
+        columns : List[str] | None
+            The columns of get_dataframe() to read. If None, all columns are read.
+
+        Returns
+        -------
+        df : pd.DataFrame
+            The rows of get_dataframe() that are stored in the part.
+        """
+        if TemplateDictionary.exists(dataset_path):
+            return Preprocessor._read_dictionary_dataset(dataset_path, columns=columns, part_name=part_name)
+        df = pd.read_parquet(Path(dataset_path) / f"{part_name}.parquet", columns=columns)
+        if "query_params" in df.columns:
+            df["query_params"] = df["query_params"].map(lambda x: tuple(x))
+        return df
+
+    def __init__(
+        self,
+        parquet_path=None,
+        csvlogs=None,
+        log_columns=None,
+        store_query_subst=False,
+        executor=None,
+        columns=None,
+        start_time=None,
+        end_time=None,
+    ):
         """
         Initialize the preprocessor with either CSVLOGs or a Parquet dataframe.
 
         Parameters
         ----------
         parquet_path : str | None
-            Path to a Parquet file containing a Preprocessor's get_dataframe().
-            If specified, none of the other keyword arguments have any effect.
+            Path to a Parquet file or dataset containing a Preprocessor's get_dataframe(),
+            or to a dataset written in the dictionary output format.
+            If specified, only columns, start_time, and end_time have any effect.
+            The query log is read on first use. If the dataset has a CountCube, interval counts are read from it
+            instead whenever possible.
 
         csvlogs : List[str] | None
             List of PostgreSQL CSVLOG files.
@@ -400,26 +1538,87 @@ class Preprocessor:
             This stores an approximation of the "raw SQL query" used to generate the query template and parameters.
             This is not necessarily the raw SQL query itself since that may exist in various forms depending on the
             query protocol format.
+
+        executor : PreprocessorExecutor | None
+            The executor to preprocess CSVLOGs with. If None, CSVLOGs are preprocessed serially.
+
+        columns : List[str] | None
+            The columns of get_dataframe() to read from parquet_path, e.g., ["query_template"] if only
+            template counts are needed. If None, all columns are read.
+            Parameter lookups require "query_params".
+
+        start_time : pd.Timestamp | None
+            If specified, only log entries at or after this time are read from parquet_path.
+
+        end_time : pd.Timestamp | None
+            If specified, only log entries before this time are read from parquet_path.
         """
+        self._df = None
+        self._count_cube = None
+        self._parquet_path = parquet_path
+        self._columns = columns
+        self._start_time = start_time
+        self._end_time = end_time
         if csvlogs is not None:
-            df = self._from_csvlogs(csvlogs, log_columns, store_query_subst=store_query_subst)
+            df = self._from_csvlogs(csvlogs, log_columns, store_query_subst=store_query_subst, executor=executor)
             df.set_index("log_time", inplace=True)
+            self._df = df
         else:
             assert parquet_path is not None
-            df = pd.read_parquet(parquet_path)
-            # convert params from array back to tuple so it is hashable
-            df["query_params"] = df["query_params"].map(lambda x: tuple(x))
+            # The query log itself is read on first use, since interval counts can often be served by the cube.
+            if CountCube.exists(parquet_path):
+                self._count_cube = CountCube(parquet_path)
+
+        # Grouping by template-parameters is expensive and only needed for parameter lookups, so it is deferred.
+        self._grouped_df_params = None
+        self._param_index = None
 
-        # Grouping queries by template-parameters count.
-        gbp = df.groupby(["query_template", "query_params"]).size()
-        grouped_by_params = pd.DataFrame(gbp, columns=["count"])
-        # grouped_by_params.drop('', axis=0, level=0, inplace=True)
-        # TODO(WAN): I am not sure if I'm wrong or pandas is wrong.
-        #  Above raises ValueError: Must pass non-zero number of levels/codes.
-        #  So we'll do this instead...
-        grouped_by_params = grouped_by_params[~grouped_by_params.index.isin([("", ())])]
-        self._df = df
-        self._grouped_df_params = grouped_by_params
+    def _get_df(self):
+        """
+        Get the query log, reading it from parquet_path on first use.
+        """
+        if self._df is None:
+            if TemplateDictionary.exists(self._parquet_path):
+                df = self._read_dictionary_dataset(
+                    self._parquet_path, columns=self._columns, start_time=self._start_time, end_time=self._end_time
+                )
+            else:
+                df = pd.read_parquet(
+                    self._parquet_path,
+                    columns=self._columns,
+                    filters=self._time_filters(self._start_time, self._end_time),
+                )
+                if "query_params" in df.columns:
+                    # convert params from array back to tuple so it is hashable
+                    df["query_params"] = df["query_params"].map(lambda x: tuple(x))
+            self._df = df
+        return self._df
+
+    def _get_grouped_df_params(self):
+        """
+        Get the query log grouped by (query template, query parameters), grouping it on first use.
+        """
+        if self._grouped_df_params is None:
+            df = self._get_df()
+            assert "query_params" in df.columns, "The query_params column was not loaded."
+            # Grouping queries by template-parameters count.
+            gbp = df.groupby(["query_template", "query_params"], observed=True).size()
+            grouped_by_params = pd.DataFrame(gbp, columns=["count"])
+            # grouped_by_params.drop('', axis=0, level=0, inplace=True)
+            # TODO(WAN): I am not sure if I'm wrong or pandas is wrong.
+            #  Above raises ValueError: Must pass non-zero number of levels/codes.
+            #  So we'll do this instead...
+            grouped_by_params = grouped_by_params[~grouped_by_params.index.isin([("", ())])]
+            self._grouped_df_params = grouped_by_params
+        return self._grouped_df_params
+
+    def _get_param_index(self):
+        """
+        Get the per-template parameter index, building it on first use.
+        """
+        if self._param_index is None:
+            self._param_index = ParamIndex(self._get_grouped_df_params())
+        return self._param_index
 
 
 class PreprocessorCLI(cli.Application):
@@ -453,6 +1652,9 @@ class PreprocessorCLI(cli.Application):
         "backend_type",
     ]
 
+    # The number of CSVLOG rows to read at a time in incremental mode, if --read-chunk-size is not specified.
+    _DEFAULT_READ_CHUNK_SIZE: int = 1_000_000
+
     query_log_folder = cli.SwitchAttr(
         "--query-log-folder", str, mandatory=True, help="The location containing postgresql*.csv query logs."
     )
@@ -479,6 +1681,156 @@ class PreprocessorCLI(cli.Application):
         help="Defines what the columns of the csvlog are. Can be the following options: {pg14, pg12, tiramisu}.",
     )
 
+    read_chunk_size = cli.SwitchAttr(
+        "--read-chunk-size",
+        int,
+        default=None,
+        help="If specified, stream each CSVLOG in chunks of this many rows. "
+        "The output Parquet is then written as a partitioned dataset directory with one part per chunk.",
+    )
+    executor_kind = cli.SwitchAttr(
+        "--executor",
+        cli.Set(*PreprocessorExecutor.KINDS),
+        default="process",
+        help="How to read the CSVLOGs, one per task unless streaming, and run the row-wise preprocessing stages.",
+    )
+    workers = cli.SwitchAttr(
+        "--workers", int, default=None, help="The number of thread or process workers. Default: CPU count."
+    )
+    chunk_size = cli.SwitchAttr(
+        "--chunk-size",
+        int,
+        default=PreprocessorExecutor.DEFAULT_CHUNK_SIZE,
+        help="The number of rows that are sent to a worker at a time.",
+    )
+    output_format = cli.SwitchAttr(
+        "--output-format",
+        cli.Set("dataframe", "dictionary"),
+        default="dataframe",
+        help="dataframe: store get_dataframe() as is. "
+        "dictionary: store a Parquet dataset directory where query templates are replaced by integer ids, "
+        f"with the templates themselves stored once in its {TemplateDictionary.FILENAME}.",
+    )
+    incremental = cli.Flag(
+        "--incremental",
+        help="Only preprocess the CSVLOG files and tail bytes that are not yet in the output Parquet dataset, "
+        f"as recorded by its {LogManifest.FILENAME}. Implies streaming.",
+    )
+
+    def _main_streaming(self, pgfiles, log_columns, executor):
+        """
+        Preprocess the CSVLOGs one chunk at a time, writing each chunk out as it is completed.
+        In incremental mode, only the files and tail bytes that are missing from the manifest are processed.
+        """
+        dataset_path = Path(self.output_parquet)
+        dataset_path.mkdir(parents=True, exist_ok=True)
+        manifest = LogManifest.load(dataset_path) if self.incremental else None
+        if manifest is not None and manifest.next_part > 0 and manifest.format_version != LogManifest.FORMAT_VERSION:
+            print(f"{dataset_path} was preprocessed by another version of the preprocessor, reprocessing it.")
+            manifest = None
+        if manifest is not None:
+            assert (self.output_format == "dictionary") == TemplateDictionary.exists(
+                dataset_path
+            ) or manifest.next_part == 0, f"--output-format {self.output_format} does not match the existing dataset."
+        else:
+            # Commit to the new dataset before removing the parts of any previous run, so that readers following
+            # the manifest never look for them, and so that they are not mixed in with the new dataset.
+            manifest = LogManifest(
+                format_version=LogManifest.FORMAT_VERSION, created=pd.Timestamp.now("UTC").isoformat()
+            )
+            manifest.save(dataset_path)
+            for stale_part in dataset_path.glob("*.parquet"):
+                stale_part.unlink()
+            CountCube.clear(dataset_path)
+        manifest.format_version = LogManifest.FORMAT_VERSION
+        # Whether the existing dataset is extended, rather than replaced.
+        extend = manifest.next_part > 0
+        # A dataset written before count cubes existed cannot be given a cube that only covers the new parts.
+        write_counts = manifest.next_part == 0 or CountCube.exists(dataset_path)
+        template_dictionary = None
+        if self.output_format == "dictionary":
+            template_dictionary = TemplateDictionary.load(dataset_path) if extend else TemplateDictionary()
+
+        templates = {}
+        if self.output_query_templates is not None and template_dictionary is not None:
+            templates.update(dict.fromkeys(template for template in template_dictionary.templates if template != ""))
+        elif self.output_query_templates is not None and extend:
+            # Seed the templates with those of the existing parts, one part at a time.
+            for part in sorted(dataset_path.glob("*.parquet")):
+                part_templates = pd.read_parquet(part, columns=["query_template"])["query_template"]
+                templates.update(dict.fromkeys(part_templates[part_templates != ""].unique()))
+        if self.output_queries is not None and not extend:
+            # Truncate the queries file, since every chunk is appended to it.
+            open(self.output_queries, "w").close()
+
+        pgfiles = sorted(pgfiles)
+        byte_ranges = [manifest.pending_range(csvlog) for csvlog in pgfiles]
+        pending = [
+            (csvlog, byte_range) for csvlog, byte_range in zip(pgfiles, byte_ranges) if byte_range[0] < byte_range[1]
+        ]
+        pending_ends = {csvlog: end for csvlog, (_, end) in pending}
+        print(f"Found {len(pending)} of {len(pgfiles)} CSVLOGs with new rows.")
+
+        template_cache = TemplateCache()
+        chunks = Preprocessor.iter_csvlog_chunks(
+            [csvlog for csvlog, _ in pending],
+            log_columns,
+            chunk_size=self.read_chunk_size,
+            store_query_subst=self.output_queries is not None,
+            byte_ranges=[byte_range for _, byte_range in pending],
+            template_cache=template_cache,
+            executor=executor,
+        )
+        last_csvlog = None
+        time_start = time.perf_counter()
+        for csvlog, chunk_id, df in chunks:
+            if last_csvlog is not None and csvlog != last_csvlog:
+                # The previous file has been fully processed, so record its progress.
+                # The dictionary is saved first so that the manifest never covers parts with unknown template ids.
+                if template_dictionary is not None:
+                    template_dictionary.save(dataset_path)
+                manifest.mark_processed(last_csvlog, pending_ends[last_csvlog])
+                manifest.save(dataset_path)
+            last_csvlog = csvlog
+
+            part_name = manifest.next_part_name()
+            part_path = Preprocessor.write_dataset_part(
+                df, dataset_path, part_name, template_dictionary=template_dictionary
+            )
+            if write_counts:
+                CountCube.write_part(df, dataset_path, part_name, template_dictionary=template_dictionary)
+            print(f"Stored {len(df)} rows of {csvlog} in: {part_path}")
+
+            manifest.update_time_range(df)
+            if self.output_query_templates is not None:
+                templates.update(dict.fromkeys(df["query_template"][df["query_template"] != ""].unique()))
+            if self.output_queries is not None:
+                queries = df["query_subst"]
+                queries = queries[queries != ""]
+                queries.to_csv(self.output_queries, mode="a", header=False, index=False, quoting=csv.QUOTE_ALL)
+            time_end = time.perf_counter()
+            print(f"Chunk {chunk_id} of {csvlog}: {time_end - time_start:.2f} s ({template_cache})")
+            time_start = time_end
+        if template_dictionary is not None:
+            template_dictionary.save(dataset_path)
+        if last_csvlog is not None:
+            manifest.mark_processed(last_csvlog, pending_ends[last_csvlog])
+        manifest.save(dataset_path)
+
+        if self.output_timestamp is not None:
+            if manifest.min_time is None:
+                # Without any log entries there is no time range, so leave no timestamps behind to be trusted.
+                print(f"No log entries were preprocessed, not writing timestamps to: {self.output_timestamp}")
+                Path(self.output_timestamp).unlink(missing_ok=True)
+            else:
+                with open(self.output_timestamp, "w") as ts_file:
+                    ts_file.write(manifest.min_time + "\n")
+                    ts_file.write(manifest.max_time + "\n")
+        if self.output_query_templates is not None:
+            pd.Series(list(templates)).to_csv(
+                self.output_query_templates, header=False, index=False, quoting=csv.QUOTE_ALL
+            )
+
     def main(self):
         pgfiles = glob.glob(str(Path(self.query_log_folder) / "postgresql*.csv"))
         assert len(pgfiles) > 0, f"No PostgreSQL query log files found in: {self.query_log_folder}"
@@ -503,11 +1855,36 @@ class PreprocessorCLI(cli.Application):
             ]
 
         print(f"Preprocessing CSV logs in: {self.query_log_folder}")
-        preprocessor = Preprocessor(
-            csvlogs=pgfiles, log_columns=log_columns, store_query_subst=self.output_queries is not None
-        )
+        if self.incremental and self.read_chunk_size is None:
+            self.read_chunk_size = self._DEFAULT_READ_CHUNK_SIZE
+        with PreprocessorExecutor(self.executor_kind, workers=self.workers, chunk_size=self.chunk_size) as executor:
+            if self.read_chunk_size is not None:
+                self._main_streaming(pgfiles, log_columns, executor)
+                return
+
+            preprocessor = Preprocessor(
+                csvlogs=pgfiles,
+                log_columns=log_columns,
+                store_query_subst=self.output_queries is not None,
+                executor=executor,
+            )
         print(f"Storing Parquet: {self.output_parquet}.")
-        preprocessor.get_dataframe().to_parquet(self.output_parquet, compression="gzip")
+        if self.output_format == "dictionary":
+            dataset_path = Path(self.output_parquet)
+            dataset_path.mkdir(parents=True, exist_ok=True)
+            for stale_part in dataset_path.glob("*.parquet"):
+                stale_part.unlink()
+            CountCube.clear(dataset_path)
+            template_dictionary = TemplateDictionary()
+            Preprocessor.write_dataset_part(
+                preprocessor.get_dataframe(), dataset_path, "part-00000000", template_dictionary=template_dictionary
+            )
+            CountCube.write_part(
+                preprocessor.get_dataframe(), dataset_path, "part-00000000", template_dictionary=template_dictionary
+            )
+            template_dictionary.save(dataset_path)
+        else:
+            preprocessor.get_dataframe().to_parquet(self.output_parquet, compression="gzip")
 
         # Optionally write min and max timestamps of queries to infer forecast window.
         if self.output_timestamp is not None:
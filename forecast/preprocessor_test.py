@@ -0,0 +1,435 @@
+import contextlib
+import csv
+import io
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pglast
+from preprocessor import (
+    LogManifest,
+    ParamIndex,
+    Preprocessor,
+    PreprocessorCLI,
+    PreprocessorExecutor,
+    TemplateCache,
+    _atomic_write,
+)
+
+
+def write_csvlog(path, n_rows, start_time="2022-01-01 00:00:00", seconds=1200, seed=15721, tables=("a", "b", "c")):
+    """
+    Write a pg14 CSVLOG with a mix of simple and extended protocol queries on three tables at random times.
+    """
+    rng = np.random.default_rng(seed)
+    offsets = pd.to_timedelta(np.sort(rng.uniform(0, seconds, n_rows)), unit="s")
+    log_times = pd.Timestamp(start_time, tz="UTC") + offsets
+    with open(path, "a", newline="") as fp:
+        writer = csv.writer(fp)
+        for i, log_time in enumerate(log_times):
+            kind = i % 3
+            detail = ""
+            if kind == 0:
+                message = f"statement: SELECT * FROM {tables[0]} WHERE x = {rng.integers(100)}"
+            elif kind == 1:
+                message = f"execute <unnamed>: UPDATE {tables[1]} SET y = $1 WHERE z = $2"
+                detail = f"parameters: $1 = '{rng.integers(10)}', $2 = 'q'"
+            else:
+                message = f"statement: DELETE FROM {tables[2]} WHERE id = {i}"
+            timestamp = log_time.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] + " UTC"
+            row = [timestamp, "user", "db", 1, "", "session", i, "SELECT", timestamp, "", 0, "LOG", "00000"]
+            writer.writerow(row + [message, detail] + [""] * 9)
+
+
+def run_preprocessor(*args):
+    """
+    Run the preprocessor CLI in this process, silencing its progress output.
+    """
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        _, retcode = PreprocessorCLI.run(["preprocessor.py", "--executor", "serial", *args], exit=False)
+    assert retcode in (None, 0), f"preprocessor.py exited with {retcode}"
+
+
+class TestAtomicWrite(unittest.TestCase):
+    def test_replace(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            path = Path(tmp_path) / "_manifest.json"
+            path.write_text("old")
+            with _atomic_write(path) as write_path:
+                write_path.write_text("new")
+                self.assertEqual(path.read_text(), "old")
+            self.assertEqual(path.read_text(), "new")
+
+            # A failed write leaves the old file, and no temporary file, behind.
+            with self.assertRaises(RuntimeError), _atomic_write(path) as write_path:
+                write_path.write_text("torn")
+                raise RuntimeError("crash")
+            self.assertEqual(path.read_text(), "new")
+            self.assertEqual([child.name for child in Path(tmp_path).iterdir()], ["_manifest.json"])
+
+
+class TestPreprocessorExecutor(unittest.TestCase):
+    def test_kinds_agree(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            csvlogs = [str(Path(tmp_path) / f"postgresql-{i}.csv") for i in range(2)]
+            write_csvlog(csvlogs[0], 600)
+            write_csvlog(csvlogs[1], 300, start_time="2022-01-01 01:00:00", seed=1)
+            dfs = {}
+            for kind in PreprocessorExecutor.KINDS:
+                # Small chunks, so that the parallel kinds split the logs across several workers.
+                with contextlib.ExitStack() as stack:
+                    executor = stack.enter_context(PreprocessorExecutor(kind, workers=2, chunk_size=64))
+                    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                    stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+                    if kind != "process":
+                        # Neither reading nor preprocessing may start a process pool behind the executor's back.
+                        for target in ["concurrent.futures.ProcessPoolExecutor", "preprocessor.ProcessPoolExecutor"]:
+                            stack.enter_context(mock.patch(target, side_effect=AssertionError("process pool")))
+                    dfs[kind] = Preprocessor(
+                        csvlogs=csvlogs, log_columns=PreprocessorCLI._PG_LOG_COLUMNS, executor=executor
+                    ).get_dataframe()
+
+        expected = dfs.pop("serial")
+        self.assertEqual(len(expected), 900)
+        self.assertEqual(expected["query_template"].nunique(), 3)
+        for kind, df in dfs.items():
+            with self.subTest(kind=kind):
+                pd.testing.assert_frame_equal(df, expected)
+
+
+class TestExtractParams(unittest.TestCase):
+    def test_values(self):
+        details = pd.Series(
+            [
+                "parameters: $1 = 'a, b', $2 = 'it''s', $3 = '$4 = x'",
+                None,
+                "parameters: $1 = NULL, $2 = '', $3 = ''''",
+                "some other detail",
+                "parameters: $1 = 'multi\nline', $2 = NULL",
+            ],
+            # Rows are numbered by position, whatever the index of the log is.
+            index=[10, 11, 12, 13, 14],
+        )
+        params = Preprocessor._extract_params(details)
+        self.assertEqual(
+            list(params.itertuples(index=False, name=None)),
+            [
+                (0, 1, "'a, b'"),
+                (0, 2, "'it''s'"),
+                (0, 3, "'$4 = x'"),
+                (2, 1, "NULL"),
+                (2, 2, "''"),
+                (2, 3, "''''"),
+                (4, 1, "'multi\nline'"),
+                (4, 2, "NULL"),
+            ],
+        )
+
+    def test_no_params(self):
+        params = Preprocessor._extract_params(pd.Series([None, "", "some other detail"], dtype=object))
+        self.assertEqual(len(params), 0)
+        self.assertEqual(list(params.columns), ["row", "param", "value"])
+
+
+class TestParamIndex(unittest.TestCase):
+    def setUp(self):
+        rows = [("SELECT $1", (str(value),)) for value, count in [(1, 1), (2, 3), (3, 6)] for _ in range(count)]
+        rows += [("DELETE $1", ("x",))] * 5
+        df = pd.DataFrame(rows, columns=["query_template", "query_params"])
+        grouped_df_params = pd.DataFrame(df.groupby(["query_template", "query_params"]).size(), columns=["count"])
+        self.index = ParamIndex(grouped_df_params)
+
+    def frequencies(self, query, n, **kwargs):
+        np.random.seed(15721)
+        samples = self.index.sample(query, n, **kwargs)
+        self.assertEqual(len(samples), n)
+        return pd.Series([params[0] for params in samples]).value_counts(normalize=True).sort_index()
+
+    def test_weighted(self):
+        frequencies = self.frequencies("SELECT $1", 100_000)
+        np.testing.assert_allclose(frequencies.to_numpy(), [0.1, 0.3, 0.6], atol=0.01)
+        self.assertEqual(list(frequencies.index), ["1", "2", "3"])
+        # Draws only land on the template's own slice of the cumulative counts.
+        self.assertEqual(list(self.frequencies("DELETE $1", 100).index), ["x"])
+
+    def test_unweighted(self):
+        frequencies = self.frequencies("SELECT $1", 100_000, weights=False)
+        np.testing.assert_allclose(frequencies.to_numpy(), [1 / 3] * 3, atol=0.01)
+
+    def test_without_replacement(self):
+        for weights in [True, False]:
+            with self.subTest(weights=weights):
+                samples = self.index.sample("SELECT $1", 3, replace=False, weights=weights)
+                self.assertEqual(sorted(params[0] for params in samples), ["1", "2", "3"])
+                with self.assertRaises(ValueError):
+                    self.index.sample("SELECT $1", 4, replace=False, weights=weights)
+
+    def test_seeded(self):
+        samples = []
+        for _ in range(2):
+            np.random.seed(15721)
+            samples.append(list(self.index.sample("SELECT $1", 50)))
+        self.assertEqual(samples[0], samples[1])
+
+    def test_unknown_template(self):
+        params, counts = self.index.get("UPDATE $1")
+        self.assertEqual((len(params), len(counts)), (0, 0))
+        with self.assertRaises(ValueError):
+            self.index.sample("UPDATE $1", 1)
+
+
+def substitute_then_parse(query, params):
+    """
+    Templatize a query the way the preprocessor used to: inline its parameters, then scan out its constants.
+    """
+    query_subst, last_end = [], 0
+    for token in pglast.parser.scan(query):
+        if token.start > last_end:
+            query_subst.append(" ")
+        token_str = query[token.start : token.end + 1]
+        query_subst.append(params[int(token_str[1:]) - 1] if token.name == "PARAM" else token_str)
+        last_end = token.end + 1
+    query_subst = "".join(query_subst)
+
+    template, template_params, last_end = [], [], 0
+    for token in pglast.parser.scan(query_subst):
+        if token.start > last_end:
+            template.append(" ")
+        token_str = query_subst[token.start : token.end + 1]
+        if token.name in ["ICONST", "FCONST", "SCONST"]:
+            template_params.append(token_str)
+            template.append(f"${len(template_params)}")
+        else:
+            template.append(token_str)
+        last_end = token.end + 1
+    return "".join(template), tuple(template_params), query_subst
+
+
+class TestTemplatize(unittest.TestCase):
+    QUERIES = [
+        ("SELECT * FROM a WHERE x = 1 AND y = 'b' AND z = 1.5", ()),
+        ("SELECT * FROM a WHERE x = $1 AND y = $2", ("'1'", "NULL")),
+        ("SELECT * FROM a WHERE x=$1", ("NULL",)),
+        ("UPDATE b SET y = $1 WHERE z = $2", ("'costs $2'", "'it''s $1'")),
+        ("INSERT INTO c VALUES ($1, $2, 3, 'd')", ("''", "'a, b'")),
+        ("DELETE FROM d WHERE id IN ($2, $1, $2)", ("'x'", "'y'")),
+        ("SELECT $10, $1 FROM e", tuple(f"'{i}'" for i in range(1, 11))),
+        ("SELECT * FROM f WHERE x = $1 -- trailing comment", ("'multi\nline'",)),
+    ]
+
+    def test_matches_substitute_then_parse(self):
+        for query, params in self.QUERIES:
+            expected = substitute_then_parse(query, params)
+            for store_query_subst in [False, True]:
+                with self.subTest(query=query, store_query_subst=store_query_subst):
+                    subst = expected[2] if store_query_subst else None
+                    self.assertEqual(
+                        Preprocessor._templatize_query(query, params, store_query_subst), (*expected[:2], subst)
+                    )
+                    # The cached skeleton gives the same result, unless it defers to a rescan for NULL parameters.
+                    skeleton = Preprocessor._query_skeleton(query)
+                    bound = Preprocessor._bind_skeleton(skeleton, params, store_query_subst)
+                    if "NULL" in params:
+                        self.assertIsNone(bound)
+                    else:
+                        self.assertEqual(bound, (*expected[:2], subst))
+
+
+class TestTemplateCache(unittest.TestCase):
+    def test_mixed_log(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            csvlog = Path(tmp_path) / "postgresql-0.csv"
+            # Every third row is the same prepared statement, and the others are mostly one-off simple statements.
+            write_csvlog(csvlog, 900)
+            df = Preprocessor._read_csv(csvlog, PreprocessorCLI._PG_LOG_COLUMNS)
+        # A cache too small to hold the simple statements, which must not evict the prepared statement.
+        template_cache = TemplateCache(maxsize=4)
+        with contextlib.redirect_stdout(io.StringIO()):
+            df = Preprocessor._preprocess_df(df, template_cache=template_cache)
+        self.assertEqual((template_cache.hits, template_cache.misses), (299, 1))
+        self.assertEqual(list(template_cache._skeletons), ["UPDATE b SET y = $1 WHERE z = $2"])
+        self.assertEqual(df["query_template"].nunique(), 3)
+        self.assertEqual(df["query_template"].iloc[1], "UPDATE b SET y = $1 WHERE z = $2")
+
+
+class TestDictionaryFormat(unittest.TestCase):
+    def test_matches_dataframe_format(self):
+        with tempfile.TemporaryDirectory() as tmp_path:
+            tmp_path = Path(tmp_path)
+            (tmp_path / "logs").mkdir()
+            write_csvlog(tmp_path / "logs" / "postgresql-0.csv", 600)
+            dfs = {}
+            for output_format, args in [
+                ("dataframe", []),
+                ("dictionary", []),
+                ("dictionary-streaming", ["--read-chunk-size", "100"]),
+            ]:
+                output_path = tmp_path / f"{output_format}.parquet"
+                run_preprocessor(
+                    "--query-log-folder",
+                    str(tmp_path / "logs"),
+                    "--output-parquet",
+                    str(output_path),
+                    "--output-format",
+                    output_format.split("-")[0],
+                    *args,
+                )
+                df = Preprocessor(parquet_path=output_path).get_dataframe()
+                # Dictionary datasets decode templates as categoricals.
+                dfs[output_format] = df.assign(query_template=df["query_template"].astype(str)).sort_index(
+                    kind="stable"
+                )
+
+        expected = dfs.pop("dataframe")
+        self.assertEqual(len(expected), 600)
+        for output_format, df in dfs.items():
+            with self.subTest(output_format=output_format):
+                pd.testing.assert_frame_equal(df, expected, check_index_type=False)
+
+
+class TestCountCube(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self._tmp.name)
+        (self.tmp_path / "logs").mkdir()
+        write_csvlog(self.tmp_path / "logs" / "postgresql-0.csv", 6000)
+        self.dataset_path = self.tmp_path / "preprocessed.parquet"
+        run_preprocessor(
+            "--query-log-folder",
+            str(self.tmp_path / "logs"),
+            "--output-parquet",
+            str(self.dataset_path),
+            "--incremental",
+            "--output-format",
+            "dictionary",
+        )
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def assert_cube_matches_resample(self, interval, start_time=None, end_time=None):
+        cube = Preprocessor(parquet_path=self.dataset_path, start_time=start_time, end_time=end_time)
+        self.assertIsNotNone(cube._count_cube)
+        resample = Preprocessor(parquet_path=self.dataset_path, start_time=start_time, end_time=end_time)
+        # Without a cube, counts are resampled from the query log itself.
+        resample._count_cube = None
+
+        def normalize(grouped_df):
+            # Templates may be categorical or strings, and times may be in any unit.
+            return pd.DataFrame(
+                {
+                    "query_template": grouped_df.index.get_level_values(0).astype(str),
+                    "log_time": grouped_df.index.get_level_values(1).as_unit("ns"),
+                    "count": grouped_df["count"].to_numpy(dtype=np.int64),
+                }
+            ).sort_values(["query_template", "log_time"], ignore_index=True)
+
+        expected = normalize(resample.get_grouped_dataframe_interval(interval))
+        actual = normalize(cube.get_grouped_dataframe_interval(interval))
+        self.assertGreater(len(expected), 0)
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_resolutions(self):
+        for interval in ["250ms", "1s", "1min", "3min", "1h"]:
+            with self.subTest(interval=interval):
+                self.assert_cube_matches_resample(pd.Timedelta(interval))
+
+    def test_time_range(self):
+        start_time = pd.Timestamp("2022-01-01 00:05:00", tz="UTC")
+        end_time = pd.Timestamp("2022-01-01 00:06:00", tz="UTC")
+        self.assert_cube_matches_resample(pd.Timedelta(seconds=1), start_time=start_time, end_time=end_time)
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self._tmp.name)
+        self.log_path = self.tmp_path / "logs"
+        self.log_path.mkdir()
+        self.dataset_path = self.tmp_path / "preprocessed.parquet"
+        self.timestamp_path = self.tmp_path / "preprocessed.timestamp.txt"
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def preprocess(self, *args, log_path=None):
+        run_preprocessor(
+            "--query-log-folder",
+            str(self.log_path if log_path is None else log_path),
+            "--output-parquet",
+            str(self.dataset_path),
+            "--output-timestamp",
+            str(self.timestamp_path),
+            *args,
+        )
+
+    def test_empty_log(self):
+        (self.log_path / "postgresql-0.csv").touch()
+        self.preprocess("--read-chunk-size", "100")
+        self.assertFalse(self.timestamp_path.exists())
+
+        write_csvlog(self.log_path / "postgresql-0.csv", 100)
+        self.preprocess("--incremental")
+        with open(self.timestamp_path) as ts_file:
+            self.assertEqual([pd.Timestamp(line).year for line in ts_file.read().splitlines()], [2022, 2022])
+
+    def count_rows(self):
+        return len(Preprocessor(parquet_path=self.dataset_path).get_dataframe())
+
+    def test_incremental_path_spellings(self):
+        write_csvlog(self.log_path / "postgresql-0.csv", 500)
+        self.preprocess("--incremental")
+        self.assertEqual(self.count_rows(), 500)
+        self.preprocess("--incremental", log_path=self.log_path / ".." / self.log_path.name)
+        self.assertEqual(self.count_rows(), 500)
+
+    def test_incremental_appended(self):
+        write_csvlog(self.log_path / "postgresql-0.csv", 500)
+        self.preprocess("--incremental", "--output-format", "dictionary")
+        write_csvlog(self.log_path / "postgresql-0.csv", 300, start_time="2022-01-01 01:00:00")
+        self.preprocess("--incremental", "--output-format", "dictionary")
+        self.assertEqual(self.count_rows(), 800)
+
+    def test_incremental_rewritten(self):
+        csvlog = self.log_path / "postgresql-0.csv"
+        write_csvlog(csvlog, 500)
+        self.preprocess("--incremental")
+        # Rotation truncates the file, which then grows back past the offset that was processed up to.
+        csvlog.unlink()
+        write_csvlog(csvlog, 800, start_time="2022-01-01 01:00:00", seed=1)
+        self.preprocess("--incremental")
+        self.assertEqual(self.count_rows(), 1300)
+
+    def test_incremental_format_version(self):
+        write_csvlog(self.log_path / "postgresql-0.csv", 500)
+        manifest_path = self.dataset_path / LogManifest.FILENAME
+        for stale_version in [{"format_version": LogManifest.FORMAT_VERSION - 1}, {"code_version": "0123abcd"}]:
+            with self.subTest(stale_version=stale_version):
+                self.preprocess("--incremental")
+                with open(manifest_path) as manifest_file:
+                    manifest = json.load(manifest_file)
+                del manifest["format_version"]
+                # Forget the processed files too, so that extending the dataset would duplicate their rows.
+                manifest.update(stale_version, files={})
+                with open(manifest_path, "w") as manifest_file:
+                    json.dump(manifest, manifest_file)
+
+                self.preprocess("--incremental")
+                self.assertEqual(self.count_rows(), 500)
+                self.assertEqual(LogManifest.load(self.dataset_path).format_version, LogManifest.FORMAT_VERSION)
+
+    def test_last_row_end_quoted_newline(self):
+        complete = b'2022-01-01 00:00:00 UTC,"statement: SELECT 1\nFROM a",\n'
+        partial = b'2022-01-01 00:00:01 UTC,"statement: SELECT ""x""\nFROM'
+        csvlog = self.log_path / "postgresql-0.csv"
+        csvlog.write_bytes(complete + partial)
+        self.assertEqual(LogManifest._last_row_end(csvlog, 0, len(complete + partial)), len(complete))
+        self.assertEqual(LogManifest._last_row_end(csvlog, 0, len(complete + partial), block_size=7), len(complete))
+
+
+if __name__ == "__main__":
+    unittest.main()